@@ -1,28 +1,10 @@
+import os
 import sys
-from typing import Optional
+from typing import List, Optional
 
 import typer
 
 from ailess import __app_name__, __version__
-from ailess.modules.aws_utils import push_docker_image, print_endpoint_info, ecs_deploy, wait_for_deployment
-from ailess.modules.cli_utils import config_prompt
-from ailess.modules.config_utils import save_config, load_config
-from ailess.modules.docker_utils import (
-    generate_or_update_docker_ignore,
-    generate_dockerfile,
-    build_docker_image,
-    generate_docker_compose_file,
-)
-from ailess.modules.docker_utils import start_docker_container, stop_container
-from ailess.modules.python_utils import ensure_requirements_exists
-from ailess.modules.terraform_utils import (
-    generate_terraform_file,
-    generate_tfvars_file,
-    ensure_tf_state_bucket_exists,
-    update_infrastructure,
-    destroy_infrastructure,
-    is_infrastructure_update_required,
-)
 
 app = typer.Typer()
 
@@ -30,6 +12,21 @@ app = typer.Typer()
 @app.command()
 def init() -> None:
     """Initialize the project"""
+    from ailess.modules.cli_utils import config_prompt
+    from ailess.modules.config_utils import save_config, get_deploy_regions, get_region_config
+    from ailess.modules.docker_utils import (
+        generate_or_update_docker_ignore,
+        generate_dockerfile,
+        generate_docker_compose_file,
+    )
+    from ailess.modules.python_utils import ensure_requirements_exists
+    from ailess.modules.server_utils import SERVER_CONFIG_PATH
+    from ailess.modules.terraform_utils import (
+        generate_terraform_file,
+        generate_tfvars_file,
+        get_terraform_dir,
+    )
+
     config = config_prompt()
     print("✔    Config saved to .ailess/config.json")
     ensure_requirements_exists()
@@ -39,38 +36,153 @@ def init() -> None:
     print("✔    .dockerignore")
     generate_dockerfile(config)
     print("✔    Dockerfile")
+    if os.path.exists(SERVER_CONFIG_PATH):
+        print(f"✔    {SERVER_CONFIG_PATH}")
     generate_docker_compose_file(config)
     print("✔    docker-compose.yml")
-    generate_tfvars_file(config)
-    generate_terraform_file(config)
+    for region in get_deploy_regions(config):
+        region_config = get_region_config(config, region)
+        generate_tfvars_file(region_config, get_terraform_dir(config, region))
+        generate_terraform_file(region_config, get_terraform_dir(config, region))
     print("✔    Terraform Cluster Config")
     print("🚀    done")
 
 
 @app.command()
-def deploy() -> None:
+def deploy(
+    verify_infra: bool = typer.Option(
+        False, "--verify-infra", help="Run terraform plan even if the infrastructure files are unchanged."
+    )
+) -> None:
     """Deploy the project"""
+    from ailess.modules.aws_utils import push_docker_image, print_endpoint_info, ecs_deploy
+    from ailess.modules.config_utils import load_config, get_deploy_regions, get_region_config
+    from ailess.modules.deployment_utils import wait_for_deployment
+    from ailess.modules.docker_utils import build_docker_image
+    from ailess.modules.pipeline_utils import (
+        Stage,
+        run_stages,
+        get_region_stage_name,
+        print_region_statuses,
+        STAGE_OK,
+    )
+    from ailess.modules.terraform_utils import (
+        ensure_tf_state_bucket_exists,
+        update_infrastructure,
+        is_infrastructure_update_required,
+        generate_terraform_file,
+        generate_tfvars_file,
+        get_terraform_dir,
+    )
+
     config = load_config()
+    regions = get_deploy_regions(config)
 
-    build_docker_image(config)
-    push_docker_image(config)
+    if len(regions) == 1:
+
+        plan = {}
 
-    ensure_tf_state_bucket_exists()
+        def plan_infrastructure():
+            ensure_tf_state_bucket_exists()
+            plan["update_required"] = is_infrastructure_update_required(verify=verify_infra)
 
-    should_update_infrastructure = is_infrastructure_update_required()
-    if should_update_infrastructure:
-        update_infrastructure()
+        def apply_infrastructure():
+            if plan["update_required"]:
+                update_infrastructure()
 
-    ecs_deploy(config)
-    wait_for_deployment(config)
+        # Planning overlaps the image build. A failing stage cancels the running ones, so the apply waits
+        # for the image to be pushed: it must never be interrupted halfway because of a build error.
+        run_stages(
+            [
+                Stage("build image", lambda: build_docker_image(config, for_deploy=True)),
+                Stage("push image", lambda: push_docker_image(config), depends_on=["build image"]),
+                Stage("plan infrastructure", plan_infrastructure),
+                Stage(
+                    "apply infrastructure",
+                    apply_infrastructure,
+                    depends_on=["plan infrastructure", "push image"],
+                ),
+                Stage("deploy", lambda: ecs_deploy(config), depends_on=["apply infrastructure"]),
+                Stage("rollout", lambda: wait_for_deployment(config), depends_on=["deploy"]),
+            ]
+        )
 
-    print_endpoint_info(config)
+        print_endpoint_info(config)
+        print("🚀    done")
+        return
+
+    def update_region_infrastructure_if_required(region_config, terraform_dir):
+        # Regions added to the config after init get their terraform files on the first deploy
+        if not os.path.exists(os.path.join(terraform_dir, "cluster.tf")):
+            generate_tfvars_file(region_config, terraform_dir)
+            generate_terraform_file(region_config, terraform_dir)
+        cwd = os.path.abspath(terraform_dir)
+        if is_infrastructure_update_required(verify=verify_infra, cwd=cwd):
+            update_infrastructure(cwd=cwd)
+
+    # The image is built once, every region pushes, plans and rolls out on its own so a failing
+    # region doesn't stop the others
+    stages = [
+        Stage("build image", lambda: build_docker_image(config, for_deploy=True)),
+        Stage("state bucket", ensure_tf_state_bucket_exists),
+    ]
+    phases = ["push image", "infrastructure", "deploy", "rollout"]
+    for region in regions:
+        region_config = get_region_config(config, region)
+        terraform_dir = get_terraform_dir(config, region)
+
+        def stage_name(phase, region=region):
+            return get_region_stage_name(phase, region)
+
+        stages += [
+            Stage(
+                stage_name("push image"),
+                lambda region_config=region_config: push_docker_image(region_config, config),
+                depends_on=["build image"],
+                output_prefix=region,
+            ),
+            Stage(
+                stage_name("infrastructure"),
+                lambda region_config=region_config, terraform_dir=terraform_dir: (
+                    update_region_infrastructure_if_required(region_config, terraform_dir)
+                ),
+                depends_on=["state bucket"],
+                output_prefix=region,
+            ),
+            Stage(
+                stage_name("deploy"),
+                lambda region_config=region_config: ecs_deploy(region_config),
+                depends_on=[stage_name("push image"), stage_name("infrastructure")],
+                output_prefix=region,
+            ),
+            Stage(
+                stage_name("rollout"),
+                lambda region_config=region_config: wait_for_deployment(region_config),
+                depends_on=[stage_name("deploy")],
+                output_prefix=region,
+            ),
+        ]
+    statuses = run_stages(stages, fail_fast=False)
+
+    print_region_statuses(regions, phases, statuses)
+    failed_regions = []
+    for region in regions:
+        if statuses.get(get_region_stage_name("rollout", region)) == STAGE_OK:
+            print_endpoint_info(get_region_config(config, region))
+        else:
+            failed_regions.append(region)
+    if failed_regions:
+        print(f"❌    deploy failed in {', '.join(failed_regions)}")
+        exit(1)
     print("🚀    done")
 
 
 @app.command()
 def serve() -> None:
     """Serve the project locally"""
+    from ailess.modules.config_utils import load_config
+    from ailess.modules.docker_utils import build_docker_image, start_docker_container, stop_container
+
     config = load_config()
     build_docker_image(config)
     try:
@@ -81,9 +193,102 @@ def serve() -> None:
     print("🚀    done")
 
 
+@app.command()
+def context(
+    apply: bool = typer.Option(False, "--apply", help="Add the suggested rules to .dockerignore."),
+    top: int = typer.Option(10, "--top", help="How many of the biggest entries to show."),
+) -> None:
+    """Show what's in the docker build context and suggest .dockerignore rules"""
+    from ailess.modules.context_utils import print_context_report
+
+    print_context_report(top=top, apply=apply)
+
+
+@app.command()
+def bench(
+    deployed: bool = typer.Option(
+        False, "--deployed", help="Load test the deployed endpoint instead of `ailess serve`."
+    ),
+    url: Optional[str] = typer.Option(None, "--url", help="Load test this base URL instead."),
+    path: str = typer.Option("/", "--path", help="Path to send the requests to."),
+    payload: Optional[str] = typer.Option(None, "--payload", help="File to send as the request body (POST)."),
+    method: Optional[str] = typer.Option(
+        None, "--method", help="HTTP method, POST with a payload, GET otherwise."
+    ),
+    content_type: Optional[str] = typer.Option(
+        None, "--content-type", help="Defaults to the payload's type."
+    ),
+    header: List[str] = typer.Option(
+        [], "--header", "-H", help="Extra header, e.g. 'Authorization: Bearer x'."
+    ),
+    concurrency: Optional[int] = typer.Option(
+        None, "--concurrency", "-c", help="Requests in flight [default: 8]."
+    ),
+    rate: Optional[float] = typer.Option(
+        None, "--rate", "-r", help="Send requests at this fixed rate per second."
+    ),
+    duration: Optional[float] = typer.Option(None, "--duration", "-d", help="Seconds to run [default: 30]."),
+    requests: Optional[int] = typer.Option(None, "--requests", "-n", help="Number of requests to send."),
+    output: Optional[str] = typer.Option(None, "--output", "-o", help="Write the results to this JSON file."),
+) -> None:
+    """Load test the local or deployed endpoint and report throughput and latency percentiles"""
+    from ailess.modules.bench_utils import run_bench, print_bench_results, save_bench_results
+    from ailess.modules.config_utils import load_config
+
+    if concurrency is not None and rate is not None:
+        raise typer.BadParameter("use either --concurrency or --rate")
+    if url is None:
+        config = load_config()
+        if deployed:
+            from ailess.modules.aws_utils import get_endpoint_url
+
+            url = get_endpoint_url(config)
+        else:
+            url = f"http://localhost:{config['host_port']}"
+    headers = {}
+    for line in header:
+        name, _, value = line.partition(":")
+        headers[name.strip()] = value.strip()
+
+    results = run_bench(
+        url,
+        path=path,
+        method=method,
+        payload_path=payload,
+        content_type=content_type,
+        headers=headers,
+        concurrency=concurrency,
+        rate=rate,
+        duration=duration,
+        requests=requests,
+    )
+    print_bench_results(results)
+    if output is not None:
+        save_bench_results(results, output)
+        print(f"✔    results saved to {output}")
+
+
+@app.command()
+def refresh_catalog(
+    region: str = typer.Option("us-east-1", "--region", help="Region to list the instance types of."),
+) -> None:
+    """Refresh the cached list of AWS regions and instance types"""
+    from ailess.modules.aws_utils import refresh_catalog as refresh_aws_catalog
+
+    instance_types_count = refresh_aws_catalog(region)
+    print(f"✔    catalog refreshed with {instance_types_count} instance types")
+
+
 @app.command()
 def destroy() -> None:
-    destroy_infrastructure()
+    from ailess.modules.config_utils import load_config, get_deploy_regions
+    from ailess.modules.terraform_utils import destroy_infrastructure, get_terraform_dir
+
+    config = load_config()
+    for region in get_deploy_regions(config):
+        terraform_dir = get_terraform_dir(config, region)
+        if os.path.exists(os.path.join(terraform_dir, "cluster.tf")):
+            destroy_infrastructure(cwd=os.path.abspath(terraform_dir))
     print("🚀    Done!")
 
 
@@ -102,6 +307,13 @@ def main(
         help="Show ailess CLI version and exit.",
         callback=_version_callback,
         is_eager=True,
-    )
+    ),
+    trace: Optional[str] = typer.Option(
+        None, "--trace", help="Write a Chrome trace of the command's phases to this file."
+    ),
+    timings: bool = typer.Option(False, "--timings", help="Print how long each phase of the command took."),
 ) -> None:
-    return
+    if trace is not None or timings:
+        from ailess.modules.trace_utils import enable_tracing
+
+        enable_tracing(trace, timings)
@@ -1,16 +1,74 @@
 import base64
+import functools
+import json
+import os
+import subprocess
+import threading
 import time
 
 import boto3
-from yaspin import yaspin
-
-from ailess.modules.cli_utils import run_command_in_working_directory
+from botocore.exceptions import ClientError
+
+from ailess.modules.catalog_utils import (
+    get_cached_regions,
+    get_cached_instance_type,
+    instance_type_to_catalog_entry,
+    save_instance_types,
+    save_regions,
+)
+from ailess.modules.cli_utils import (
+    run_command_in_working_directory,
+    progress_spinner,
+    print_command_output,
+    CommandFailedError,
+)
+from ailess.modules.config_utils import load_user_cache, save_user_cache
+from ailess.modules.trace_utils import traced, annotate_span, is_tracing_enabled, instrument_boto3_session
 from ailess.modules.docker_utils import (
     login_to_docker_registry,
+    PushProgressParser,
     DOCKER_ARCHITECTURE_AMD64,
     DOCKER_ARCHITECTURE_ARM64,
 )
 
+ECR_TOKEN_CACHE_FILE = "ecr_tokens.json"
+# Refresh the ECR token a bit before it actually expires so a long push doesn't fail midway
+ECR_TOKEN_EXPIRY_MARGIN = 30 * 60
+# What docker and buildx print when the registry rejects the stored credential
+ECR_AUTH_ERRORS = [
+    b"no basic auth credentials",
+    b"authorization token has expired",
+    b"401 Unauthorized",
+]
+
+_session = None
+_clients = {}
+_clients_lock = threading.Lock()
+_ecr_login_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    with _clients_lock:
+        if _session is None:
+            _session = boto3.session.Session()
+            if is_tracing_enabled():
+                instrument_boto3_session(_session)
+        return _session
+
+
+def get_client(service, region=None):
+    """Returns a boto3 client shared across the process for the (service, region) pair"""
+    key = (service, region)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    session = get_session()
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = session.client(service, region_name=region)
+        return _clients[key]
+
 
 def sort_key(region):
     # Assign priority based on region category
@@ -30,15 +88,25 @@ def sort_key(region):
 
 
 def get_regions():
-    """Returns a list of all AWS regions"""
-    regions = []
-    for region in boto3.client("ec2", region_name="us-east-1").describe_regions()["Regions"]:
-        regions.append(region["RegionName"])
+    """Returns AWS regions from the catalog, us, eu, ap, ca and sa regions first"""
+    return sorted(get_cached_regions(), key=lambda r: (sort_key(r), r))
+
 
-    ## Sort regions us, eu, ap, ca, sa
-    sorted_regions = sorted(regions, key=lambda r: (sort_key(r), r))
+def fetch_regions():
+    """Returns the regions enabled for the account from the EC2 API"""
+    return [region["RegionName"] for region in get_client("ec2", "us-east-1").describe_regions()["Regions"]]
 
-    return sorted_regions
+
+def refresh_catalog(region):
+    """Refreshes the cached region list and every instance type offered in region"""
+    save_regions(fetch_regions())
+    entries = {}
+    for page in get_client("ec2", region).get_paginator("describe_instance_types").paginate():
+        for instance_type in page["InstanceTypes"]:
+            entries[instance_type["InstanceType"]] = instance_type_to_catalog_entry(instance_type)
+    save_instance_types(entries)
+    get_instance_type_info.cache_clear()
+    return len(entries)
 
 
 def get_predefined_instances():
@@ -53,39 +121,131 @@ def get_predefined_instances():
     ]
 
 
+@functools.lru_cache(maxsize=None)
 def get_instance_type_info(instance_type: str, region: str):
-    response = boto3.client("ec2", region_name=region).describe_instance_types(
-        DryRun=False,
-        InstanceTypes=[instance_type],
-    )
-    if len(response["InstanceTypes"]) == 0:
-        print(f"ERROR: {instance_type} is not a valid instance type in {region}")
-        exit(1)
-
-    arch = DOCKER_ARCHITECTURE_AMD64
-
-    if "arm64" in response["InstanceTypes"][0]["ProcessorInfo"]["SupportedArchitectures"]:
-        arch = DOCKER_ARCHITECTURE_ARM64
-    if len(response["InstanceTypes"][0].get("GpuInfo", {}).get("Gpus", []))>0:
-        gpu_manufacturer = response["InstanceTypes"][0].get("GpuInfo", {}).get("Gpus", [])[0].get("Manufacturer", {})
-    else:
-        gpu_manufacturer = None
+    """Looks the instance type up in the catalog, only types the catalog doesn't know are fetched from EC2"""
+    entry = get_cached_instance_type(instance_type)
+    if entry is None:
+        try:
+            response = get_client("ec2", region).describe_instance_types(
+                DryRun=False,
+                InstanceTypes=[instance_type],
+            )
+        except ClientError:
+            response = {"InstanceTypes": []}
+        if len(response["InstanceTypes"]) == 0:
+            print(f"ERROR: {instance_type} is not a valid instance type in {region}")
+            exit(1)
+        entry = instance_type_to_catalog_entry(response["InstanceTypes"][0])
+        save_instance_types({instance_type: entry})
 
     return {
-        "memory_size": response["InstanceTypes"][0]["MemoryInfo"]["SizeInMiB"],
-        "cpu_size": response["InstanceTypes"][0]["VCpuInfo"]["DefaultVCpus"] * 1024,
-        "gpu_manufacturer": gpu_manufacturer,
-        "num_gpus": len(response["InstanceTypes"][0].get("GpuInfo", {}).get("Gpus", [])),
-        "cpu_architecture": arch,
+        "memory_size": entry["memory_size"],
+        "cpu_size": entry["vcpus"] * 1024,
+        "gpu_manufacturer": entry["gpu_manufacturer"],
+        "num_gpus": entry["num_gpus"],
+        "cpu_architecture": (
+            DOCKER_ARCHITECTURE_ARM64 if entry["cpu_architecture"] == "arm64" else DOCKER_ARCHITECTURE_AMD64
+        ),
     }
 
 
+@functools.lru_cache(maxsize=None)
+def get_caller_identity():
+    return get_client("sts").get_caller_identity()
+
+
 def get_aws_account_id():
-    return boto3.client("sts").get_caller_identity().get("Account")
+    return get_caller_identity().get("Account")
+
+
+def get_ecr_registry_url(region):
+    return f"{get_aws_account_id()}.dkr.ecr.{region}.amazonaws.com"
+
+
+def ensure_ecr_login(region, spinner):
+    """Logs docker into the ECR registry, reusing the cached token while it's still valid"""
+    # Docker's credential store and the token cache are plain files, pushes to several regions must take turns
+    with _ecr_login_lock:
+        return _ensure_ecr_login(region, spinner)
+
+
+def get_docker_config_path():
+    return os.path.join(os.environ.get("DOCKER_CONFIG") or os.path.expanduser("~/.docker"), "config.json")
+
+
+def get_ecr_token_key(registry_url):
+    # A token only helps the docker config it was stored in, e.g. not after switching DOCKER_CONFIG
+    return f"{get_docker_config_path()} {registry_url}"
+
+
+def is_docker_logged_in(registry_url):
+    """Whether the docker config still has an entry for the registry, `docker logout` removes it"""
+    try:
+        with open(get_docker_config_path(), "r") as f:
+            auths = json.load(f).get("auths", {})
+    except (OSError, ValueError):
+        return False
+    return registry_url in auths or f"https://{registry_url}" in auths
+
+
+def _ensure_ecr_login(region, spinner):
+    registry_url = get_ecr_registry_url(region)
+    tokens = load_user_cache(ECR_TOKEN_CACHE_FILE)
+    cached_token = tokens.get(get_ecr_token_key(registry_url))
+    if (
+        cached_token is not None
+        and cached_token["expires_at"] - ECR_TOKEN_EXPIRY_MARGIN > time.time()
+        and is_docker_logged_in(registry_url)
+    ):
+        return cached_token["password"]
+
+    authorization_data = get_client("ecr", region).get_authorization_token()["authorizationData"][0]
+    decoded_string = base64.b64decode(authorization_data["authorizationToken"]).decode("utf-8")
+    ecr_password = decoded_string.split(":")[1]
+    login_to_docker_registry("AWS", ecr_password, registry_url, spinner)
+
+    # Only cache the token once docker has accepted it, so a cache hit means we're logged in
+    tokens = {url: token for url, token in tokens.items() if token["expires_at"] > time.time()}
+    tokens[get_ecr_token_key(registry_url)] = {
+        "password": ecr_password,
+        "expires_at": authorization_data["expiresAt"].timestamp(),
+    }
+    save_user_cache(ECR_TOKEN_CACHE_FILE, tokens)
+    return ecr_password
+
+
+def forget_ecr_login(region):
+    with _ecr_login_lock:
+        tokens = load_user_cache(ECR_TOKEN_CACHE_FILE)
+        tokens.pop(get_ecr_token_key(get_ecr_registry_url(region)), None)
+        save_user_cache(ECR_TOKEN_CACHE_FILE, tokens)
+
+
+def run_ecr_command(command, regions, spinner, parser=None):
+    """Runs a docker command against the regions' ECR registries.
+
+    If the registry rejects docker's stored credential, e.g. because it was removed behind the token cache's
+    back, the cached tokens are dropped and the command runs once more after a fresh login.
+    """
+    for region in regions:
+        ensure_ecr_login(region, spinner)
+    try:
+        run_command_in_working_directory(command, spinner, raise_on_error=True, parser=parser)
+        return
+    except CommandFailedError as e:
+        if not any(error in e.output for error in ECR_AUTH_ERRORS):
+            spinner.fail("❌")
+            print_command_output(e.output)
+            exit(1)
+    for region in regions:
+        forget_ecr_login(region)
+        ensure_ecr_login(region, spinner)
+    run_command_in_working_directory(command, spinner, parser=parser)
 
 
 def ensure_ecr_repo_exists(config):
-    ecr_client = boto3.client("ecr", region_name=config["aws_region"])
+    ecr_client = get_client("ecr", config["aws_region"])
     project_name = config["project_name"]
     try:
         ecr_client.create_repository(repositoryName=project_name)
@@ -96,47 +256,165 @@ def ensure_ecr_repo_exists(config):
         exit(1)
 
 
-def push_docker_image(config):
+def get_build_cache_ref(config, spinner):
+    """Returns the image reference used as remote build cache, logging into ECR when it lives there"""
     from ailess.modules.terraform_utils import convert_to_alphanumeric
 
-    with yaspin(text="    pushing docker image") as spinner:
+    registry_url = get_ecr_registry_url(config["aws_region"])
+    cache_ref = config.get("build_cache_ref")
+    if cache_ref is None:
+        cache_ref = f"{registry_url}/{convert_to_alphanumeric(config['project_name'])}:buildcache"
+    if cache_ref.startswith(registry_url + "/"):
         ensure_ecr_repo_exists(config)
-        ecr_token = boto3.client("ecr", region_name=config["aws_region"]).get_authorization_token()[
-            "authorizationData"
-        ][0]["authorizationToken"]
-        decoded_string = base64.b64decode(ecr_token).decode("utf-8")
-        ecr_password = decoded_string.split(":")[1]
-        # Login to ECR
-        login_to_docker_registry(
-            "AWS",
-            ecr_password,
-            f"{get_aws_account_id()}.dkr.ecr.{config['aws_region']}.amazonaws.com",
-            spinner,
+        ensure_ecr_login(config["aws_region"], spinner)
+    return cache_ref
+
+
+def get_ecr_image_name(config):
+    from ailess.modules.terraform_utils import convert_to_alphanumeric
+
+    registry_url = get_ecr_registry_url(config["aws_region"])
+    return "{}/{}".format(registry_url, convert_to_alphanumeric(config["project_name"]))
+
+
+def get_ecr_latest_image(config):
+    """Returns the ECR image details of the :latest tag, or None if there is no such image yet"""
+    from ailess.modules.terraform_utils import convert_to_alphanumeric
+
+    ecr_client = get_client("ecr", config["aws_region"])
+    try:
+        response = ecr_client.describe_images(
+            repositoryName=convert_to_alphanumeric(config["project_name"]),
+            imageIds=[{"imageTag": "latest"}],
         )
+    except (ecr_client.exceptions.ImageNotFoundException, ecr_client.exceptions.RepositoryNotFoundException):
+        return None
+    return response["imageDetails"][0] if response["imageDetails"] else None
+
+
+def get_image_size_text(config, image_name=None):
+    """Compressed size in ECR, next to the local image's uncompressed size or, for images pushed while
+    building, how many of the layers in the pushed manifest are zstd"""
+    from ailess.modules.docker_utils import (
+        format_size,
+        inspect_local_image,
+        inspect_pushed_manifest,
+        get_layer_compression_summary,
+    )
+
+    ecr_image = get_ecr_latest_image(config)
+    if ecr_image is None:
+        return ""
+    annotate_span(bytes=ecr_image["imageSizeInBytes"])
+    size_text = f"{format_size(ecr_image['imageSizeInBytes'])} compressed"
+    if image_name is not None:
+        local_size = inspect_local_image(image_name, "{{.Size}}")
+        if local_size is not None:
+            size_text += f", {format_size(int(local_size))} uncompressed"
+        return size_text
+
+    # Manifests only record compressed layer sizes, the uncompressed size isn't known without a pull
+    manifest = inspect_pushed_manifest(
+        f"{get_ecr_image_name(config)}@{ecr_image['imageDigest']}", config["cpu_architecture"]
+    )
+    if manifest is not None:
+        _, zstd_layers, layers = get_layer_compression_summary(manifest)
+        size_text += f", {zstd_layers}/{layers} layers zstd"
+    return size_text
+
 
-        ecr_image_name = f"{get_aws_account_id()}.dkr.ecr.{config['aws_region']}.amazonaws.com/{convert_to_alphanumeric(config['project_name'])}"
+@traced("push image", "docker")
+def push_docker_image(config, build_config=None):
+    """Pushes the built image to the config's region, build_config is the config the image was built with"""
+    from ailess.modules.docker_utils import LAYER_COMPRESSION_ZSTD
+    from ailess.modules.terraform_utils import convert_to_alphanumeric
+
+    build_config = build_config or config
+    with progress_spinner("    pushing docker image") as spinner:
+        if config.get("layer_compression") == LAYER_COMPRESSION_ZSTD:
+            if build_config["aws_region"] != config["aws_region"]:
+                copy_ecr_image(build_config, config, spinner)
+            # Otherwise zstd layers were pushed straight from buildx while building
+            spinner.text = f"{spinner.text} ({get_image_size_text(config)})"
+            spinner.ok("✔")
+            return
+
+        ensure_ecr_repo_exists(config)
+        ecr_image_name = get_ecr_image_name(config)
 
         run_command_in_working_directory(
             f"docker tag {convert_to_alphanumeric(config['project_name'])} {ecr_image_name}", spinner
         )
-        run_command_in_working_directory(f"docker push {ecr_image_name}", spinner)
+        if is_image_pushed(config, ecr_image_name):
+            spinner.text = "    docker image is already in ECR"
+            spinner.ok("✔")
+            return
+
+        run_ecr_command(
+            f"docker push {ecr_image_name}",
+            [config["aws_region"]],
+            spinner,
+            parser=PushProgressParser(spinner),
+        )
+        spinner.text = f"{spinner.text} ({get_image_size_text(config, ecr_image_name)})"
         spinner.ok("✔")
 
 
+def copy_ecr_image(source_config, config, spinner):
+    """Copies :latest between regional ECR registries without pulling it, keeping its layer compression"""
+    ensure_ecr_repo_exists(config)
+    source_image = get_ecr_latest_image(source_config)
+    target_image = get_ecr_latest_image(config)
+    if target_image is not None and source_image is not None:
+        if target_image["imageDigest"] == source_image["imageDigest"]:
+            return
+    run_ecr_command(
+        f"docker buildx imagetools create --tag {get_ecr_image_name(config)}:latest "
+        f"{get_ecr_image_name(source_config)}:latest",
+        [source_config["aws_region"], config["aws_region"]],
+        spinner,
+    )
+
+
+def get_local_repo_digest(image_name):
+    completed_process = subprocess.run(
+        ["docker", "image", "inspect", "--format", "{{json .RepoDigests}}", image_name],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    if completed_process.returncode != 0:
+        return None
+    for repo_digest in json.loads(completed_process.stdout.decode("utf8")) or []:
+        repository, _, digest = repo_digest.partition("@")
+        if repository == image_name:
+            return digest
+    return None
+
+
+def is_image_pushed(config, ecr_image_name):
+    """Checks whether the :latest tag in ECR already points to the local image"""
+    local_digest = get_local_repo_digest(ecr_image_name)
+    if local_digest is None:
+        return False  # Docker only knows the registry digest of images it pushed or pulled
+
+    ecr_image = get_ecr_latest_image(config)
+    return ecr_image is not None and ecr_image["imageDigest"] == local_digest
+
+
 def ecs_deploy(config):
-    ecs_client = boto3.client("ecs", region_name=config["aws_region"])
+    ecs_client = get_client("ecs", config["aws_region"])
 
     cluster_name = f"{config['project_name']}-cluster"
     service_name = f"{config['project_name']}_cluster_service"
-    with yaspin(text="    deploying new code") as spinner:
+    with progress_spinner("    deploying new code") as spinner:
         ecs_client.update_service(cluster=cluster_name, service=service_name, forceNewDeployment=True)
         spinner.ok("✔")
 
 
-def print_endpoint_info(config):
+def get_endpoint_url(config):
     from ailess.modules.terraform_utils import convert_to_alphanumeric
 
-    elbv2_client = boto3.client("elbv2", region_name=config["aws_region"])
+    elbv2_client = get_client("elbv2", config["aws_region"])
     alb_name = f"{convert_to_alphanumeric(config['project_name'])}-lb"
 
     # Describe the load balancers with the given name
@@ -144,41 +422,8 @@ def print_endpoint_info(config):
 
     # Extract the public DNS name from the response
     alb_dns_name = response["LoadBalancers"][0]["DNSName"]
-    print(f"🌐    endpoint: http://{alb_dns_name}")
-
-
-def get_latest_deployment(cluster_name, service_name, region):
-    ecs_client = boto3.client("ecs", region_name=region)
+    return f"http://{alb_dns_name}"
 
-    response = ecs_client.describe_services(cluster=cluster_name, services=[service_name])
-    services = response["services"]
 
-    if services:
-        service = services[0]
-        deployments = service.get("deployments", [])
-        if deployments:
-            latest_deployment = max(deployments, key=lambda d: d["createdAt"])
-            return latest_deployment
-
-    return None
-
-
-def wait_for_deployment(config):
-    cluster_name = f"{config['project_name']}-cluster"
-    service_name = f"{config['project_name']}_cluster_service"
-    with yaspin(text="    waiting for deployment") as spinner:
-        latest_deployment = get_latest_deployment(cluster_name, service_name, config["aws_region"])
-        if latest_deployment:
-            while latest_deployment["rolloutState"] != "COMPLETED":
-                time.sleep(5)
-                latest_deployment = get_latest_deployment(cluster_name, service_name, config["aws_region"])
-                if latest_deployment["rolloutState"] == "FAILED":
-                    spinner.fail("❌")
-                    print(f"Deployment failed {latest_deployment['rolloutStateReason']}, more details here:")
-                    print(
-                        f"https://console.aws.amazon.com/ecs/home?region={config['aws_region']}#/clusters/{cluster_name}/services/{service_name}/events"
-                    )
-                    exit(1)
-            spinner.ok("✔")
-        else:
-            spinner.fail("❌")
+def print_endpoint_info(config):
+    print(f"🌐    endpoint: {get_endpoint_url(config)}")
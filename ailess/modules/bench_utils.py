@@ -0,0 +1,266 @@
+import asyncio
+import json
+import math
+import mimetypes
+import os
+import ssl
+import time
+from urllib.parse import urlparse
+
+BENCH_TIMEOUT = 60
+MAX_CONNECTIONS = 256
+PERCENTILES = [50, 90, 99]
+
+
+class BenchConnection:
+    """Minimal keep-alive HTTP/1.1 client connection, enough for request/response load testing"""
+
+    def __init__(self, url, method):
+        self.url = url
+        self.method = method
+        self.reader = None
+        self.writer = None
+
+    async def open(self):
+        port = self.url.port or (443 if self.url.scheme == "https" else 80)
+        ssl_context = ssl.create_default_context() if self.url.scheme == "https" else None
+        self.reader, self.writer = await asyncio.open_connection(self.url.hostname, port, ssl=ssl_context)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def request(self, request_bytes):
+        """Sends a prepared request and returns the status, reading the body to keep the connection usable"""
+        if self.writer is None:
+            await self.open()
+        self.writer.write(request_bytes)
+        await self.writer.drain()
+
+        http_version, status, headers = await self.read_head()
+        while 100 <= status < 200:  # Interim responses like 100 Continue precede the real one
+            http_version, status, headers = await self.read_head()
+
+        connection_header = headers.get("connection", "").lower()
+        keep_alive = connection_header == "keep-alive" or (
+            http_version != b"HTTP/1.0" and connection_header != "close"
+        )
+        if self.method == "HEAD" or status in (204, 304):
+            pass  # These responses never have a body, whatever their headers say
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        elif "content-length" in headers:
+            await self.reader.readexactly(int(headers["content-length"]))
+        elif not keep_alive:
+            await self.reader.read()  # The body ends with the connection
+        if not keep_alive:
+            self.close()
+        return status
+
+    async def read_head(self):
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed by the server")
+        http_version, status = status_line.split(b" ", 2)[:2]
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return http_version, int(status), headers
+
+
+def build_request(url, method, body, headers):
+    path = url.path or "/"
+    if url.query:
+        path += "?" + url.query
+    lines = [f"{method} {path} HTTP/1.1", f"Host: {url.netloc}", "Connection: keep-alive"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    if body is not None:
+        lines.append(f"Content-Length: {len(body)}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b"")
+
+
+class BenchRecorder:
+    def __init__(self):
+        self.latencies = []
+        self.status_counts = {}
+        self.errors = {}
+
+    def record(self, latency, status=None, error=None):
+        if error is not None:
+            name = type(error).__name__
+            self.errors[name] = self.errors.get(name, 0) + 1
+            return
+        self.latencies.append(latency)
+        self.status_counts[str(status)] = self.status_counts.get(str(status), 0) + 1
+
+
+async def send_request(pool, request_bytes, recorder, started_at):
+    connection = await pool.get()
+    try:
+        status = await asyncio.wait_for(connection.request(request_bytes), BENCH_TIMEOUT)
+        recorder.record(time.perf_counter() - started_at, status=status)
+    except (OSError, ValueError, IndexError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+        connection.close()  # Reconnect on the next request
+        recorder.record(time.perf_counter() - started_at, error=e)
+    finally:
+        pool.put_nowait(connection)
+
+
+async def run_fixed_concurrency(url, method, request_bytes, recorder, concurrency, duration, requests):
+    pool = asyncio.Queue()
+    for _ in range(concurrency):
+        pool.put_nowait(BenchConnection(url, method))
+    deadline = time.perf_counter() + duration if duration else None
+    remaining = [requests]
+
+    async def worker():
+        while (deadline is None or time.perf_counter() < deadline) and (requests is None or remaining[0] > 0):
+            if requests is not None:
+                remaining[0] -= 1
+            await send_request(pool, request_bytes, recorder, time.perf_counter())
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    close_pool(pool)
+
+
+async def run_fixed_rate(url, method, request_bytes, recorder, rate, duration, requests):
+    """Open-loop load: request i is due at i / rate, and its latency counts from then.
+
+    A slow server doesn't slow the arrivals down, waiting for a free connection shows up as latency.
+    """
+    pool = asyncio.Queue()
+    for _ in range(min(MAX_CONNECTIONS, max(int(rate), 1))):
+        pool.put_nowait(BenchConnection(url, method))
+    total = requests if requests is not None else math.ceil(rate * duration)
+    started_at = time.perf_counter()
+    tasks = []
+    for i in range(total):
+        due_at = started_at + i / rate
+        delay = due_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(send_request(pool, request_bytes, recorder, due_at)))
+    await asyncio.gather(*tasks)
+    close_pool(pool)
+
+
+def close_pool(pool):
+    while not pool.empty():
+        pool.get_nowait().close()
+
+
+def get_percentile(sorted_values, percentile):
+    if not sorted_values:
+        return None
+    index = max(math.ceil(percentile / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[index]
+
+
+def summarize(recorder, elapsed):
+    latencies = sorted(recorder.latencies)
+    summary = {
+        "requests": len(latencies) + sum(recorder.errors.values()),
+        "responses": len(latencies),
+        "errors": recorder.errors,
+        "status_codes": recorder.status_counts,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0,
+        "latency_ms": {},
+    }
+    if latencies:
+        for percentile in PERCENTILES:
+            summary["latency_ms"][f"p{percentile}"] = round(get_percentile(latencies, percentile) * 1000, 2)
+        summary["latency_ms"]["max"] = round(latencies[-1] * 1000, 2)
+        summary["latency_ms"]["mean"] = round(sum(latencies) / len(latencies) * 1000, 2)
+    return summary
+
+
+def load_payload(payload_path, content_type):
+    if payload_path is None:
+        return None, content_type
+    with open(payload_path, "rb") as f:
+        body = f.read()
+    if content_type is None:
+        content_type = mimetypes.guess_type(payload_path)[0] or "application/octet-stream"
+    return body, content_type
+
+
+def run_bench(
+    base_url,
+    path="/",
+    method=None,
+    payload_path=None,
+    content_type=None,
+    headers=None,
+    concurrency=None,
+    rate=None,
+    duration=None,
+    requests=None,
+):
+    """Load tests base_url + path and returns the run's settings and results"""
+    body, content_type = load_payload(payload_path, content_type)
+    method = method or ("POST" if body is not None else "GET")
+    request_headers = dict(headers or {})
+    if content_type is not None and body is not None:
+        request_headers["Content-Type"] = content_type
+    url = urlparse(base_url.rstrip("/") + "/" + path.lstrip("/"))
+    request_bytes = build_request(url, method, body, request_headers)
+    if duration is None and requests is None:
+        duration = 30
+    if rate is None and concurrency is None:
+        concurrency = 8
+
+    recorder = BenchRecorder()
+    timestamp = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    started_at = time.perf_counter()
+    if rate is not None:
+        coroutine = run_fixed_rate(url, method, request_bytes, recorder, rate, duration, requests)
+    else:
+        coroutine = run_fixed_concurrency(
+            url, method, request_bytes, recorder, concurrency, duration, requests
+        )
+    asyncio.run(coroutine)
+    elapsed = time.perf_counter() - started_at
+
+    return {
+        "url": url.geturl(),
+        "method": method,
+        "payload": os.path.basename(payload_path) if payload_path else None,
+        "mode": "rate" if rate is not None else "concurrency",
+        "rate": rate,
+        "concurrency": concurrency,
+        "started_at": timestamp,
+        "results": summarize(recorder, elapsed),
+    }
+
+
+def print_bench_results(bench):
+    results = bench["results"]
+    load = f"{bench['rate']} req/s" if bench["mode"] == "rate" else f"{bench['concurrency']} concurrent"
+    print(f"📈    {bench['method']} {bench['url']} ({load})")
+    print(
+        f"       {results['responses']} responses in {results['duration_s']}s, "
+        f"{results['throughput_rps']} req/s"
+    )
+    if results["latency_ms"]:
+        latencies = ", ".join(f"{name} {value}ms" for name, value in results["latency_ms"].items())
+        print(f"       latency {latencies}")
+    if results["status_codes"]:
+        status_codes = ", ".join(f"{code}: {count}" for code, count in results["status_codes"].items())
+        print(f"       status codes {status_codes}")
+    if results["errors"]:
+        print("❌    errors " + ", ".join(f"{name}: {count}" for name, count in results["errors"].items()))
+
+
+def save_bench_results(bench, output_path):
+    with open(output_path, "w") as f:
+        json.dump(bench, f, indent=4)
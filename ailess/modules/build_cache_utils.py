@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+
+from ailess.modules.config_utils import ensure_workdir_exists
+from ailess.modules.docker_utils import iter_build_context_files
+
+BUILD_CACHE_PATH = ".ailess/build_cache.json"
+# Config keys that change the built image without changing any file in the build context
+FINGERPRINT_CONFIG_KEYS = ["project_name", "cpu_architecture"]
+
+
+def load_build_cache():
+    if not os.path.exists(BUILD_CACHE_PATH):
+        return {}
+    try:
+        with open(BUILD_CACHE_PATH, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_build_cache(cache):
+    ensure_workdir_exists()
+    with open(BUILD_CACHE_PATH, "w") as f:
+        json.dump(cache, f)
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_build_fingerprint(config):
+    """Hashes everything that ends up in the image: the build context, the Dockerfile and the build config"""
+    cache = load_build_cache()
+    known_files = cache.get("files", {})
+    files = {}
+
+    digest = hashlib.sha256()
+    for key in FINGERPRINT_CONFIG_KEYS:
+        digest.update(f"{key}={config.get(key)}\n".encode("utf8"))
+
+    paths = set(iter_build_context_files())
+    paths.update(path for path in ["Dockerfile", ".dockerignore"] if os.path.exists(path))
+    for path in sorted(paths):
+        stat = os.lstat(path)
+        known_file = known_files.get(path)
+        # Files are only re-hashed when their size or mtime changed since the last build
+        if known_file is not None and known_file[0] == stat.st_size and known_file[1] == stat.st_mtime_ns:
+            file_hash = known_file[2]
+        elif os.path.islink(path):
+            file_hash = hashlib.sha256(os.readlink(path).encode("utf8")).hexdigest()
+        else:
+            file_hash = hash_file(path)
+        files[path] = [stat.st_size, stat.st_mtime_ns, file_hash]
+        digest.update(f"{path}\0{stat.st_mode & 0o111}\0{file_hash}\n".encode("utf8"))
+
+    cache["files"] = files
+    save_build_cache(cache)
+    return digest.hexdigest()
+
+
+def get_build_context_size():
+    """Returns (total size, file count) of the context hashed by the last get_build_fingerprint call"""
+    files = load_build_cache().get("files", {})
+    return sum(known_file[0] for known_file in files.values()), len(files)
+
+
+def get_cached_image_id(fingerprint):
+    cache = load_build_cache()
+    if cache.get("fingerprint") != fingerprint:
+        return None
+    return cache.get("image_id")
+
+
+def save_built_image_id(fingerprint, image_id):
+    cache = load_build_cache()
+    cache["fingerprint"] = fingerprint
+    cache["image_id"] = image_id
+    save_build_cache(cache)
+
+
+def get_cached_pushed_digest(fingerprint):
+    cache = load_build_cache()
+    if cache.get("pushed_fingerprint") != fingerprint:
+        return None
+    return cache.get("pushed_digest")
+
+
+def save_pushed_digest(fingerprint, digest):
+    """Images built straight into the registry are never loaded locally, so their digest is cached instead"""
+    cache = load_build_cache()
+    cache["pushed_fingerprint"] = fingerprint
+    cache["pushed_digest"] = digest
+    save_build_cache(cache)
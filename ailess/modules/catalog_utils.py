@@ -0,0 +1,67 @@
+import functools
+import json
+import os
+import time
+
+from ailess.modules.config_utils import load_user_cache, save_user_cache
+
+CATALOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog")
+CATALOG_CACHE_FILE = "aws_catalog.json"
+# Instance types and regions hardly ever change, a month old entry is still good
+CATALOG_CACHE_TTL = 30 * 24 * 60 * 60
+
+
+def load_bundled_catalog(name):
+    with open(os.path.join(CATALOG_DIR, name), "r") as f:
+        return json.load(f)
+
+
+def is_fresh(entry):
+    return entry is not None and time.time() - entry.get("fetched_at", 0) < CATALOG_CACHE_TTL
+
+
+def instance_type_to_catalog_entry(instance_type):
+    """Converts a describe_instance_types entry to the catalog's format"""
+    gpus = instance_type.get("GpuInfo", {}).get("Gpus", [])
+    architectures = instance_type["ProcessorInfo"]["SupportedArchitectures"]
+    return {
+        "vcpus": instance_type["VCpuInfo"]["DefaultVCpus"],
+        "memory_size": instance_type["MemoryInfo"]["SizeInMiB"],
+        # Every entry is one GPU model, with Count GPUs of it
+        "num_gpus": sum(gpu.get("Count", 1) for gpu in gpus),
+        "gpu_manufacturer": gpus[0].get("Manufacturer") if gpus else None,
+        "cpu_architecture": "arm64" if "arm64" in architectures else "x86_64",
+    }
+
+
+def get_cached_regions():
+    """Regions from the on-disk cache, or the ones bundled with ailess"""
+    cached_regions = load_user_cache(CATALOG_CACHE_FILE).get("regions")
+    if is_fresh(cached_regions):
+        return cached_regions["items"]
+    return load_bundled_catalog("regions.json")
+
+
+@functools.lru_cache(maxsize=None)
+def get_cached_instance_type(instance_type):
+    """Instance type from the on-disk cache or the bundled catalog, None if neither has it"""
+    cached_entry = load_user_cache(CATALOG_CACHE_FILE).get("instance_types", {}).get(instance_type)
+    if is_fresh(cached_entry):
+        return cached_entry
+    return load_bundled_catalog("instance_types.json").get(instance_type)
+
+
+def save_instance_types(entries):
+    cache = load_user_cache(CATALOG_CACHE_FILE)
+    instance_types = cache.setdefault("instance_types", {})
+    fetched_at = time.time()
+    for instance_type, entry in entries.items():
+        instance_types[instance_type] = dict(entry, fetched_at=fetched_at)
+    save_user_cache(CATALOG_CACHE_FILE, cache)
+    get_cached_instance_type.cache_clear()
+
+
+def save_regions(regions):
+    cache = load_user_cache(CATALOG_CACHE_FILE)
+    cache["regions"] = {"items": regions, "fetched_at": time.time()}
+    save_user_cache(CATALOG_CACHE_FILE, cache)
@@ -1,13 +1,43 @@
 import os
+import signal
 import subprocess
 import sys
+import threading
+import time
+from collections import deque
 
-import inquirer
+from yaspin import yaspin
+
+from ailess.modules.trace_utils import annotate_span
+
+# When several stages run at once, animated spinners would overwrite each other's
+# line, so progress is reported as plain lines instead
+_line_progress = False
+_output_lock = threading.Lock()
+_output_context = threading.local()
+_running_processes = set()
+_cancelled = threading.Event()
+
+# Only the end of a command's output is kept around to show when it fails
+OUTPUT_TAIL_LINES = 200
+MAX_LINE_LENGTH = 64 * 1024
+# In line mode a progress update is printed at most this often per stage
+LINE_PROGRESS_INTERVAL = 5
 
 
 def config_prompt():
+    import inquirer
+
     from .aws_utils import get_regions, get_predefined_instances
     from ailess.modules.aws_utils import get_instance_type_info
+    from ailess.modules.deployment_utils import ROLLOUT_PROFILE_FAST, ROLLOUT_PROFILE_SAFE
+    from ailess.modules.docker_utils import DOCKERFILE_MODE_MULTISTAGE
+    from ailess.modules.packing_utils import (
+        get_default_tasks_per_instance,
+        SCALING_METRIC_NONE,
+        SCALING_METRIC_REQUESTS,
+        SCALING_METRIC_CPU,
+    )
 
     print("Welcome to the Ailess CLI!")
     current_folder = os.path.basename(os.getcwd())
@@ -16,7 +46,7 @@ def config_prompt():
         inquirer.List(
             "aws_region",
             message="Choose an AWS region to deploy to",
-            choices=get_regions(),
+            choices=get_regions() + ["other (custom input)"],
         ),
         inquirer.Text("host_port", message="What port is your app running on?", default=5000),
         inquirer.Text(
@@ -30,6 +60,22 @@ def config_prompt():
     ]
     answers = inquirer.prompt(questions)
 
+    if answers["aws_region"] == "other (custom input)":
+        custom_region_answers = inquirer.prompt(
+            [inquirer.Text("aws_region", message="Input AWS region (e.g. me-south-1)")]
+        )
+        answers["aws_region"] = custom_region_answers["aws_region"]
+    extra_region_answers = inquirer.prompt(
+        [
+            inquirer.Checkbox(
+                "aws_regions",
+                message="Deploy to more regions as well? (space to select, enter to skip)",
+                choices=[region for region in get_regions() if region != answers["aws_region"]],
+            )
+        ]
+    )
+    if extra_region_answers["aws_regions"]:
+        answers["aws_regions"] = [answers["aws_region"]] + extra_region_answers["aws_regions"]
     if answers["ec2_instance_type"] == "other (custom input)":
         custom_instance_answers = inquirer.prompt(
             [inquirer.Text("ec2_instance_type", message="Input EC2 instance type (e.g. t2.micro)")]
@@ -50,36 +96,276 @@ def config_prompt():
 
     answers["entrypoint_path"] = entrypoint_answers["entrypoint_path"]
 
+    rollout_answers = inquirer.prompt(
+        [
+            inquirer.Text(
+                "health_check_path", message="What path should the load balancer health check?", default="/"
+            ),
+            inquirer.List(
+                "rollout_profile",
+                message="Choose a rollout profile",
+                choices=[
+                    ("safe (more time for slow-starting apps and long requests)", ROLLOUT_PROFILE_SAFE),
+                    ("fast (quicker health checks and draining, no scale-out)", ROLLOUT_PROFILE_FAST),
+                ],
+            ),
+        ]
+    )
+    answers["health_check_path"] = rollout_answers["health_check_path"]
+    answers["rollout_profile"] = rollout_answers["rollout_profile"]
+
     instance_data = get_instance_type_info(answers["ec2_instance_type"], answers["aws_region"])
     answers["cpu_architecture"] = instance_data["cpu_architecture"]
     answers["has_gpu"] = instance_data["num_gpus"] > 0
     answers["gpu_manufacturer"] = instance_data["gpu_manufacturer"]
+    answers["dockerfile_mode"] = DOCKERFILE_MODE_MULTISTAGE
+
+    tasks_answers = inquirer.prompt(
+        [
+            inquirer.Text(
+                "tasks_per_instance",
+                message="How many copies of your app do you want to run on each server?",
+                default=get_default_tasks_per_instance(instance_data),
+            ),
+        ]
+    )
+    answers["tasks_per_instance"] = int(tasks_answers["tasks_per_instance"])
+
+    desired_count = int(answers["instances_count"]) * answers["tasks_per_instance"]
+    scaling_answers = inquirer.prompt(
+        [
+            inquirer.List(
+                "scaling_metric",
+                message="Scale the number of tasks with load?",
+                choices=[
+                    ("no", SCALING_METRIC_NONE),
+                    ("yes, by requests per task", SCALING_METRIC_REQUESTS),
+                    ("yes, by CPU utilization", SCALING_METRIC_CPU),
+                ],
+            ),
+            inquirer.Text(
+                "max_tasks",
+                message="What is the maximum number of tasks?",
+                default=desired_count * 2,
+                ignore=lambda scaling_answers: scaling_answers["scaling_metric"] == SCALING_METRIC_NONE,
+            ),
+            inquirer.Confirm(
+                "warm_pool",
+                message="Keep stopped servers with your image pulled for faster scale-out?",
+                default=answers["has_gpu"],
+                ignore=lambda scaling_answers: scaling_answers["scaling_metric"] == SCALING_METRIC_NONE,
+            ),
+        ]
+    )
+    answers["scaling_metric"] = scaling_answers["scaling_metric"]
+    if answers["scaling_metric"] != SCALING_METRIC_NONE:
+        answers["min_tasks"] = desired_count
+        answers["max_tasks"] = int(scaling_answers["max_tasks"])
+        answers["warm_pool_size"] = scaling_answers["warm_pool"]
 
     return answers
 
 
-def run_command_in_working_directory(command, spinner, cwd=os.getcwd(), join_stdout_stderr=False):
+class LineProgress:
+    """Spinner stand-in that reports progress as separate lines, safe to use from several threads"""
+
+    def __init__(self, text):
+        self._text = text
+        self._started_at = None
+        self._last_update_at = 0
+
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        if text == self._text:
+            return
+        self._text = text
+        if self._started_at is not None and time.monotonic() - self._last_update_at >= LINE_PROGRESS_INTERVAL:
+            self._last_update_at = time.monotonic()
+            print_line(f"…{text}")
+
+    def __enter__(self):
+        self._started_at = time.monotonic()
+        self._last_update_at = self._started_at
+        print_line(f"…{self._text}")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def _finish(self, symbol):
+        print_line(f"{symbol}{self._text} ({time.monotonic() - self._started_at:.1f}s)")
+
+    def ok(self, text="✔"):
+        self._finish(text)
+
+    def fail(self, text="❌"):
+        self._finish(text)
+
+    def write(self, text):
+        print_line(text)
+
+
+def print_line(text):
+    prefix = getattr(_output_context, "prefix", None)
+    if prefix is not None:
+        text = f"[{prefix}] {text}"
+    with _output_lock:
+        print(text, flush=True)
+
+
+def set_output_prefix(prefix):
+    """Prefixes every line the current thread prints through print_line"""
+    _output_context.prefix = prefix
+
+
+def set_line_progress(enabled):
+    global _line_progress
+    _line_progress = enabled
+
+
+def progress_spinner(text):
+    if _line_progress:
+        return LineProgress(text)
+    return yaspin(text=text)
+
+
+class CommandFailedError(Exception):
+    def __init__(self, command, returncode, output):
+        super().__init__(f"{command} exited with code {returncode}")
+        self.command = command
+        self.returncode = returncode
+        self.output = output
+
+
+def print_command_output(output):
+    with _output_lock:
+        sys.stdout.buffer.write(output)
+        sys.stdout.flush()
+
+
+class OutputParser:
+    """Receives a command's output line by line while it runs.
+
+    handle_line returns what should be kept for the failure log, or None to drop the line.
+    """
+
+    def __init__(self, spinner=None):
+        self.spinner = spinner
+        self.base_text = spinner.text if spinner is not None else ""
+
+    def set_progress(self, progress):
+        if self.spinner is not None:
+            self.spinner.text = f"{self.base_text} ({progress})"
+
+    def handle_line(self, line, stream):
+        return line
+
+    def finish(self):
+        if self.spinner is not None:
+            self.spinner.text = self.base_text
+
+
+def cancel_running_commands():
+    """Stops every command started by run_command_in_working_directory and makes them exit quietly"""
+    _cancelled.set()
+    for process in list(_running_processes):
+        _stop_process(process)
+
+
+def _stop_process(process):
+    if process.poll() is None:
+        if os.name == "posix" and _line_progress:
+            # Commands run through a shell, signal the whole group so the actual tool stops too
+            os.killpg(process.pid, signal.SIGTERM)
+        else:
+            process.terminate()
+
+
+def _start_process(command, **kwargs):
+    process = subprocess.Popen(command, shell=True, start_new_session=_line_progress, **kwargs)
+    _running_processes.add(process)
+    if _cancelled.is_set():
+        # Cancelled while starting, after cancel_running_commands went through the running processes
+        _stop_process(process)
+    return process
+
+
+def _read_stream(pipe, stream, parser, tail, tail_lock):
+    for raw_line in iter(lambda: pipe.readline(MAX_LINE_LENGTH), b""):
+        line = raw_line.decode("utf8", errors="replace").rstrip("\r\n")
+        try:
+            log_line = parser.handle_line(line, stream)
+        except Exception:
+            log_line = line  # A parser bug must not break the command itself
+        if log_line is not None:
+            with tail_lock:
+                tail.append(log_line)
+    pipe.close()
+
+
+def run_command_in_working_directory(
+    command, spinner, cwd=os.getcwd(), join_stdout_stderr=False, env=None, raise_on_error=False, parser=None
+):
+    """Runs a shell command, streaming its output through parser and exiting with its tail on failure"""
     try:
+        if _cancelled.is_set():
+            exit(1)
         if join_stdout_stderr:
-            completed_process = subprocess.run(
-                command, shell=True, stdout=sys.stdout, stderr=subprocess.STDOUT, cwd=cwd
-            )
+            process = _start_process(command, stdout=sys.stdout, stderr=subprocess.STDOUT, cwd=cwd, env=env)
+            try:
+                process.wait()
+            finally:
+                _running_processes.discard(process)
+            tail = deque()
         else:
-            completed_process = subprocess.run(
-                command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd
+            if parser is None:
+                parser = OutputParser()
+            process = _start_process(
+                command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, env=env
             )
+            tail = deque(maxlen=OUTPUT_TAIL_LINES)
+            tail_lock = threading.Lock()
+            readers = [
+                threading.Thread(
+                    target=_read_stream, args=(process.stdout, "stdout", parser, tail, tail_lock), daemon=True
+                ),
+                threading.Thread(
+                    target=_read_stream, args=(process.stderr, "stderr", parser, tail, tail_lock), daemon=True
+                ),
+            ]
+            try:
+                for reader in readers:
+                    reader.start()
+                for reader in readers:
+                    reader.join()
+                process.wait()
+            finally:
+                _running_processes.discard(process)
+                parser.finish()
 
+        annotate_span(exit_code=process.returncode)
         # Check if the command was successful
-        if completed_process.returncode == 0:
-            return completed_process.stdout  # Command executed successfully, no need to display output
+        if process.returncode == 0:
+            return  # Command executed successfully, no need to display output
 
+        output = "".join(line + "\n" for line in tail).encode("utf8")
+        if _cancelled.is_set():
+            # Another stage failed and stopped us, its output is the one that matters
+            exit(1)
+        if raise_on_error:
+            raise CommandFailedError(command, process.returncode, output)
         if spinner is not None:
             spinner.fail("❌")
-        # Command failed, print stdout and stderr
-        sys.stdout.buffer.write(completed_process.stdout)  # Print stdout
-        sys.stdout.buffer.write(completed_process.stderr)  # Print stderr
+        # Command failed, print the end of its output
+        print_command_output(output)
         exit(1)
 
+    except CommandFailedError:
+        raise
     except Exception as e:
         if spinner is not None:
             spinner.fail("❌")
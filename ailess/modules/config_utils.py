@@ -2,6 +2,33 @@ import json
 import os
 
 
+def get_user_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    cache_dir = os.path.join(cache_home, "ailess")
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def load_user_cache(name):
+    path = os.path.join(get_user_cache_dir(), name)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_user_cache(name, data):
+    path = os.path.join(get_user_cache_dir(), name)
+    # Cache files may hold short-lived credentials, keep them private to the user
+    fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+
 def ensure_workdir_exists():
     if not os.path.exists(".ailess"):
         os.mkdir(".ailess")
@@ -13,6 +40,17 @@ def save_config(config):
         json.dump(config, f, indent=4)
 
 
+def get_deploy_regions(config):
+    """Every region to deploy to, the primary aws_region first"""
+    primary_region = config["aws_region"]
+    return [primary_region] + [region for region in config.get("aws_regions", []) if region != primary_region]
+
+
+def get_region_config(config, region):
+    """The config as a single-region deploy to region would see it"""
+    return dict(config, aws_region=region)
+
+
 def load_config():
     if not os.path.exists(".ailess/config.json"):
         print('No .ailess/config.json file found. Please run "ailess init" first.')
@@ -0,0 +1,144 @@
+import os
+import re
+
+from ailess.modules.docker_utils import (
+    iter_build_context_files,
+    format_size,
+)
+
+VCS_DIRS = [".git", ".hg", ".svn"]
+CACHE_DIRS = [
+    "__pycache__",
+    ".pytest_cache",
+    ".mypy_cache",
+    ".ruff_cache",
+    ".ipynb_checkpoints",
+    ".tox",
+    ".nox",
+    "node_modules",
+]
+# Files this big are worth leaving out of the image unless the code mentions them
+LARGE_FILE_SIZE = 10 * 1024 * 1024
+SOURCE_FILE_EXTENSIONS = (".py", ".json", ".yaml", ".yml", ".toml", ".cfg", ".ini", ".txt", ".sh")
+
+
+def get_context_files(root="."):
+    """Returns (relative path, size) of every file in the build context"""
+    files = []
+    for relative_path in iter_build_context_files(root):
+        files.append((relative_path, os.lstat(os.path.join(root, relative_path)).st_size))
+    return files
+
+
+def get_biggest_contributors(files, top):
+    """Sums file sizes per top-level entry, since a single directory is usually to blame"""
+    sizes = {}
+    counts = {}
+    for relative_path, size in files:
+        entry = relative_path.split("/")[0] + ("/" if "/" in relative_path else "")
+        sizes[entry] = sizes.get(entry, 0) + size
+        counts[entry] = counts.get(entry, 0) + 1
+    entries = sorted(sizes, key=lambda entry: sizes[entry], reverse=True)[:top]
+    return [(entry, sizes[entry], counts[entry]) for entry in entries]
+
+
+def get_referenced_names(root, files):
+    """Collects every quoted string in the project's source and config files"""
+    referenced_names = set()
+    for relative_path, size in files:
+        if not relative_path.endswith(SOURCE_FILE_EXTENSIONS) or size > LARGE_FILE_SIZE:
+            continue
+        try:
+            with open(os.path.join(root, relative_path), "r", errors="ignore") as f:
+                contents = f.read()
+        except OSError:
+            continue
+        for literal in re.findall(r"[\"']([^\"'\n]+)[\"']", contents):
+            referenced_names.add(literal)
+            referenced_names.add(os.path.basename(literal))
+    return referenced_names
+
+
+def is_referenced(relative_path, referenced_names):
+    if relative_path in referenced_names or os.path.basename(relative_path) in referenced_names:
+        return True
+    # The code may load the whole directory the file is in
+    parts = relative_path.split("/")[:-1]
+    return any("/".join(parts[: i + 1]) in referenced_names for i in range(len(parts)))
+
+
+def get_ignore_suggestions(root, files):
+    """Returns (rule, reason, size) for context entries that almost certainly don't belong in the image"""
+    from ailess.modules.python_utils import is_virtualenv
+
+    suggestions = {}
+    excluded_dirs = []
+    for dirpath, dirnames, _ in os.walk(root):
+        relative_dir = os.path.relpath(dirpath, root).replace(os.sep, "/")
+        relative_dir = "" if relative_dir == "." else relative_dir + "/"
+        for dirname in list(dirnames):
+            if dirname in VCS_DIRS:
+                rule, reason = relative_dir + dirname, "version control"
+            elif dirname in CACHE_DIRS:
+                rule, reason = f"**/{dirname}", "cache"
+            elif is_virtualenv(os.path.join(dirpath, dirname)):
+                rule, reason = relative_dir + dirname, "virtualenv"
+            else:
+                continue
+            dirnames.remove(dirname)
+            excluded_dirs.append(relative_dir + dirname + "/")
+            suggestions.setdefault(rule, [reason, 0])
+
+    referenced_names = get_referenced_names(root, files)
+    for relative_path, size in files:
+        excluded_dir = next((d for d in excluded_dirs if relative_path.startswith(d)), None)
+        if excluded_dir is not None:
+            name = excluded_dir.rstrip("/")
+            rule = f"**/{os.path.basename(name)}" if os.path.basename(name) in CACHE_DIRS else name
+            suggestions[rule][1] += size
+        elif (
+            size >= LARGE_FILE_SIZE
+            and not relative_path.endswith(SOURCE_FILE_EXTENSIONS)
+            and not is_referenced(relative_path, referenced_names)
+        ):
+            suggestions[relative_path] = ["large file not referenced by the code", size]
+
+    # Rules for directories already left out by .dockerignore have nothing to save
+    suggestions = [(rule, reason, size) for rule, (reason, size) in suggestions.items() if size > 0]
+    return sorted(suggestions, key=lambda suggestion: suggestion[2], reverse=True)
+
+
+def apply_ignore_suggestions(suggestions, path=".dockerignore"):
+    content = ""
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            content = f.read()
+    if content and not content.endswith("\n"):
+        content += "\n"
+    content += "# Added by ailess context\n"
+    content += "".join(rule + "\n" for rule, _, _ in suggestions)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def print_context_report(root=".", top=10, apply=False):
+    files = get_context_files(root)
+    total_size = sum(size for _, size in files)
+    print(f"📦    build context: {format_size(total_size)} in {len(files)} files")
+    for entry, size, count in get_biggest_contributors(files, top):
+        print(f"       {format_size(size):>10}  {count:>7} files  {entry}")
+
+    suggestions = get_ignore_suggestions(root, files)
+    if not suggestions:
+        print("✔    no .dockerignore suggestions")
+        return
+
+    saved_size = sum(size for _, _, size in suggestions)
+    print(f"💡    suggested .dockerignore rules (save {format_size(saved_size)}):")
+    for rule, reason, size in suggestions:
+        print(f"       {format_size(size):>10}  {rule}  ({reason})")
+    if apply:
+        apply_ignore_suggestions(suggestions, os.path.join(root, ".dockerignore"))
+        print("✔    .dockerignore updated")
+    else:
+        print("       run `ailess context --apply` to add them to .dockerignore")
@@ -0,0 +1,273 @@
+import time
+
+from ailess.modules.aws_utils import get_client
+from ailess.modules.cli_utils import progress_spinner, print_line
+from ailess.modules.trace_utils import traced
+
+MIN_POLL_INTERVAL = 2
+MAX_POLL_INTERVAL = 15
+POLL_BACKOFF = 1.5
+
+ROLLOUT_PROFILE_FAST = "fast"
+ROLLOUT_PROFILE_SAFE = "safe"
+# Target group, health check and ECS deployment settings rendered into cluster.tfvars.
+# "fast" drains old tasks quickly and replaces half of the tasks at a time instead of scaling out first,
+# "safe" gives slow-starting apps and long requests more time, and is exactly what deploys did before profiles.
+ROLLOUT_PROFILES = {
+    ROLLOUT_PROFILE_FAST: {
+        "deregistration_delay": 15,
+        "slow_start": 0,
+        "health_check_interval": 5,
+        "health_check_timeout": 4,
+        "healthy_threshold": 2,
+        "unhealthy_threshold": 3,
+        "service_health_check_grace_period": 30,
+        "asg_health_check_grace_period": 60,
+        "deployment_minimum_healthy_percent": 50,
+    },
+    ROLLOUT_PROFILE_SAFE: {
+        "deregistration_delay": 300,
+        "slow_start": 0,
+        "health_check_interval": 10,
+        "health_check_timeout": 5,
+        "healthy_threshold": 2,
+        "unhealthy_threshold": 5,
+        "service_health_check_grace_period": 0,
+        "asg_health_check_grace_period": 300,
+        "deployment_minimum_healthy_percent": 100,
+    },
+}
+
+
+def get_rollout_settings(config):
+    """Returns the config's rollout profile, with single values overridden by config["rollout_settings"]"""
+    profile = config.get("rollout_profile") or ROLLOUT_PROFILE_SAFE
+    if profile not in ROLLOUT_PROFILES:
+        print(f"ERROR: rollout_profile must be one of {', '.join(ROLLOUT_PROFILES)}, got {profile}")
+        exit(1)
+    settings = dict(ROLLOUT_PROFILES[profile])
+    settings.update(config.get("rollout_settings") or {})
+    settings["health_check_path"] = config.get("health_check_path") or "/"
+    settings["health_check_matcher"] = str(config.get("health_check_matcher") or "200")
+    return settings
+
+
+def get_service(cluster_name, service_name, region):
+    response = get_client("ecs", region).describe_services(cluster=cluster_name, services=[service_name])
+    services = response["services"]
+    return services[0] if services else None
+
+
+def get_latest_deployment(cluster_name, service_name, region):
+    service = get_service(cluster_name, service_name, region)
+    if service is None:
+        return None
+    deployments = service.get("deployments", [])
+    if deployments:
+        return max(deployments, key=lambda d: d["createdAt"])
+    return None
+
+
+def get_deployment_tasks(cluster_name, deployment, region):
+    """Returns tasks started for the deployment, tasks of the previous deployments are skipped"""
+    ecs_client = get_client("ecs", region)
+    task_arns = ecs_client.list_tasks(cluster=cluster_name, startedBy=deployment["id"])["taskArns"]
+    if not task_arns:
+        return []
+    return ecs_client.describe_tasks(cluster=cluster_name, tasks=task_arns[:100])["tasks"]
+
+
+def get_task_targets(cluster_name, tasks, region, instance_ids):
+    """Returns the (instance id, host port) load balancer targets of the tasks.
+
+    instance_ids caches container instance ARN -> EC2 instance id, the mapping doesn't change.
+    """
+    unknown_arns = list(
+        {task["containerInstanceArn"] for task in tasks if "containerInstanceArn" in task} - set(instance_ids)
+    )
+    if unknown_arns:
+        response = get_client("ecs", region).describe_container_instances(
+            cluster=cluster_name, containerInstances=unknown_arns[:100]
+        )
+        for container_instance in response["containerInstances"]:
+            instance_ids[container_instance["containerInstanceArn"]] = container_instance["ec2InstanceId"]
+
+    targets = set()
+    for task in tasks:
+        instance_id = instance_ids.get(task.get("containerInstanceArn"))
+        if instance_id is None:
+            continue
+        for container in task.get("containers", []):
+            for binding in container.get("networkBindings", []):
+                targets.add((instance_id, binding["hostPort"]))
+    return targets
+
+
+def get_target_health_counts(service, region, targets=None):
+    """Counts target health states, only of the given (instance id, port) targets if there are any"""
+    counts = {}
+    for load_balancer in service.get("loadBalancers", []):
+        response = get_client("elbv2", region).describe_target_health(
+            TargetGroupArn=load_balancer["targetGroupArn"]
+        )
+        for target in response["TargetHealthDescriptions"]:
+            if targets is not None and (target["Target"]["Id"], target["Target"].get("Port")) not in targets:
+                continue
+            state = target["TargetHealth"]["State"]
+            counts[state] = counts.get(state, 0) + 1
+    return counts
+
+
+def get_completed_at(service, deployment):
+    """When ECS completed the deployment, from its own event or the deployment's last update"""
+    for event in service.get("events", []):
+        if f"(deployment {deployment['id']}) deployment completed" in event["message"]:
+            return event["createdAt"].timestamp()
+    if "updatedAt" in deployment:
+        return deployment["updatedAt"].timestamp()
+    return time.time()
+
+
+class DeploymentWatcher:
+    """Polls an ECS rollout, backing off while nothing changes, and keeps track of when each phase ended"""
+
+    def __init__(self, cluster_name, service_name, region, spinner):
+        self.cluster_name = cluster_name
+        self.service_name = service_name
+        self.region = region
+        self.spinner = spinner
+        self.base_text = spinner.text
+        self.poll_interval = MIN_POLL_INTERVAL
+        self.seen_event_ids = set()
+        self.last_status = None
+        self.tasks = []
+        self.last_deployment_counts = None
+        self.instance_ids = {}
+        self.healthy_at = None
+        self.completed_at = None
+
+    @traced("poll deployment", "ecs")
+    def poll(self):
+        """Returns the latest deployment after refreshing counts, events and task timestamps"""
+        service = get_service(self.cluster_name, self.service_name, self.region)
+        deployment = max(service["deployments"], key=lambda d: d["createdAt"])
+        changed = self.report_events(service, deployment)
+
+        deployment_counts = (
+            deployment["runningCount"],
+            deployment["pendingCount"],
+            deployment["desiredCount"],
+            len(service["deployments"]),
+        )
+        if deployment_counts != self.last_deployment_counts:
+            self.last_deployment_counts = deployment_counts
+            # Task timestamps and ports only move when the counts do, no need to fetch them on every poll
+            self.tasks = get_deployment_tasks(self.cluster_name, deployment, self.region) or self.tasks
+
+        # The target group also holds the old deployment's tasks, only this deployment's targets count
+        targets = get_task_targets(self.cluster_name, self.tasks, self.region, self.instance_ids)
+        health_counts = get_target_health_counts(service, self.region, targets)
+        # Target health has no timestamps, so the end of the health checks is only as exact as the polling
+        in_health_checks = health_counts.get("initial", 0) > 0
+        status = deployment_counts + (health_counts.get("healthy", 0),)
+        if status != self.last_status:
+            changed = True
+            self.last_status = status
+            running_count, pending_count, desired_count, _, healthy_count = status
+            self.spinner.text = (
+                f"{self.base_text} (running {running_count}/{desired_count}, pending {pending_count}, "
+                f"healthy targets {healthy_count})"
+            )
+            if (
+                self.healthy_at is None
+                and desired_count > 0
+                and running_count >= desired_count
+                and healthy_count >= desired_count
+            ):
+                self.healthy_at = time.time()
+
+        if deployment["rolloutState"] == "COMPLETED" and self.completed_at is None:
+            self.completed_at = get_completed_at(service, deployment)
+
+        if changed or in_health_checks:
+            self.poll_interval = MIN_POLL_INTERVAL
+        else:
+            self.poll_interval = min(self.poll_interval * POLL_BACKOFF, MAX_POLL_INTERVAL)
+        return deployment
+
+    def report_events(self, service, deployment):
+        new_events = [
+            event
+            for event in service.get("events", [])
+            if event["id"] not in self.seen_event_ids and event["createdAt"] >= deployment["createdAt"]
+        ]
+        for event in reversed(new_events):  # ECS lists the newest events first
+            self.seen_event_ids.add(event["id"])
+            self.spinner.write(f"       {event['createdAt'].strftime('%H:%M:%S')} {event['message']}")
+        return len(new_events) > 0
+
+    def get_phase_durations(self, deployment):
+        """Splits the rollout into phases, taking the slowest task for each of them"""
+        deployment_created_at = deployment["createdAt"].timestamp()
+        phases = {"task placement": [], "image pull": [], "container start": []}
+        last_started_at = None
+        for task in self.tasks:
+            if "createdAt" in task:
+                phases["task placement"].append(task["createdAt"].timestamp() - deployment_created_at)
+            if "pullStartedAt" in task and "pullStoppedAt" in task:
+                phases["image pull"].append((task["pullStoppedAt"] - task["pullStartedAt"]).total_seconds())
+                if "startedAt" in task:
+                    container_start = task["startedAt"] - task["pullStoppedAt"]
+                    phases["container start"].append(container_start.total_seconds())
+            if "startedAt" in task:
+                last_started_at = max(last_started_at or 0, task["startedAt"].timestamp())
+
+        durations = {name: max(values) for name, values in phases.items() if values}
+        healthy_at = self.healthy_at
+        if healthy_at is not None and self.completed_at is not None:
+            # Noticed by the same poll as the completion, which ECS timestamps itself
+            healthy_at = min(healthy_at, self.completed_at)
+        if healthy_at is not None and last_started_at is not None:
+            durations["alb health checks"] = max(healthy_at - last_started_at, 0)
+        if healthy_at is not None and self.completed_at is not None:
+            durations["draining old tasks"] = max(self.completed_at - healthy_at, 0)
+        if self.completed_at is not None:
+            durations["total"] = self.completed_at - deployment_created_at
+        return durations
+
+
+def print_rollout_timings(durations, profile):
+    if not durations:
+        return
+    name_width = max(len(name) for name in durations)
+    print_line(f"⏱    rollout timings ({profile} profile):")
+    for name, duration in durations.items():
+        print_line(f"       {name.ljust(name_width)}  {duration:7.1f}s")
+
+
+@traced("wait for deployment", "ecs")
+def wait_for_deployment(config):
+    cluster_name = f"{config['project_name']}-cluster"
+    service_name = f"{config['project_name']}_cluster_service"
+    with progress_spinner("    waiting for deployment") as spinner:
+        if get_latest_deployment(cluster_name, service_name, config["aws_region"]) is None:
+            spinner.fail("❌")
+            return
+
+        watcher = DeploymentWatcher(cluster_name, service_name, config["aws_region"], spinner)
+        latest_deployment = watcher.poll()
+        while latest_deployment["rolloutState"] != "COMPLETED":
+            time.sleep(watcher.poll_interval)
+            latest_deployment = watcher.poll()
+            if latest_deployment["rolloutState"] == "FAILED":
+                spinner.fail("❌")
+                print(f"Deployment failed {latest_deployment['rolloutStateReason']}, more details here:")
+                print(
+                    f"https://console.aws.amazon.com/ecs/home?region={config['aws_region']}#/clusters/{cluster_name}/services/{service_name}/events"
+                )
+                exit(1)
+        spinner.text = watcher.base_text
+        spinner.ok("✔")
+    print_rollout_timings(
+        watcher.get_phase_durations(latest_deployment), config.get("rollout_profile") or ROLLOUT_PROFILE_SAFE
+    )
@@ -11,3 +11,6 @@ def get_image_name(config, requirements):
 
 def get_image_extras():
     return ""
+
+def get_apt_packages():
+    return []
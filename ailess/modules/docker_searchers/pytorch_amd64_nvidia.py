@@ -1,5 +1,4 @@
-import json
-import urllib.request
+from ailess.modules.docker_searchers.tag_index import get_tag_index
 
 lib_name = "torch"
 
@@ -15,24 +14,16 @@ def is_suitable(config, requirements):
     return True
 
 def get_image_name(config, requirements):
-    response = urllib.request.urlopen(
-                "https://hub.docker.com/v2/repositories/pytorch/pytorch/tags/?name=runtime&page_size=100"
-            )
-    response = json.load(response)["results"]
-    image_names = list(map(lambda result: result["name"], response))
     if requirements.is_latest(lib_name):
         return "pytorch/pytorch:latest"
-    for im in image_names:
-        try:
-            version = im.split("-")[0]
-            version = version.split(".")
-            version = [int(v) for v in version]
-            match = requirements.is_match(lib_name, version)
-            if match:
-                return f"pytorch/pytorch:{im}"
-        except (ValueError, TypeError):
-            continue
+    tags = get_tag_index("pytorch/pytorch", "runtime")
+    matches = requirements.filter_versions(lib_name, tags, key=lambda e: e[0])
+    if matches:
+        return f"pytorch/pytorch:{matches[0][1]}"
     return "pytorch/pytorch:latest"
 
 def get_image_extras():
     return "RUN apt-get install -y libglib2.0-0"
+
+def get_apt_packages():
+    return ["libglib2.0-0"]
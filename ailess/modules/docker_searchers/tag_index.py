@@ -0,0 +1,128 @@
+import json
+import os
+import re
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from ailess.modules.config_utils import get_user_cache_dir
+
+DOCKER_HUB_URL = os.environ.get("AILESS_DOCKER_HUB_URL", "https://hub.docker.com")
+TAG_INDEX_TTL = 24 * 60 * 60
+PAGE_SIZE = 100
+MAX_PAGES = 50
+REQUEST_TIMEOUT = 10
+
+_tag_indexes = {}
+
+
+def is_offline():
+    return os.environ.get("AILESS_OFFLINE", "").lower() in ["1", "true", "yes"]
+
+
+def parse_tag_version(tag):
+    """Returns the version a tag starts with (e.g. [2, 0, 1] for "2.0.1-cuda11.7-cudnn8-runtime") or None"""
+    try:
+        return [int(v) for v in tag.split("-")[0].split(".")]
+    except ValueError:
+        return None
+
+
+def build_version_index(tags):
+    """Sorts tags by version, newest first, dropping the ones that don't start with a version"""
+    index = []
+    for tag in tags:
+        version = parse_tag_version(tag)
+        if version is not None:
+            index.append([version, tag])
+    index.sort(key=lambda entry: entry[0], reverse=True)
+    return index
+
+
+def get_cache_path(repository, name_filter):
+    cache_dir = os.path.join(get_user_cache_dir(), "docker_hub_tags")
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, re.sub(r"[^a-zA-Z0-9]+", "_", f"{repository}_{name_filter}") + ".json")
+
+
+def load_cached_index(cache_path):
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_cached_index(cache_path, cached_index):
+    with open(cache_path + ".tmp", "w") as f:
+        json.dump(cached_index, f)
+    os.replace(cache_path + ".tmp", cache_path)
+
+
+def fetch_page(url, etag=None):
+    """Returns (page, etag), page is None when the server says the etag is still current"""
+    request = urllib.request.Request(url)
+    if etag is not None:
+        request.add_header("If-None-Match", etag)
+    try:
+        with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+            return json.load(response), response.headers.get("ETag")
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, etag
+        raise
+
+
+def fetch_tags(repository, name_filter, etag=None):
+    """Returns (tags, etag) going through every page, or (None, etag) if the first page didn't change"""
+    query = urllib.parse.urlencode({"name": name_filter, "page_size": PAGE_SIZE})
+    url = f"{DOCKER_HUB_URL}/v2/repositories/{repository}/tags/?{query}"
+    page, first_page_etag = fetch_page(url, etag)
+    if page is None:
+        return None, etag
+
+    tags = [result["name"] for result in page["results"]]
+    for _ in range(MAX_PAGES - 1):
+        if not page.get("next"):
+            break
+        page, _ = fetch_page(page["next"])
+        tags += [result["name"] for result in page["results"]]
+    return tags, first_page_etag
+
+
+def get_tag_index(repository, name_filter):
+    """Returns [version, tag] pairs for a Docker Hub repository, newest version first.
+
+    Tags are cached on disk for a day and revalidated with the ETag of the first page after that.
+    With AILESS_OFFLINE set only the cache is used.
+    """
+    key = (repository, name_filter)
+    if key in _tag_indexes:
+        return _tag_indexes[key]
+
+    cache_path = get_cache_path(repository, name_filter)
+    cached_index = load_cached_index(cache_path)
+    is_fresh = cached_index is not None and time.time() - cached_index["fetched_at"] < TAG_INDEX_TTL
+    if cached_index is not None and (is_offline() or is_fresh):
+        _tag_indexes[key] = cached_index["index"]
+        return cached_index["index"]
+    if is_offline():
+        print(f"WARNING: no cached tags for {repository}, using the latest image")
+        _tag_indexes[key] = []
+        return []
+
+    try:
+        tags, etag = fetch_tags(repository, name_filter, cached_index["etag"] if cached_index else None)
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        print(f"WARNING: could not fetch tags for {repository} from Docker Hub: {e}")
+        index = cached_index["index"] if cached_index else []
+        _tag_indexes[key] = index
+        return index
+
+    index = cached_index["index"] if tags is None else build_version_index(tags)
+    save_cached_index(cache_path, {"fetched_at": time.time(), "etag": etag, "index": index})
+    _tag_indexes[key] = index
+    return index
@@ -1,5 +1,4 @@
-import json
-import urllib.request
+from ailess.modules.docker_searchers.tag_index import get_tag_index
 
 lib_name = "tensorflow"
 
@@ -15,25 +14,16 @@ def is_suitable(config, requirements):
     return True
 
 def get_image_name(config, requirements):
-    response = urllib.request.urlopen(
-                "https://hub.docker.com/v2/repositories/tensorflow/tensorflow/tags/?name=gpu&page_size=100"
-            )
-    response = json.load(response)["results"]
-    image_names = list(map(lambda result: result["name"], response))
     if requirements.is_latest(lib_name):
         return "tensorflow/tensorflow:latest-gpu"
-    for im in image_names:
-        try:
-            if "jupyter" not in im:
-                version = im.split("-")[0]
-                version = version.split(".")
-                version = [int(v) for v in version]
-                match = requirements.is_match(lib_name, version)
-                if match:
-                    return f"tensorflow/tensorflow:{im}"
-        except (ValueError, TypeError):
-            continue
+    tags = [entry for entry in get_tag_index("tensorflow/tensorflow", "gpu") if "jupyter" not in entry[1]]
+    matches = requirements.filter_versions(lib_name, tags, key=lambda e: e[0])
+    if matches:
+        return f"tensorflow/tensorflow:{matches[0][1]}"
     return "tensorflow/tensorflow:latest-gpu"
 
 def get_image_extras():
     return ""
+
+def get_apt_packages():
+    return []
@@ -3,28 +3,66 @@ import os
 import re
 import subprocess
 import sys
-import urllib.request
 
-from yaspin import yaspin
-
-from ailess.modules.cli_utils import run_command_in_working_directory
-from ailess.modules.python_utils import RequirementsParser
-from ailess.modules.docker_searchers import get_sercher_from_config
+from ailess.modules.cli_utils import run_command_in_working_directory, progress_spinner, OutputParser
+from ailess.modules.server_utils import get_server_packages, get_server_command
+from ailess.modules.trace_utils import traced, annotate_span
 
 DOCKER_ARCHITECTURE_AMD64 = "linux/amd64"
 DOCKER_ARCHITECTURE_ARM64 = "linux/arm64"
 
+BUILDX_BUILDER_NAME = "ailess"
+BUILD_CACHE_MODES = ["off", "min", "max"]
+
+LAYER_COMPRESSION_GZIP = "gzip"
+LAYER_COMPRESSION_ZSTD = "zstd"
+BUILD_METADATA_PATH = ".ailess/build_metadata.json"
+
+DEFAULT_DOCKER_IGNORE_RULES = [
+    ".ailess/*",
+    ".idea/*",
+    ".vscode/*",
+    ".git",
+    "**/__pycache__",
+    "**/*.pyc",
+    "**/.ipynb_checkpoints",
+    "**/.pytest_cache",
+    "**/.mypy_cache",
+    ".venv",
+    "venv",
+]
+DOCKERFILE_MODE_SIMPLE = "simple"
+DOCKERFILE_MODE_MULTISTAGE = "multistage"
+
+BUILDX_STEP_REGEX = re.compile(r"^#\d+ \[(?:[^\]]+ )?(\d+)/(\d+)\] (.*)$")
+PUSH_LAYER_REGEX = re.compile(r"^([0-9a-f]{12}): (.*)$")
+
 
 def generate_dockerfile(config):
     if os.path.exists(os.path.join(os.getcwd(), "Dockerfile")):
         return
 
+    from ailess.modules.python_utils import RequirementsParser
+    from ailess.modules.docker_searchers import get_sercher_from_config
+
     # Get image name from config
     requirements = RequirementsParser("requirements.txt")
     searcher = get_sercher_from_config(config, requirements)
     image_name = searcher.get_image_name(config, requirements)
+    app = get_entrypoint_app(config)
+    server_packages = get_server_packages(app)
+    command = json.dumps(get_server_command(config, app))
+    if config.get("dockerfile_mode", DOCKERFILE_MODE_SIMPLE) == DOCKERFILE_MODE_MULTISTAGE:
+        apt_packages = searcher.get_apt_packages()
+        dockerfile_content = get_multistage_dockerfile_content(
+            config, image_name, apt_packages, server_packages, command
+        )
+        with open("Dockerfile", "w") as dockerfile:
+            dockerfile.write("\n".join(dockerfile_content) + "\n")
+        return
+
     image_extras = searcher.get_image_extras()
-    
+
     dockerfile_content = []
     dockerfile_content.append("FROM {}".format(image_name))
     if config["has_gpu"]:
@@ -47,12 +85,70 @@ RUN apt update && \
     dockerfile_content.append("ADD requirements.txt /app/requirements.txt")
     dockerfile_content.append("WORKDIR /app")
     dockerfile_content.append("RUN pip3 install -r requirements.txt")
+    if server_packages:
+        dockerfile_content.append("RUN pip3 install {}".format(" ".join(server_packages)))
     dockerfile_content.append("ADD . /app")
-    dockerfile_content.append('CMD ["python3", "-u", "{}"]'.format(config["entrypoint_path"]))
+    dockerfile_content.append("CMD {}".format(command))
     with open("Dockerfile", "w") as dockerfile:
         dockerfile.write("\n".join(dockerfile_content))
 
 
+def get_entrypoint_app(config):
+    """Returns the WSGI/ASGI app to serve with gunicorn and writes its config, or None if there's none"""
+    from ailess.modules.aws_utils import get_instance_type_info
+    from ailess.modules.packing_utils import get_task_packing
+    from ailess.modules.server_utils import detect_app, generate_server_config
+
+    app = detect_app(config["entrypoint_path"])
+    if app is not None:
+        instance_data = get_instance_type_info(config["ec2_instance_type"], config["aws_region"])
+        generate_server_config(config, app, get_task_packing(config, instance_data))
+    return app
+
+
+def get_multistage_dockerfile_content(config, image_name, extra_apt_packages, server_packages, command):
+    """Two-stage Dockerfile using BuildKit cache mounts for apt and pip.
+
+    The builder stage turns requirements into wheels, the final stage installs them through a bind mount,
+    so neither compilers nor wheel files end up in the image. Layers go from least to most often changing.
+    """
+    apt_packages = ["libgl1"] + extra_apt_packages
+    if config["has_gpu"]:
+        apt_packages = ["bash", "curl", "ca-certificates", "python3", "python3-pip"] + apt_packages
+    server_requirements = "".join(" " + package for package in server_packages)
+    apt_cache_mounts = (
+        "RUN --mount=type=cache,target=/var/cache/apt,sharing=locked \\\n"
+        "    --mount=type=cache,target=/var/lib/apt,sharing=locked \\\n"
+    )
+
+    return [
+        "# syntax=docker/dockerfile:1",
+        "FROM {} AS base".format(image_name),
+        "ENV DEBIAN_FRONTEND=noninteractive PIP_DISABLE_PIP_VERSION_CHECK=1",
+        # The base images clean the apt cache after every install, which would leave the cache mount empty
+        "RUN rm -f /etc/apt/apt.conf.d/docker-clean && \\\n"
+        "    echo 'Binary::apt::APT::Keep-Downloaded-Packages \"true\";' > /etc/apt/apt.conf.d/keep-cache",
+        apt_cache_mounts + "    apt-get update && apt-get install -y --no-install-recommends {}".format(
+            " ".join(apt_packages)
+        ),
+        "",
+        "FROM base AS builder",
+        apt_cache_mounts + "    apt-get update && apt-get install -y --no-install-recommends build-essential",
+        "COPY requirements.txt /tmp/requirements.txt",
+        "RUN --mount=type=cache,target=/root/.cache/pip \\\n"
+        "    pip3 wheel --wheel-dir /wheels -r /tmp/requirements.txt" + server_requirements,
+        "",
+        "FROM base",
+        "WORKDIR /app",
+        "COPY requirements.txt /app/requirements.txt",
+        "RUN --mount=type=bind,from=builder,source=/wheels,target=/wheels \\\n"
+        "    pip3 install --no-cache-dir --no-index --find-links=/wheels \\\n"
+        "    -r requirements.txt" + server_requirements,
+        "COPY . /app",
+        "CMD {}".format(command),
+    ]
+
+
 def generate_docker_compose_file(config):
     if os.path.exists(os.path.join(os.getcwd(), "docker-compose.yml")):
         return
@@ -90,37 +186,320 @@ def generate_docker_compose_file(config):
 
 
 def generate_or_update_docker_ignore():
+    """Creates .dockerignore or appends the default rules it's missing"""
+    docker_ignore = ""
     if os.path.exists(".dockerignore"):
         with open(".dockerignore", "r") as f:
             docker_ignore = f.read()
-            if ".ailess/*" not in docker_ignore:
-                with open(".dockerignore", "a") as docker_ignore_file:
-                    docker_ignore_file.write(".ailess/*")
-            if ".idea/*" not in docker_ignore:
-                with open(".dockerignore", "a") as docker_ignore_file:
-                    docker_ignore_file.write(".idea/*")
-    else:
-        with open(".dockerignore", "w") as docker_ignore_file:
-            docker_ignore_file.write(".ailess/*\n.idea/*")
+    existing_rules = {line.strip() for line in docker_ignore.splitlines()}
+    missing_rules = [rule for rule in DEFAULT_DOCKER_IGNORE_RULES if rule not in existing_rules]
+    if len(missing_rules) == 0:
+        return
+    if docker_ignore and not docker_ignore.endswith("\n"):
+        docker_ignore += "\n"
+    with open(".dockerignore", "w") as docker_ignore_file:
+        docker_ignore_file.write(docker_ignore + "".join(rule + "\n" for rule in missing_rules))
+
+
+def load_docker_ignore_patterns(path=".dockerignore"):
+    """Returns .dockerignore rules as a list of (compiled pattern, is_exception) pairs"""
+    if not os.path.exists(path):
+        return []
+    patterns = []
+    with open(path, "r") as f:
+        for line in f.readlines():
+            line = line.strip()
+            if len(line) == 0 or line.startswith("#"):
+                continue
+            is_exception = line.startswith("!")
+            if is_exception:
+                line = line[1:].strip()
+            line = os.path.normpath(line).replace(os.sep, "/").lstrip("/")
+            if line == ".":
+                continue
+            patterns.append((re.compile(_docker_ignore_pattern_to_regex(line)), is_exception))
+    return patterns
+
+
+def _docker_ignore_pattern_to_regex(pattern):
+    # Same rules as docker: "*" and "?" stay within one path segment, "**" spans any number of them,
+    # and a matching directory excludes everything below it
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+            continue
+        if char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                regex += re.escape(char)
+            else:
+                char_class = pattern[i + 1 : end]
+                if char_class.startswith("!"):
+                    char_class = "^" + char_class[1:]
+                regex += "[" + char_class + "]"
+                i = end
+        else:
+            regex += re.escape(char)
+        i += 1
+    return regex + "(?:/.*)?$"
+
+
+def is_docker_ignored(relative_path, patterns):
+    ignored = False
+    for pattern, is_exception in patterns:
+        if pattern.match(relative_path):
+            ignored = not is_exception
+    return ignored
+
+
+def iter_build_context_files(root=".", patterns=None):
+    """Yields paths (relative, "/"-separated) of every file docker would send as build context"""
+    if patterns is None:
+        patterns = load_docker_ignore_patterns(os.path.join(root, ".dockerignore"))
+    # An exception rule can bring back files from an ignored directory, so only prune without them
+    can_prune = not any(is_exception for _, is_exception in patterns)
+    for dirpath, dirnames, filenames in os.walk(root):
+        relative_dir = os.path.relpath(dirpath, root).replace(os.sep, "/")
+        relative_dir = "" if relative_dir == "." else relative_dir + "/"
+        if can_prune:
+            dirnames[:] = [d for d in dirnames if not is_docker_ignored(relative_dir + d, patterns)]
+        dirnames.sort()
+        for filename in sorted(filenames):
+            relative_path = relative_dir + filename
+            if not is_docker_ignored(relative_path, patterns):
+                yield relative_path
+
+
+class BuildxProgressParser(OutputParser):
+    """Shows the current Dockerfile step from `docker buildx build --progress=plain`"""
+
+    def handle_line(self, line, stream):
+        match = BUILDX_STEP_REGEX.match(line)
+        if match is not None:
+            step, steps, instruction = match.groups()
+            instruction = instruction if len(instruction) <= 50 else instruction[:47] + "..."
+            self.set_progress(f"step {step}/{steps}: {instruction}")
+        return line
+
+
+class PushProgressParser(OutputParser):
+    """Counts pushed layers from the plain `docker push` output"""
+
+    def __init__(self, spinner=None):
+        super().__init__(spinner)
+        self.layers = {}
+
+    def handle_line(self, line, stream):
+        match = PUSH_LAYER_REGEX.match(line)
+        if match is not None:
+            layer, status = match.groups()
+            self.layers[layer] = status in ["Pushed", "Layer already exists"] or status.startswith(
+                "Mounted from"
+            )
+            done_layers = sum(1 for is_done in self.layers.values() if is_done)
+            self.set_progress(f"{done_layers}/{len(self.layers)} layers")
+        return line
+
+
+def inspect_local_image(image_name, template):
+    completed_process = subprocess.run(
+        ["docker", "image", "inspect", "--format", template, image_name],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    if completed_process.returncode != 0:
+        return None
+    return completed_process.stdout.decode("utf8").strip()
+
 
+def get_local_image_id(image_name):
+    return inspect_local_image(image_name, "{{.Id}}")
 
-def build_docker_image(config):
+
+def inspect_pushed_manifest(image_ref, platform):
+    """Returns the platform's manifest of a pushed image, read from the registry without pulling anything"""
+    completed_process = subprocess.run(
+        ["docker", "buildx", "imagetools", "inspect", "--raw", image_ref],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    if completed_process.returncode != 0:
+        return None
+    manifest = json.loads(completed_process.stdout)
+    if "manifests" not in manifest:
+        return manifest
+    # buildx pushes an index when it adds attestations, the image itself is one of its manifests
+    os_name, _, architecture = platform.partition("/")
+    for entry in manifest["manifests"]:
+        entry_platform = entry.get("platform", {})
+        if entry_platform.get("os") == os_name and entry_platform.get("architecture") == architecture:
+            return inspect_pushed_manifest(f"{image_ref.split('@')[0]}@{entry['digest']}", platform)
+    return None
+
+
+def get_layer_compression_summary(manifest):
+    """Returns the compressed size of the manifest's layers and how many of them are zstd"""
+    layers = manifest.get("layers", [])
+    compressed_size = sum(layer["size"] for layer in layers)
+    zstd_layers = sum(1 for layer in layers if layer["mediaType"].endswith("+zstd"))
+    return compressed_size, zstd_layers, len(layers)
+
+
+def format_size(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+
+
+def ensure_buildx_builder(spinner):
+    """Registry cache export and compressed pushes need a docker-container builder, the docker driver can't"""
+    completed_process = subprocess.run(
+        ["docker", "buildx", "inspect", BUILDX_BUILDER_NAME],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    if completed_process.returncode != 0:
+        run_command_in_working_directory(
+            f"docker buildx create --name {BUILDX_BUILDER_NAME} --driver docker-container", spinner
+        )
+
+
+def get_build_cache_args(config, spinner):
+    cache_mode = config.get("build_cache_mode", "off")
+    if cache_mode not in BUILD_CACHE_MODES:
+        spinner.fail("❌")
+        print(f"Invalid build_cache_mode {cache_mode} in .ailess/config.json, use one of: off, min, max")
+        exit(1)
+    if cache_mode == "off":
+        return ""
+
+    from ailess.modules.aws_utils import get_build_cache_ref
+
+    cache_ref = get_build_cache_ref(config, spinner)
+    # ECR only accepts cache exported as a regular image manifest
+    return (
+        f"--cache-from type=registry,ref={cache_ref} "
+        f"--cache-to type=registry,ref={cache_ref},mode={cache_mode},image-manifest=true,oci-mediatypes=true"
+    )
+
+
+def is_pushed_while_building(config, for_deploy):
+    compression = config.get("layer_compression", LAYER_COMPRESSION_GZIP)
+    if compression not in [LAYER_COMPRESSION_GZIP, LAYER_COMPRESSION_ZSTD]:
+        print(f"Invalid layer_compression {compression} in .ailess/config.json, use one of: gzip, zstd")
+        exit(1)
+    return for_deploy and compression == LAYER_COMPRESSION_ZSTD
+
+
+def get_build_output_args(config, spinner, push_while_building):
+    """Returns buildx output flags: load into docker or, for zstd layers, push straight to ECR"""
+    if not push_while_building:
+        return "--load"
+
+    from ailess.modules.aws_utils import ensure_ecr_repo_exists, ensure_ecr_login, get_ecr_image_name
+
+    ensure_ecr_repo_exists(config)
+    ensure_ecr_login(config["aws_region"], spinner)
+    # `docker push` keeps whatever compression the local layers have, so zstd has to come from buildx itself
+    return (
+        f"--metadata-file {BUILD_METADATA_PATH} "
+        f"--output type=image,name={get_ecr_image_name(config)}:latest,push=true,"
+        "compression=zstd,compression-level=3,force-compression=true,oci-mediatypes=true"
+    )
+
+
+def get_build_command(config, dockerfile_path, output_args, builder_args, cache_args, push_while_building):
+    from ailess.modules.terraform_utils import convert_to_alphanumeric
+
+    # A -t tag replaces the name of the image output, so pushes straight to ECR must not get one
+    tag_args = "" if push_while_building else f"-t {convert_to_alphanumeric(config['project_name'])}:latest"
+    return "docker buildx build \
+            --progress=plain \
+            --platform {} \
+            {} \
+            {} {} \
+            -f {} . {}".format(
+        config["cpu_architecture"],
+        tag_args,
+        builder_args,
+        cache_args,
+        dockerfile_path,
+        output_args,
+    )
+
+
+@traced("build image", "docker")
+def build_docker_image(config, for_deploy=False):
+    from ailess.modules.build_cache_utils import (
+        get_build_fingerprint,
+        get_build_context_size,
+        get_cached_image_id,
+        save_built_image_id,
+        get_cached_pushed_digest,
+        save_pushed_digest,
+    )
     from ailess.modules.terraform_utils import convert_to_alphanumeric
 
     dockerfile_path = os.path.join(os.getcwd(), "Dockerfile")
+    image_name = "{}:latest".format(convert_to_alphanumeric(config["project_name"]))
+    push_while_building = is_pushed_while_building(config, for_deploy)
+
+    with progress_spinner("    building docker image") as spinner:
+        fingerprint = get_build_fingerprint(config)
+        context_size, context_files = get_build_context_size()
+        annotate_span(context_bytes=context_size, context_files=context_files)
+        spinner.write(f"📦    build context: {format_size(context_size)} in {context_files} files")
+        if push_while_building:
+            from ailess.modules.aws_utils import get_ecr_latest_image
+
+            cached_digest = get_cached_pushed_digest(fingerprint)
+            ecr_image = get_ecr_latest_image(config) if cached_digest is not None else None
+            is_up_to_date = ecr_image is not None and ecr_image["imageDigest"] == cached_digest
+        else:
+            cached_image_id = get_cached_image_id(fingerprint)
+            is_up_to_date = cached_image_id is not None and cached_image_id == get_local_image_id(image_name)
+        if is_up_to_date:
+            spinner.text = "    docker image is up to date"
+            spinner.ok("✔")
+            return
 
-    with yaspin(text="    building docker image") as spinner:
+        cache_args = get_build_cache_args(config, spinner) if for_deploy else ""
+        output_args = get_build_output_args(config, spinner, push_while_building)
+        builder_args = ""
+        if cache_args or push_while_building:
+            ensure_buildx_builder(spinner)
+            builder_args = f"--builder {BUILDX_BUILDER_NAME}"
         run_command_in_working_directory(
-            "docker buildx build \
-            --platform {} \
-            -t {}:latest \
-            -f {} . --load".format(
-                config["cpu_architecture"],
-                convert_to_alphanumeric(config["project_name"]),
-                dockerfile_path,
+            get_build_command(
+                config, dockerfile_path, output_args, builder_args, cache_args, push_while_building
             ),
             spinner,
+            parser=BuildxProgressParser(spinner),
         )
+        if push_while_building:
+            with open(BUILD_METADATA_PATH, "r") as f:
+                save_pushed_digest(fingerprint, json.load(f).get("containerimage.digest"))
+            spinner.ok("✔")
+            return
+
+        save_built_image_id(fingerprint, get_local_image_id(image_name))
+        image_size = inspect_local_image(image_name, "{{.Size}}")
+        if image_size is not None:
+            annotate_span(bytes=int(image_size))
+            spinner.text = f"{spinner.text} ({format_size(int(image_size))})"
         spinner.ok("✔")
 
 
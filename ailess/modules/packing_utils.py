@@ -0,0 +1,142 @@
+import math
+
+# Memory left to the OS and the ECS agent on every instance
+RESERVED_MEMORY_FRACTION = 0.1
+
+SCALING_METRIC_NONE = "none"
+SCALING_METRIC_REQUESTS = "requests"
+SCALING_METRIC_CPU = "cpu"
+SCALING_METRIC_CUSTOM = "custom"
+SCALING_METRICS = [SCALING_METRIC_NONE, SCALING_METRIC_REQUESTS, SCALING_METRIC_CPU, SCALING_METRIC_CUSTOM]
+# Requests per task per minute for the ALB metric, average utilization percent for CPU
+DEFAULT_SCALING_TARGETS = {SCALING_METRIC_REQUESTS: 100, SCALING_METRIC_CPU: 70}
+
+
+def get_default_tasks_per_instance(instance_data):
+    """One task per GPU, since a GPU can't be shared between tasks and an app rarely drives more than one"""
+    return max(instance_data["num_gpus"], 1)
+
+
+def get_task_packing(config, instance_data):
+    """Splits an instance between tasks_per_instance tasks, or fits as many tasks of a given shape as it can.
+
+    The shape comes from the optional task_cpu (CPU units), task_memory (MiB) and task_gpus config keys.
+    """
+    available_cpu = instance_data["cpu_size"]
+    available_memory = math.floor(instance_data["memory_size"] * (1 - RESERVED_MEMORY_FRACTION))
+    num_gpus = instance_data["num_gpus"]
+
+    tasks_per_instance = int(config.get("tasks_per_instance") or 0)
+    task_cpu = int(config.get("task_cpu") or 0)
+    task_memory = int(config.get("task_memory") or 0)
+    task_gpus = int(config["task_gpus"]) if config.get("task_gpus") is not None else None
+
+    if task_cpu > available_cpu or task_memory > available_memory or (task_gpus or 0) > num_gpus:
+        print(
+            f"ERROR: a task needs more than a {config['ec2_instance_type']} has to offer "
+            f"({available_cpu} CPU units, {available_memory} MiB of memory, {num_gpus} GPUs)"
+        )
+        exit(1)
+
+    if tasks_per_instance == 0:
+        # task_gpus 0 is a shape too, a CPU-only task on a GPU instance
+        if task_cpu or task_memory or task_gpus is not None:
+            fits = []
+            if task_cpu:
+                fits.append(available_cpu // task_cpu)
+            if task_memory:
+                fits.append(available_memory // task_memory)
+            if task_gpus:
+                fits.append(num_gpus // task_gpus)
+            elif task_gpus is None and num_gpus > 0:
+                fits.append(num_gpus)
+            # With only task_gpus 0, one task gets the whole instance, as on instances without GPUs
+            tasks_per_instance = min(fits) if fits else 1
+        else:
+            tasks_per_instance = get_default_tasks_per_instance(instance_data)
+
+    if num_gpus > 0 and task_gpus is None:
+        if tasks_per_instance > num_gpus:
+            print(
+                f"ERROR: {config['ec2_instance_type']} has {num_gpus} GPUs, "
+                f"it can't run {tasks_per_instance} GPU tasks"
+            )
+            exit(1)
+        task_gpus = num_gpus // tasks_per_instance
+        if num_gpus % tasks_per_instance != 0:
+            idle_gpus = num_gpus - task_gpus * tasks_per_instance
+            print(
+                f"WARNING: {idle_gpus} of {num_gpus} GPUs will be idle with {tasks_per_instance} tasks"
+            )
+
+    packing = {
+        "tasks_per_instance": tasks_per_instance,
+        "task_cpu": task_cpu or available_cpu // tasks_per_instance,
+        "task_memory": task_memory or available_memory // tasks_per_instance,
+        "task_gpus": task_gpus or 0,
+    }
+    if (
+        packing["task_cpu"] * tasks_per_instance > available_cpu
+        or packing["task_memory"] * tasks_per_instance > available_memory
+        or packing["task_gpus"] * tasks_per_instance > num_gpus
+    ):
+        print(f"ERROR: {tasks_per_instance} tasks of this size don't fit on a {config['ec2_instance_type']}")
+        exit(1)
+
+    packing["instances_count"] = int(config["instances_count"])
+    packing["desired_count"] = packing["instances_count"] * tasks_per_instance
+    return packing
+
+
+def get_scaling_settings(config, packing):
+    """Task count bounds and scaling target, plus the ASG size that can hold max_tasks during a rollout.
+
+    Without a scaling metric the service is pinned to desired_count.
+    """
+    scaling_metric = config.get("scaling_metric") or SCALING_METRIC_NONE
+    if scaling_metric not in SCALING_METRICS:
+        print(f"ERROR: scaling_metric must be one of {', '.join(SCALING_METRICS)}, got {scaling_metric}")
+        exit(1)
+
+    if scaling_metric == SCALING_METRIC_NONE:
+        min_tasks = max_tasks = packing["desired_count"]
+    else:
+        min_tasks = int(config.get("min_tasks") or packing["desired_count"])
+        max_tasks = int(config.get("max_tasks") or packing["desired_count"])
+    if not min_tasks <= packing["desired_count"] <= max_tasks:
+        print(
+            f"ERROR: {packing['desired_count']} tasks is outside of "
+            f"min_tasks {min_tasks} and max_tasks {max_tasks}"
+        )
+        exit(1)
+
+    custom_metric = config.get("scaling_custom_metric") or {}
+    is_custom_metric_complete = (
+        custom_metric.get("namespace") and custom_metric.get("name") and config.get("scaling_target")
+    )
+    if scaling_metric == SCALING_METRIC_CUSTOM and not is_custom_metric_complete:
+        print(
+            "ERROR: the custom scaling metric needs a scaling_target "
+            "and scaling_custom_metric with a namespace and a name"
+        )
+        exit(1)
+
+    tasks_per_instance = packing["tasks_per_instance"]
+    asg_min_size = math.ceil(min_tasks / tasks_per_instance)
+    max_instances = math.ceil(max_tasks / tasks_per_instance)
+    # true keeps enough warm instances to scale from min_tasks to max_tasks
+    warm_pool_size = config.get("warm_pool_size") or 0
+    if warm_pool_size is True:
+        warm_pool_size = max(max_instances - asg_min_size, 1)
+    scaling_target = config.get("scaling_target") or DEFAULT_SCALING_TARGETS.get(scaling_metric, 0)
+    return {
+        "scaling_metric": scaling_metric,
+        "scaling_target": float(scaling_target),
+        "scaling_custom_metric": custom_metric,
+        "min_tasks": min_tasks,
+        "max_tasks": max_tasks,
+        "asg_min_size": asg_min_size,
+        # A rollout starts a full set of new tasks next to the old ones, see deployment_maximum_percent
+        "asg_max_size": max_instances * 2,
+        "warm_pool_size": int(warm_pool_size),
+    }
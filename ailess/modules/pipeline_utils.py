@@ -0,0 +1,135 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from ailess.modules.cli_utils import set_line_progress, set_output_prefix, cancel_running_commands, print_line
+from ailess.modules.trace_utils import span
+
+
+class Stage:
+    def __init__(self, name, func, depends_on=(), output_prefix=None):
+        self.name = name
+        self.func = func
+        self.depends_on = list(depends_on)
+        # Marks the stage's output lines, e.g. with its region, when similar stages run side by side
+        self.output_prefix = output_prefix
+
+
+STAGE_OK = "ok"
+STAGE_FAILED = "failed"
+STAGE_CANCELLED = "cancelled"
+STAGE_SKIPPED = "skipped"
+
+# Bounds how many stages run at once, e.g. pushes and rollouts of many regions
+MAX_PARALLEL_STAGES = 8
+
+
+def run_stages(stages, fail_fast=True, max_workers=None):
+    """Runs stages as soon as their dependencies are done.
+
+    With fail_fast, the first failure stops everything and exits. Otherwise only the stages that depend on
+    a failed one are skipped, and the status of every stage is returned for the caller to report.
+    """
+    stages_by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        for dependency in stage.depends_on:
+            if dependency not in stages_by_name:
+                raise ValueError(f"Stage {stage.name} depends on unknown stage {dependency}")
+
+    statuses = {}
+    running = {}
+    durations = {}
+    failed_stage = None
+    started_at = time.monotonic()
+
+    set_line_progress(True)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers or min(len(stages), MAX_PARALLEL_STAGES)) as executor:
+            try:
+                while len(statuses) < len(stages) and (failed_stage is None or not fail_fast):
+                    scheduled = True
+                    while scheduled:  # Skipping a stage can make its dependents skippable in turn
+                        scheduled = False
+                        for stage in stages:
+                            if stage.name in statuses or stage.name in running.values():
+                                continue
+                            dependency_statuses = [statuses.get(name) for name in stage.depends_on]
+                            if any(status not in (None, STAGE_OK) for status in dependency_statuses):
+                                statuses[stage.name] = STAGE_SKIPPED
+                                scheduled = True
+                            elif all(status == STAGE_OK for status in dependency_statuses):
+                                running[executor.submit(_timed_call, stage)] = stage.name
+
+                    if len(statuses) == len(stages):
+                        break
+                    if not running:
+                        raise ValueError("Stage dependencies contain a cycle")
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        stage_name = running.pop(future)
+                        durations[stage_name], error = future.result()
+                        statuses[stage_name] = STAGE_OK if error is None else STAGE_FAILED
+                        if error is not None and not isinstance(error, SystemExit):
+                            print_line(f"Error in {stage_name}: {error}")
+                        if error is not None and failed_stage is None:
+                            failed_stage = stage_name
+                            if fail_fast:
+                                cancel_running_commands()
+            except KeyboardInterrupt:
+                # Commands run in their own sessions here, so Ctrl+C doesn't reach them by itself
+                cancel_running_commands()
+                raise
+            for stage_name in running.values():
+                statuses[stage_name] = STAGE_CANCELLED
+    finally:
+        set_line_progress(False)
+
+    print_stage_timings(stages, durations, statuses, time.monotonic() - started_at)
+    if failed_stage is not None and fail_fast:
+        print_line(f"❌    {failed_stage} failed")
+        exit(1)
+    return statuses
+
+
+def _timed_call(stage):
+    started_at = time.monotonic()
+    set_output_prefix(stage.output_prefix)
+    try:
+        with span(stage.name, "stage"):
+            stage.func()
+    except BaseException as e:  # stages report failures through exit(1)
+        return time.monotonic() - started_at, e
+    finally:
+        set_output_prefix(None)
+    return time.monotonic() - started_at, None
+
+
+def print_stage_timings(stages, durations, statuses, total_duration):
+    name_width = max(len(stage.name) for stage in stages + [Stage("total", None)])
+    print_line("⏱    stage timings:")
+    for stage in stages:
+        if stage.name in durations:
+            failed = "  failed" if statuses.get(stage.name) == STAGE_FAILED else ""
+            print_line(f"       {stage.name.ljust(name_width)}  {durations[stage.name]:7.1f}s{failed}")
+        else:
+            print_line(f"       {stage.name.ljust(name_width)}  {statuses.get(stage.name, STAGE_SKIPPED)}")
+    print_line(f"       {'total'.ljust(name_width)}  {total_duration:7.1f}s")
+
+
+def get_region_stage_name(phase, region):
+    return f"{phase} [{region}]"
+
+
+def print_region_statuses(regions, phases, statuses):
+    """Prints the status of every region's phases side by side"""
+    region_width = max(len(region) for region in regions + ["region"])
+    widths = [max(len(phase), len(STAGE_CANCELLED)) for phase in phases]
+    print_line("🌍    regions:")
+    header = "  ".join(phase.ljust(width) for phase, width in zip(phases, widths))
+    print_line(f"       {'region'.ljust(region_width)}  {header}".rstrip())
+    for region in regions:
+        cells = [
+            statuses.get(get_region_stage_name(phase, region), STAGE_SKIPPED).ljust(width)
+            for phase, width in zip(phases, widths)
+        ]
+        print_line(f"       {region.ljust(region_width)}  {'  '.join(cells)}".rstrip())
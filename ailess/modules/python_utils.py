@@ -1,6 +1,45 @@
+import ast
+import functools
+import json
 import os
 import re
-from pipreqs.pipreqs import get_all_imports, get_pkg_names, get_import_local, get_imports_info
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from urllib.parse import urlparse
+
+from packaging.requirements import Requirement, InvalidRequirement
+from packaging.specifiers import Specifier, SpecifierSet
+from packaging.utils import canonicalize_name
+from packaging.version import Version, InvalidVersion
+
+IMPORT_CACHE_PATH = ".ailess/import_cache.json"
+IMPORT_SCAN_IGNORED_DIRS = {
+    ".git",
+    ".hg",
+    ".svn",
+    ".tox",
+    ".nox",
+    ".ailess",
+    ".idea",
+    ".mypy_cache",
+    ".pytest_cache",
+    ".ipynb_checkpoints",
+    "__pycache__",
+    "node_modules",
+    "site-packages",
+    "env",
+    "venv",
+    ".venv",
+}
+# Below this many files to parse, starting worker processes costs more than it saves
+PARALLEL_SCAN_MIN_FILES = 64
+PYPI_URL = "https://pypi.org/pypi/"
+PYPI_WORKERS = 8
+PYPI_TIMEOUT = 10
+
+_pypi_connections = threading.local()
 
 
 def ensure_requirements_exists():
@@ -9,20 +48,166 @@ def ensure_requirements_exists():
         generate_requirements_file("./")
 
 
+def is_virtualenv(path):
+    return any(os.path.exists(os.path.join(path, marker)) for marker in ["pyvenv.cfg", "conda-meta"])
+
+
+def iter_python_files(project_path):
+    """Yields (relative path, absolute path) of python files, skipping virtualenvs, caches and ignored files"""
+    from ailess.modules.docker_utils import load_docker_ignore_patterns, is_docker_ignored
+
+    # Files docker doesn't send to the build can't be imported by the app in the image
+    ignore_patterns = [
+        (pattern, is_exception)
+        for pattern, is_exception in load_docker_ignore_patterns(os.path.join(project_path, ".dockerignore"))
+        if not is_exception
+    ]
+    for dirpath, dirnames, filenames in os.walk(project_path):
+        relative_dir = os.path.relpath(dirpath, project_path).replace(os.sep, "/")
+        relative_dir = "" if relative_dir == "." else relative_dir + "/"
+        dirnames[:] = [
+            d
+            for d in dirnames
+            if d not in IMPORT_SCAN_IGNORED_DIRS
+            and not is_docker_ignored(relative_dir + d, ignore_patterns)
+            and not is_virtualenv(os.path.join(dirpath, d))
+        ]
+        for filename in filenames:
+            if filename.endswith(".py") and not is_docker_ignored(relative_dir + filename, ignore_patterns):
+                yield relative_dir + filename, os.path.join(dirpath, filename)
+
+
+def parse_file_imports(path):
+    """Returns the top-level modules imported by a python file, or None if it can't be parsed"""
+    try:
+        with open(path, "rb") as f:
+            tree = ast.parse(f.read(), filename=path)
+    except (SyntaxError, ValueError, OSError):
+        return None
+    imports = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            imports.update(alias.name.partition(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            imports.add(node.module.partition(".")[0])
+    return sorted(imports)
+
+
+def load_import_cache():
+    if not os.path.exists(IMPORT_CACHE_PATH):
+        return {}
+    try:
+        with open(IMPORT_CACHE_PATH, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_import_cache(cache):
+    from ailess.modules.config_utils import ensure_workdir_exists
+
+    ensure_workdir_exists()
+    with open(IMPORT_CACHE_PATH, "w") as f:
+        json.dump(cache, f)
+
+
+def scan_imports(project_path):
+    """Returns modules imported anywhere in the project that aren't part of the project itself.
+
+    Parsed imports are cached per file by size and mtime, files that changed are parsed in a process pool.
+    """
+    cache = load_import_cache()
+    new_cache = {}
+    local_modules = set()
+    to_parse = []
+    for relative_path, path in iter_python_files(project_path):
+        local_modules.update(part for part in relative_path[: -len(".py")].split("/"))
+        stat = os.stat(path)
+        cached_file = cache.get(relative_path)
+        if cached_file is not None and cached_file[0] == stat.st_size and cached_file[1] == stat.st_mtime_ns:
+            new_cache[relative_path] = cached_file
+        else:
+            to_parse.append((relative_path, path, stat))
+
+    if len(to_parse) >= PARALLEL_SCAN_MIN_FILES:
+        with ProcessPoolExecutor() as executor:
+            paths = [path for _, path, _ in to_parse]
+            parsed_imports = list(executor.map(parse_file_imports, paths, chunksize=16))
+    else:
+        parsed_imports = [parse_file_imports(path) for _, path, _ in to_parse]
+
+    for (relative_path, path, stat), imports in zip(to_parse, parsed_imports):
+        if imports is None:
+            print(f"WARNING: could not parse {relative_path}, skipping it")
+            continue
+        new_cache[relative_path] = [stat.st_size, stat.st_mtime_ns, imports]
+    save_import_cache(new_cache)
+
+    imports = {module for cached_file in new_cache.values() for module in cached_file[2]}
+    return imports - local_modules - get_stdlib_modules()
+
+
+def get_stdlib_modules():
+    from pipreqs.pipreqs import join
+
+    with open(join("stdlib"), "r") as f:
+        stdlib_modules = {line.strip() for line in f}
+    return stdlib_modules | set(getattr(sys, "stdlib_module_names", []))
+
+
+def get_pypi_connection(base_url):
+    connection = getattr(_pypi_connections, "connection", None)
+    if connection is None:
+        connection_class = HTTPSConnection if base_url.scheme == "https" else HTTPConnection
+        connection = connection_class(base_url.netloc, timeout=PYPI_TIMEOUT)
+        _pypi_connections.connection = connection
+    return connection
+
+
+def get_pypi_version(name, base_url):
+    """Returns the latest version of a package on PyPI, or None if it's unknown"""
+    path = f"{base_url.path.rstrip('/')}/{name}/json"
+    for _ in range(2):
+        connection = get_pypi_connection(base_url)
+        try:
+            connection.request("GET", path, headers={"Accept": "application/json"})
+            response = connection.getresponse()
+            body = response.read()
+        except (HTTPException, OSError):
+            # The server may have closed the kept-alive connection, retry once on a new one
+            connection.close()
+            _pypi_connections.connection = None
+            continue
+        if response.status != 200:
+            return None
+        return json.loads(body)["info"]["version"]
+    return None
+
+
+def resolve_pypi_versions(names):
+    base_url = urlparse(os.environ.get("AILESS_PYPI_URL", PYPI_URL))
+    with ThreadPoolExecutor(max_workers=PYPI_WORKERS) as executor:
+        versions = list(executor.map(lambda name: get_pypi_version(name, base_url), names))
+    libs = []
+    for name, version in zip(names, versions):
+        if version is None:
+            print(f"WARNING: package {name} was not found on PyPI, skipping it")
+            continue
+        libs.append({"name": name, "version": version})
+    return libs
+
+
 def get_libs(project_path):
-    candidates = get_all_imports(project_path, encoding=None, extra_ignore_dirs=None, follow_links=None)
-    candidates = get_pkg_names(candidates)
-    pypi_server = "https://pypi.python.org/pypi/"
+    from pipreqs.pipreqs import get_pkg_names, get_import_local
+
+    candidates = get_pkg_names(sorted(scan_imports(project_path)))
     local = get_import_local(candidates, encoding=None)
 
-    difference = [
-        x
-        for x in candidates
-        if x.lower() not in [y for x in local for y in x["exports"]]
-        and x.lower() not in [x["name"] for x in local]
-    ]
+    local_exports = {export for lib in local for export in lib["exports"]}
+    local_names = {lib["name"] for lib in local}
+    difference = [x for x in candidates if x.lower() not in local_exports and x.lower() not in local_names]
 
-    imports = local + get_imports_info(difference, proxy=None, pypi_server=pypi_server)
+    imports = local + resolve_pypi_versions(difference)
     imports = sorted(imports, key=lambda x: x["name"].lower())
     return imports
 
@@ -37,109 +222,140 @@ def generate_requirements_file(project_path):
         file.write(requirements)
 
 
+INCLUDE_OPTION_REGEX = re.compile(r"^(-r|--requirement|-c|--constraint)(?:\s*=\s*|\s+|(?=\S))(.+)$")
+COMMENT_REGEX = re.compile(r"(^|\s+)#.*$")
+REQUIREMENT_OPTION_REGEX = re.compile(r"\s+--?[a-zA-Z].*$")
+# Markers are evaluated for the linux image the requirements are installed in, not the machine running ailess
+TARGET_MARKER_ENVIRONMENTS = [
+    {"sys_platform": "linux", "platform_system": "Linux", "os_name": "posix", "platform_machine": machine}
+    for machine in ["x86_64", "aarch64"]
+]
+
+
+@functools.lru_cache(maxsize=None)
+def parse_version(version):
+    try:
+        return Version(version)
+    except InvalidVersion:
+        return None
+
+
+def to_version_string(version):
+    if isinstance(version, (list, tuple)):
+        return ".".join(str(v) for v in version)
+    return str(version)
+
+
 class RequirementsParser:
+    """Index of a requirements file and everything it includes, keyed by normalized package name.
+
+    Specifiers of duplicate entries and of constraint files are merged into one SpecifierSet per package.
+    """
 
     def __init__(self, requirements):
-        if type(requirements) == str:
-            req_file = open(requirements, "r")
-            requirements = req_file.readlines()
-            req_file.close()
-        self.requirements = self.parse_all(requirements)
-
-    def parse_line(self, s):
-        # Clear
-        if s.isspace() or len(s) == 0 or s[0] == '#':
-            return '', 'emptyline', []
-        s = s.split('#')[0]
-        s = s.split(';')[0]
-        s = s.split('@')[-1]
-        s = s.replace('.*', '')
-        s = re.sub(r' *([=><!~]=?) *\*', '', s)
-        # Check if local lib
-        if os.path.isfile(s):
-            return s, 'local', []
-        # Check if url
-        if s.find('http:') > -1 or s.find('https:') > -1:
-            return s, 'url', []
-        # Check if no version specified
-        if len(re.findall(r'[=><!~]=?', s)) == 0:
-            name = re.findall(r'([a-z|0-9|.|_|-]+) *', s)
-            if len(name)>0:
-                return name[0], 'latest', []
-            else:
-                return '', 'error', []
-        # Fined name and version of lib
-        name = re.findall(r'(?:([a-z|0-9|.|_|-]+) *[=><!~]=?)', s)
-        version = re.findall(r'(?:(?:[a-z|0-9|.|_|-|\.]+)|,) *([=><!~]=?) *(\b[0-9|.]+)', s)
-        version = [[v[0],[int(n) for n in v[1].split('.')]]for v in version]
-        if len(name)>0 and len(version)>0:
-            return name[0], 'normal', version
+        self.requirements = {}
+        self.constraints = {}
+        self._specifiers = {}
+        self._loaded_files = set()
+        if isinstance(requirements, str):
+            self.load_file(requirements, self.requirements)
         else:
-            return '', 'error', []
-
-    def parse_all(self, requirements):
-        # "Recursive" reading of requirements and constraints
-        reqs = requirements.copy()
-        not_all_loaded = True
-        pars_start = 0
-        while not_all_loaded:
-            not_all_loaded = False
-            len_reqs = len(reqs)
-            for i in range(pars_start, len_reqs):
-                req = reqs[i].replace('\n','').lstrip()
-                if len(req)>1 and (req[:2]=='-r' or req[:2]=='-c'):
-                    not_all_loaded = True
-                    path = req[2:].lstrip().rstrip()
-                    req_file = open(path, "r")
-                    reqs += req_file.readlines()
-                    req_file.close()
-                pars_start = len_reqs
-        
-        # Parse requirements
-        filtred_reqs = {}
-        for i in range(len(reqs)):
-            req = reqs[i].replace('\n','').lstrip()
-            name, reqtype, version = self.parse_line(req)
-            if reqtype == 'normal' or reqtype == 'latest':
-                filtred_reqs[name] = version
-        return filtred_reqs
+            self.load_lines(requirements, os.getcwd(), self.requirements)
+        for name in self.requirements:
+            specifier = self.requirements[name]
+            if name in self.constraints:
+                specifier = specifier & self.constraints[name]
+            self._specifiers[name] = specifier
+
+    def load_file(self, path, target):
+        real_path = os.path.realpath(path)
+        file_key = (real_path, target is self.constraints)
+        if file_key in self._loaded_files:
+            return  # Already included, this also stops include cycles
+        self._loaded_files.add(file_key)
+        with open(path, "r") as f:
+            self.load_lines(f.readlines(), os.path.dirname(real_path), target)
+
+    def load_lines(self, lines, base_dir, target):
+        for line in self.join_continuations(lines):
+            line = COMMENT_REGEX.sub("", line).strip()
+            if len(line) == 0:
+                continue
+            include = INCLUDE_OPTION_REGEX.match(line)
+            if include is not None:
+                option, path = include.groups()
+                include_target = self.constraints if option in ["-c", "--constraint"] else target
+                self.load_file(os.path.join(base_dir, path.strip()), include_target)
+                continue
+            if line.startswith("-"):
+                continue  # Editable installs, index urls and other pip options
+            self.add_requirement(REQUIREMENT_OPTION_REGEX.sub("", line), target)
 
     @staticmethod
-    def compare(val1, sign, val2):
-        if sign == '==' or sign == '~=' or sign == '~':
-            return val1 == val2
-        elif sign == '!=':
-            return not (val1 == val2)
-        elif sign == '>=':
-            return val1 >= val2
-        elif sign == '<=':
-            return val1 <= val2
-        elif sign == '>':
-            return val1 > val2
-        elif sign == '<':
-            return val1 < val2
+    def join_continuations(lines):
+        current = ""
+        for line in lines:
+            line = line.rstrip("\r\n")
+            if line.endswith("\\"):
+                current += line[:-1] + " "
+                continue
+            yield current + line
+            current = ""
+        if current:
+            yield current
 
-    def is_contain(self, name):
-        if name in self.requirements:
-            return True
+    @staticmethod
+    def add_requirement(line, target):
+        try:
+            requirement = Requirement(line)
+        except InvalidRequirement:
+            return  # Local paths and plain urls don't name a package
+        if requirement.marker is not None and not any(
+            requirement.marker.evaluate(environment) for environment in TARGET_MARKER_ENVIRONMENTS
+        ):
+            return
+        name = canonicalize_name(requirement.name)
+        specifier = RequirementsParser.without_local_versions(requirement.specifier)
+        if name in target:
+            target[name] = target[name] & specifier
         else:
-            return False
-        
+            target[name] = specifier
+
+    @staticmethod
+    def without_local_versions(specifier_set):
+        """Drops local segments like +cu118 from ==/!= pins, docker tags only carry the public version"""
+        specifiers = []
+        for specifier in specifier_set:
+            if specifier.operator in ["==", "!="] and "+" in specifier.version:
+                specifier = Specifier(f"{specifier.operator}{specifier.version.partition('+')[0]}")
+            specifiers.append(specifier)
+        return SpecifierSet(",".join(str(specifier) for specifier in specifiers))
+
+    def is_contain(self, name):
+        return canonicalize_name(name) in self.requirements
+
     def is_latest(self, name):
-        if name in self.requirements and len(self.requirements[name]) == 0:
-            return True
-        else:
-            return False
-         
+        name = canonicalize_name(name)
+        return name in self._specifiers and len(self._specifiers[name]) == 0
+
     def is_match(self, name, version):
-        # If latest any version
-        if not self.is_contain(name):
-            return False
-        targets = self.requirements[name]
-        if len(targets) == 0 or len(version) == 0:
-            return True
-        for sign, t in targets:
-            if not self.compare(version, sign, t):
-                return False
-        return True
+        return len(self.filter_versions(name, [version])) > 0
+
+    def filter_versions(self, name, candidates, key=None):
+        """Returns the candidates whose version satisfies name's specifiers, keeping their order.
 
+        Versions can be strings or lists of ints, key extracts the version from a candidate.
+        Pre-releases only match if a specifier mentions one or no final release matches, as in pip.
+        """
+        name = canonicalize_name(name)
+        if name not in self._specifiers:
+            return []
+        if key is None:
+            key = lambda candidate: candidate
+        parsed_candidates = []
+        for candidate in candidates:
+            parsed = parse_version(to_version_string(key(candidate)))
+            if parsed is not None:
+                parsed_candidates.append((candidate, parsed))
+        allowed_versions = set(self._specifiers[name].filter(parsed for _, parsed in parsed_candidates))
+        return [candidate for candidate, parsed in parsed_candidates if parsed in allowed_versions]
@@ -0,0 +1,142 @@
+import ast
+import os
+
+SERVER_CONFIG_PATH = "gunicorn.conf.py"
+SERVER_INTERFACE_WSGI = "wsgi"
+SERVER_INTERFACE_ASGI = "asgi"
+
+# Constructors of app objects, by the interface gunicorn has to serve them with
+APP_CONSTRUCTORS = {
+    "Flask": SERVER_INTERFACE_WSGI,
+    "Bottle": SERVER_INTERFACE_WSGI,
+    "Falcon": SERVER_INTERFACE_WSGI,
+    "get_wsgi_application": SERVER_INTERFACE_WSGI,
+    "FastAPI": SERVER_INTERFACE_ASGI,
+    "Starlette": SERVER_INTERFACE_ASGI,
+    "Quart": SERVER_INTERFACE_ASGI,
+    "Litestar": SERVER_INTERFACE_ASGI,
+    "get_asgi_application": SERVER_INTERFACE_ASGI,
+}
+# Falcon apps are created with falcon.App() or falcon.asgi.App()
+FALCON_MODULES = {"falcon": SERVER_INTERFACE_WSGI, "falcon.asgi": SERVER_INTERFACE_ASGI}
+
+# Rough memory a worker needs on top of the model itself, used to cap the number of workers
+WORKER_MEMORY_SIZE = 512
+# Model inference can take a while, gunicorn's default of 30s would kill busy workers
+WORKER_TIMEOUT = 120
+GPU_WORKER_THREADS = 4
+
+
+def get_call_name(node):
+    """Returns the dotted name of a call's function, e.g. "falcon.asgi.App" """
+    names = []
+    node = node.func
+    while isinstance(node, ast.Attribute):
+        names.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    names.append(node.id)
+    return ".".join(reversed(names))
+
+
+def get_app_interface(call_name):
+    if call_name is None:
+        return None
+    module, _, constructor = call_name.rpartition(".")
+    if constructor == "App" and module in FALCON_MODULES:
+        return FALCON_MODULES[module]
+    return APP_CONSTRUCTORS.get(constructor)
+
+
+def is_main_guard(node):
+    return (
+        isinstance(node, ast.If)
+        and isinstance(node.test, ast.Compare)
+        and isinstance(node.test.left, ast.Name)
+        and node.test.left.id == "__name__"
+    )
+
+
+def detect_app(entrypoint_path):
+    """Finds the module-level WSGI/ASGI app object of the entrypoint.
+
+    Returns {"variable", "interface"} or None when there is no app, or when the entrypoint starts
+    a server on import (outside of `if __name__ == "__main__"`), which gunicorn can't take over.
+    """
+    try:
+        with open(entrypoint_path, "rb") as f:
+            tree = ast.parse(f.read(), filename=entrypoint_path)
+    except (SyntaxError, ValueError, OSError):
+        return None
+
+    app = None
+    for node in tree.body:
+        if is_main_guard(node) or isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            continue
+        for child in ast.walk(node):
+            if isinstance(child, ast.Call) and get_call_name(child) is not None:
+                if get_call_name(child).endswith(".run"):
+                    return None  # app.run(), uvicorn.run() and the like
+        if not isinstance(node, (ast.Assign, ast.AnnAssign)) or not isinstance(node.value, ast.Call):
+            continue
+        targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+        interface = get_app_interface(get_call_name(node.value))
+        if interface is not None and len(targets) == 1 and isinstance(targets[0], ast.Name):
+            app = {"variable": targets[0].id, "interface": interface}
+    return app
+
+
+def get_server_settings(packing):
+    """Sizes gunicorn to the task's share of the instance.
+
+    CPU tasks get 2 workers per vCPU + 1, capped by memory, and preload the app so workers share the model.
+    GPU tasks get a single worker with a few threads, since every process loads its own copy of the model
+    into GPU memory and CUDA doesn't survive a fork. Tasks are already packed one per GPU.
+    """
+    if packing["task_gpus"] > 0:
+        return {"workers": 1, "threads": GPU_WORKER_THREADS, "preload_app": False}
+    vcpus = max(packing["task_cpu"] // 1024, 1)
+    workers = max(min(2 * vcpus + 1, packing["task_memory"] // WORKER_MEMORY_SIZE), 1)
+    return {"workers": workers, "threads": 1, "preload_app": True}
+
+
+def get_server_packages(app):
+    if app is None:
+        return []
+    if app["interface"] == SERVER_INTERFACE_ASGI:
+        return ["gunicorn", "uvicorn"]
+    return ["gunicorn"]
+
+
+def get_server_command(config, app):
+    if app is None:
+        return ["python3", "-u", config["entrypoint_path"]]
+    module = os.path.splitext(os.path.normpath(config["entrypoint_path"]))[0].replace(os.sep, ".")
+    return ["gunicorn", "-c", SERVER_CONFIG_PATH, f"{module}:{app['variable']}"]
+
+
+def generate_server_config(config, app, packing):
+    if os.path.exists(os.path.join(os.getcwd(), SERVER_CONFIG_PATH)):
+        return
+
+    settings = get_server_settings(packing)
+    lines = [
+        "# Generated by ailess for {} with {} CPU units, {} MiB of memory and {} GPUs per task".format(
+            config["ec2_instance_type"], packing["task_cpu"], packing["task_memory"], packing["task_gpus"]
+        ),
+        f'bind = "0.0.0.0:{config["host_port"]}"',
+        f"workers = {settings['workers']}",
+        f"threads = {settings['threads']}",
+        f"preload_app = {settings['preload_app']}",
+        f"timeout = {WORKER_TIMEOUT}",
+        "graceful_timeout = 30",
+        "keepalive = 75",  # Longer than the ALB idle timeout, so the ALB closes idle connections first
+        'accesslog = "-"',
+    ]
+    if app["interface"] == SERVER_INTERFACE_ASGI:
+        lines.append('worker_class = "uvicorn.workers.UvicornWorker"')
+    elif settings["threads"] > 1:
+        lines.append('worker_class = "gthread"')
+    with open(SERVER_CONFIG_PATH, "w") as f:
+        f.write("\n".join(lines) + "\n")
@@ -14,6 +14,104 @@ variable "instances_count" {
   type    = number
 }
 
+variable "tasks_per_instance" {
+  type    = number
+}
+
+variable "desired_count" {
+  type        = number
+  description = "Tasks the service starts with. Only read when the service is created, afterwards the scalable target owns the count, so a new value only takes effect through min_tasks or max_tasks."
+}
+
+variable "min_tasks" {
+  type        = number
+  description = "Fewest tasks autoscaling keeps. Raising it above the running count scales the service out, this is how the task count changes after the service exists."
+}
+
+variable "max_tasks" {
+  type        = number
+  description = "Most tasks autoscaling runs. Lowering it below the running count scales the service in."
+}
+
+variable "asg_min_size" {
+  type    = number
+}
+
+variable "asg_max_size" {
+  type    = number
+}
+
+# One of "none", "requests" (ALB requests per task per minute), "cpu" (average %) or "custom"
+variable "scaling_metric" {
+  type    = string
+}
+
+variable "scaling_target" {
+  type    = number
+}
+
+variable "custom_metric_namespace" {
+  type    = string
+}
+
+variable "custom_metric_name" {
+  type    = string
+}
+
+variable "custom_metric_statistic" {
+  type    = string
+}
+
+# Rollout settings, see the rollout profiles in ailess/modules/deployment_utils.py
+variable "deregistration_delay" {
+  type    = number
+}
+
+variable "slow_start" {
+  type    = number
+}
+
+variable "health_check_path" {
+  type    = string
+}
+
+variable "health_check_matcher" {
+  type    = string
+}
+
+variable "health_check_interval" {
+  type    = number
+}
+
+variable "health_check_timeout" {
+  type    = number
+}
+
+variable "healthy_threshold" {
+  type    = number
+}
+
+variable "unhealthy_threshold" {
+  type    = number
+}
+
+variable "service_health_check_grace_period" {
+  type    = number
+}
+
+variable "asg_health_check_grace_period" {
+  type    = number
+}
+
+variable "deployment_minimum_healthy_percent" {
+  type    = number
+}
+
+# Stopped, pre-initialized instances kept ready for scale-out, 0 disables the warm pool
+variable "warm_pool_size" {
+  type    = number
+}
+
 variable "instance_type" {
   type    = string
 }
@@ -46,6 +144,17 @@ resource "aws_default_vpc" "default_vpc" {
 }
 
 terraform {
+  required_providers {
+    aws = {
+      source  = "hashicorp/aws"
+      version = ">= 4.0"
+    }
+    local = {
+      source  = "hashicorp/local"
+      version = ">= 2.0"
+    }
+  }
+
   backend "s3" {
     bucket = "%AILESS_AWS_ACCOUNT_ID%-ailess-tf-state"
     key    = "%AILESS_PROJECT_NAME%-%AILESS_AWS_REGION%-tf"
@@ -102,7 +211,7 @@ resource "aws_ecs_task_definition" "cluster_task" {
   [
     {
       "name": "${var.project_name}-cluster-task",
-      "image": "${data.aws_caller_identity.current.account_id}.dkr.ecr.${data.aws_region.current.name}.amazonaws.com/${var.project_name}:latest",
+      "image": "${local.image_uri}",
       "essential": true,
       "portMappings": [
         {
@@ -185,10 +294,15 @@ resource "aws_lb_target_group" "target_group" {
   protocol    = "HTTP"
   target_type = "instance"
   vpc_id      = "${aws_default_vpc.default_vpc.id}"
+  deregistration_delay = var.deregistration_delay
+  slow_start           = var.slow_start
   health_check {
-    interval = 10
-    healthy_threshold = 2
-    unhealthy_threshold = 5
+    path                = var.health_check_path
+    matcher             = var.health_check_matcher
+    interval            = var.health_check_interval
+    timeout             = var.health_check_timeout
+    healthy_threshold   = var.healthy_threshold
+    unhealthy_threshold = var.unhealthy_threshold
   }
 }
 
@@ -206,8 +320,9 @@ resource "aws_ecs_service" "cluster_service" {
   name = "${var.project_name}_cluster_service"
   cluster         = "${aws_ecs_cluster.cluster.id}"
   task_definition = "${aws_ecs_task_definition.cluster_task.arn}"
-  desired_count   = var.instances_count
-  deployment_minimum_healthy_percent = 100
+  desired_count   = var.desired_count
+  deployment_minimum_healthy_percent = var.deployment_minimum_healthy_percent
+  health_check_grace_period_seconds  = var.service_health_check_grace_period
   deployment_maximum_percent = 200
 
   load_balancer {
@@ -229,12 +344,56 @@ resource "aws_ecs_service" "cluster_service" {
   lifecycle {
     ignore_changes = [
       capacity_provider_strategy,
+      # Owned by the scalable target below, which also pins it when scaling is off
+      desired_count,
     ]
   }
 
   depends_on = [aws_ecs_capacity_provider.capacity_provider]
 }
 
+resource "aws_appautoscaling_target" "service_scaling_target" {
+  service_namespace  = "ecs"
+  resource_id        = "service/${aws_ecs_cluster.cluster.name}/${aws_ecs_service.cluster_service.name}"
+  scalable_dimension = "ecs:service:DesiredCount"
+  min_capacity       = var.min_tasks
+  max_capacity       = var.max_tasks
+}
+
+resource "aws_appautoscaling_policy" "service_scaling_policy" {
+  count              = var.scaling_metric != "none" ? 1 : 0
+  name               = "${var.project_name}-${var.scaling_metric}-scaling"
+  policy_type        = "TargetTrackingScaling"
+  service_namespace  = aws_appautoscaling_target.service_scaling_target.service_namespace
+  resource_id        = aws_appautoscaling_target.service_scaling_target.resource_id
+  scalable_dimension = aws_appautoscaling_target.service_scaling_target.scalable_dimension
+
+  target_tracking_scaling_policy_configuration {
+    target_value       = var.scaling_target
+    scale_out_cooldown = 60
+    scale_in_cooldown  = 300
+
+    dynamic "predefined_metric_specification" {
+      for_each = var.scaling_metric == "requests" ? ["ALBRequestCountPerTarget"] : (
+        var.scaling_metric == "cpu" ? ["ECSServiceAverageCPUUtilization"] : []
+      )
+      content {
+        predefined_metric_type = predefined_metric_specification.value
+        resource_label         = predefined_metric_specification.value == "ALBRequestCountPerTarget" ? "${aws_alb.application_load_balancer.arn_suffix}/${aws_lb_target_group.target_group.arn_suffix}" : null
+      }
+    }
+
+    dynamic "customized_metric_specification" {
+      for_each = var.scaling_metric == "custom" ? [var.custom_metric_name] : []
+      content {
+        namespace   = var.custom_metric_namespace
+        metric_name = customized_metric_specification.value
+        statistic   = var.custom_metric_statistic
+      }
+    }
+  }
+}
+
 
 resource "aws_security_group" "service_security_group" {
   name_prefix = "${var.project_name}"
@@ -293,7 +452,25 @@ resource "aws_iam_instance_profile" "ecs_agent" {
 }
 
 locals {
-  base64_user_data = base64encode("#!/bin/bash\necho ECS_CLUSTER=${aws_ecs_cluster.cluster.name} >> /etc/ecs/ecs.config")
+  image_uri = "${data.aws_caller_identity.current.account_id}.dkr.ecr.${data.aws_region.current.name}.amazonaws.com/${var.project_name}:latest"
+
+  # Instances launched into the warm pool pull the image while they are prepared, so a scale-out only has to
+  # start the container. ECS pins every deployment to the image digest, so prefer-cached still runs new code.
+  # ECS_WARM_POOL_CHECK keeps the agent from joining the cluster while the instance sits in the warm pool.
+  warm_pool_user_data = <<-USERDATA
+    echo ECS_IMAGE_PULL_BEHAVIOR=prefer-cached >> /etc/ecs/ecs.config
+    echo ECS_WARM_POOL_CHECK=true >> /etc/ecs/ecs.config
+    systemctl start docker
+    command -v aws > /dev/null || yum install -y awscli
+    aws ecr get-login-password --region ${data.aws_region.current.name} | docker login --username AWS --password-stdin ${split("/", local.image_uri)[0]}
+    docker pull ${local.image_uri} || true
+  USERDATA
+
+  base64_user_data = base64encode(join("\n", [
+    "#!/bin/bash",
+    "echo ECS_CLUSTER=${aws_ecs_cluster.cluster.name} >> /etc/ecs/ecs.config",
+    var.warm_pool_size > 0 ? local.warm_pool_user_data : "",
+  ]))
 }
 
 resource "aws_launch_template" "ecs_launch_template" {
@@ -324,9 +501,13 @@ resource "aws_ecs_capacity_provider" "capacity_provider" {
   auto_scaling_group_provider {
     auto_scaling_group_arn         = aws_autoscaling_group.cluster_asg.arn
 
+    # Adds and removes instances to fit the tasks the service scaling policy asks for,
+    # within the ASG's asg_min_size and asg_max_size
     managed_scaling {
       status                    = "ENABLED"
       target_capacity           = 100
+      minimum_scaling_step_size = 1
+      maximum_scaling_step_size = var.asg_max_size
     }
   }
 }
@@ -337,7 +518,7 @@ resource "aws_ecs_cluster_capacity_providers" "capacity_providers" {
   capacity_providers = [aws_ecs_capacity_provider.capacity_provider.name]
 
   default_capacity_provider_strategy {
-    base              = var.instances_count
+    base              = var.min_tasks
     weight            = 100
     capacity_provider = aws_ecs_capacity_provider.capacity_provider.name
   }
@@ -353,11 +534,25 @@ resource "aws_autoscaling_group" "cluster_asg" {
   depends_on = [aws_launch_template.ecs_launch_template]
 
   desired_capacity          = var.instances_count
-  min_size                  = var.instances_count
-  max_size                  = "${var.instances_count * 2}"
-  health_check_grace_period = 300
+  min_size                  = var.asg_min_size
+  max_size                  = var.asg_max_size
+  health_check_grace_period = var.asg_health_check_grace_period
   health_check_type         = "EC2"
 
+  # Stopped instances that already booted and pulled the image, started when the capacity provider scales out
+  dynamic "warm_pool" {
+    for_each = var.warm_pool_size > 0 ? [var.warm_pool_size] : []
+    content {
+      pool_state                  = "Stopped"
+      min_size                    = warm_pool.value
+      max_group_prepared_capacity = var.asg_min_size + warm_pool.value
+
+      instance_reuse_policy {
+        reuse_on_scale_in = true
+      }
+    }
+  }
+
   lifecycle {
     create_before_destroy = true
     ignore_changes = [
@@ -1,39 +1,62 @@
+import hashlib
 import json
 import os
 import re
+import threading
 from string import Template
 
-import boto3
-from yaspin import yaspin
-
-from .aws_utils import get_instance_type_info, get_aws_account_id
-from .cli_utils import run_command_in_working_directory
+from .aws_utils import get_instance_type_info, get_aws_account_id, get_client
+from .cli_utils import (
+    run_command_in_working_directory,
+    progress_spinner,
+    CommandFailedError,
+    print_command_output,
+    OutputParser,
+)
+from .config_utils import get_user_cache_dir
+from .deployment_utils import get_rollout_settings
 from .docker_utils import DOCKER_ARCHITECTURE_AMD64
+from .packing_utils import get_task_packing, get_scaling_settings
+from .trace_utils import span, traced
+
+TERRAFORM_DIR = ".ailess"
+
+_terraform_init_lock = threading.Lock()
 
 
-def generate_terraform_file(config):
+def get_terraform_dir(config, region=None):
+    """The primary region's terraform files live in .ailess, every other region gets its own directory"""
+    if region is None or region == config["aws_region"]:
+        return TERRAFORM_DIR
+    return os.path.join(TERRAFORM_DIR, "regions", region)
+
+
+def generate_terraform_file(config, terraform_dir=TERRAFORM_DIR):
     script_path = os.path.abspath(__file__)
     script_dir = os.path.dirname(script_path)
     tf_template_path = os.path.join(script_dir, "terraform/cluster.tf")
 
     with open(os.path.join(script_dir, "terraform/iam_policy.json"), "r") as file:
         iam_role_statements_content = file.read()
-    with open(".ailess/iam_policy.json", "w") as iam_role_statements_file:
+    os.makedirs(terraform_dir, exist_ok=True)
+    with open(os.path.join(terraform_dir, "iam_policy.json"), "w") as iam_role_statements_file:
         iam_role_statements_file.write(iam_role_statements_content)
     with open(tf_template_path, "r") as file:
         file_contents = file.read()
-    with open(".ailess/cluster.tf", "w") as tf_file:
+    with open(os.path.join(terraform_dir, "cluster.tf"), "w") as tf_file:
         tf_file.write(
-            file_contents.replace(
-                "%AILESS_AWS_ACCOUNT_ID%", boto3.client("sts").get_caller_identity().get("Account")
-            )
+            file_contents.replace("%AILESS_AWS_ACCOUNT_ID%", get_aws_account_id())
             .replace("%AILESS_PROJECT_NAME%", convert_to_alphanumeric(config["project_name"]))
             .replace("%AILESS_AWS_REGION%", config["aws_region"])
         )
 
 
-def generate_tfvars_file(config):
+def generate_tfvars_file(config, terraform_dir=TERRAFORM_DIR):
     instance_data = get_instance_type_info(config["ec2_instance_type"], config["aws_region"])
+    packing = get_task_packing(config, instance_data)
+    scaling = get_scaling_settings(config, packing)
+    custom_metric = scaling["scaling_custom_metric"]
+    rollout = get_rollout_settings(config)
 
     tfvars = Template(
         """
@@ -42,24 +65,64 @@ project_name = "$project_name"
 task_port = $task_port
 instance_type = "$instance_type"
 instances_count = $instances_count
+tasks_per_instance = $tasks_per_instance
+desired_count = $desired_count
+min_tasks = $min_tasks
+max_tasks = $max_tasks
+asg_min_size = $asg_min_size
+asg_max_size = $asg_max_size
+warm_pool_size = $warm_pool_size
+scaling_metric = "$scaling_metric"
+scaling_target = $scaling_target
+custom_metric_namespace = $custom_metric_namespace
+custom_metric_name = $custom_metric_name
+custom_metric_statistic = $custom_metric_statistic
 task_memory_size = $task_memory_size
 task_cpu_reservation = $task_cpu_reservation
 task_num_gpus = $task_num_gpus
 cpu_architecture = "$cpu_architecture"
+deregistration_delay = $deregistration_delay
+slow_start = $slow_start
+health_check_path = $health_check_path
+health_check_matcher = $health_check_matcher
+health_check_interval = $health_check_interval
+health_check_timeout = $health_check_timeout
+healthy_threshold = $healthy_threshold
+unhealthy_threshold = $unhealthy_threshold
+service_health_check_grace_period = $service_health_check_grace_period
+asg_health_check_grace_period = $asg_health_check_grace_period
+deployment_minimum_healthy_percent = $deployment_minimum_healthy_percent
     """
     ).substitute(
         region=config["aws_region"],
         project_name=convert_to_alphanumeric(config["project_name"]),
         task_port=config["host_port"],
-        task_memory_size=round(instance_data["memory_size"] * 0.9),
-        task_cpu_reservation=instance_data["cpu_size"],
-        task_num_gpus=instance_data["num_gpus"],
+        task_memory_size=packing["task_memory"],
+        task_cpu_reservation=packing["task_cpu"],
+        task_num_gpus=packing["task_gpus"],
         instance_type=config["ec2_instance_type"],
-        instances_count=config["instances_count"],
+        instances_count=packing["instances_count"],
+        tasks_per_instance=packing["tasks_per_instance"],
+        desired_count=packing["desired_count"],
+        min_tasks=scaling["min_tasks"],
+        max_tasks=scaling["max_tasks"],
+        asg_min_size=scaling["asg_min_size"],
+        asg_max_size=scaling["asg_max_size"],
+        warm_pool_size=scaling["warm_pool_size"],
+        scaling_metric=scaling["scaling_metric"],
+        scaling_target=scaling["scaling_target"],
+        custom_metric_namespace=json.dumps(custom_metric.get("namespace", "")),
+        custom_metric_name=json.dumps(custom_metric.get("name", "")),
+        custom_metric_statistic=json.dumps(custom_metric.get("statistic", "Average")),
         cpu_architecture="x86_64" if config["cpu_architecture"] == DOCKER_ARCHITECTURE_AMD64 else "arm64",
+        **{
+            key: json.dumps(value) if isinstance(value, str) else value
+            for key, value in rollout.items()
+        },
     )
 
-    with open(".ailess/cluster.tfvars", "w") as tfvars_file:
+    os.makedirs(terraform_dir, exist_ok=True)
+    with open(os.path.join(terraform_dir, "cluster.tfvars"), "w") as tfvars_file:
         tfvars_file.write(tfvars)
 
 
@@ -67,49 +130,246 @@ def get_tf_state_bucket_name():
     return f"{get_aws_account_id()}-ailess-tf-state"
 
 
+@traced("ensure state bucket", "terraform")
 def ensure_tf_state_bucket_exists():
-    s3 = boto3.client("s3", region_name="us-east-1")
+    s3 = get_client("s3", "us-east-1")
     bucket_name = get_tf_state_bucket_name()
     s3.create_bucket(Bucket=bucket_name)
 
 
-def is_infrastructure_update_required():
-    with yaspin(text="    verifying infrastructure") as spinner:
-        run_command_in_working_directory(
-            "terraform init -reconfigure", spinner, os.path.join(os.getcwd(), ".ailess")
-        )
-        output = run_command_in_working_directory(
-            "terraform plan -var-file=cluster.tfvars -json", spinner, os.path.join(os.getcwd(), ".ailess")
-        )
-        summary_line = filter(
-            lambda line: json.loads(line.decode("utf8")).get("type", "") == "change_summary",
-            output.splitlines(),
-        )
-        changes = json.loads(next(summary_line).decode("utf8"))["changes"]
-        spinner.ok("✔")
-        return changes["add"] > 0 or changes["change"] > 0 or changes["remove"] > 0
+TERRAFORM_INIT_STATE_FILE = "ailess_init.json"
+TERRAFORM_PLAN_FILE = "ailess.tfplan"
+INFRASTRUCTURE_STATE_FILE = "infrastructure_state.json"
+# Files that fully describe the infrastructure on our side, the remote state covers the rest
+INFRASTRUCTURE_FILES = ["cluster.tf", "cluster.tfvars", "iam_policy.json"]
+
 
+def get_terraform_env():
+    env = os.environ.copy()
+    if "TF_PLUGIN_CACHE_DIR" not in env:
+        # Share downloaded providers between all projects on the machine. It spares the download, not the
+        # registry lookups, so a project's first init still needs the network unless a mirror is configured
+        plugin_cache_dir = os.path.join(get_user_cache_dir(), "terraform-plugins")
+        os.makedirs(plugin_cache_dir, exist_ok=True)
+        env["TF_PLUGIN_CACHE_DIR"] = plugin_cache_dir
+    return env
 
-def update_infrastructure():
-    with yaspin(text="    updating infrastructure") as spinner:
-        run_command_in_working_directory(
-            "terraform init -reconfigure", spinner, os.path.join(os.getcwd(), ".ailess")
+
+class TerraformJsonParser(OutputParser):
+    """Follows `terraform ... -json` events, keeping the change summary and readable log lines"""
+
+    def __init__(self, spinner=None):
+        super().__init__(spinner)
+        self.changes = None
+
+    def handle_line(self, line, stream):
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return line
+        if not isinstance(event, dict):
+            return line
+
+        event_type = event.get("type")
+        message = event.get("@message", line)
+        if event_type == "change_summary":
+            self.changes = event["changes"]
+        elif event_type in ["refresh_start", "apply_start", "apply_progress", "planned_change"]:
+            self.set_progress(message if len(message) <= 60 else message[:57] + "...")
+        elif event_type == "diagnostic":
+            diagnostic = event["diagnostic"]
+            severity = diagnostic["severity"].capitalize()
+            return f"{severity}: {diagnostic['summary']}\n{diagnostic.get('detail', '')}"
+        return message
+
+
+def run_terraform_command(command, spinner, cwd, raise_on_error=False, parser=None):
+    with span(" ".join(command.split()[:2]), "terraform"):
+        return run_command_in_working_directory(
+            command, spinner, cwd, env=get_terraform_env(), raise_on_error=raise_on_error, parser=parser
         )
-        run_command_in_working_directory(
-            "terraform apply -auto-approve -var-file=cluster.tfvars",
+
+
+def get_terraform_block(tf_contents):
+    match = re.search(r"^terraform\s*\{", tf_contents, re.MULTILINE)
+    if match is None:
+        return ""
+    depth = 0
+    for i in range(match.end() - 1, len(tf_contents)):
+        if tf_contents[i] == "{":
+            depth += 1
+        elif tf_contents[i] == "}":
+            depth -= 1
+            if depth == 0:
+                return tf_contents[match.start() : i + 1]
+    return tf_contents[match.start() :]
+
+
+def get_terraform_init_fingerprint(cwd):
+    """Hashes everything `terraform init` depends on: backend, provider requirements and the lock file"""
+    with open(os.path.join(cwd, "cluster.tf"), "r") as f:
+        tf_contents = f.read()
+    providers = set(re.findall(r'^\s*(?:resource|data)\s+"([a-z0-9]+)_', tf_contents, re.MULTILINE))
+    providers.update(re.findall(r'^\s*provider\s+"([^"]+)"', tf_contents, re.MULTILINE))
+
+    lock_file_path = os.path.join(cwd, ".terraform.lock.hcl")
+    lock_file_contents = ""
+    if os.path.exists(lock_file_path):
+        with open(lock_file_path, "r") as f:
+            lock_file_contents = f.read()
+
+    fingerprint_source = json.dumps([get_terraform_block(tf_contents), sorted(providers), lock_file_contents])
+    return hashlib.sha256(fingerprint_source.encode("utf8")).hexdigest()
+
+
+def is_terraform_init_required(cwd):
+    init_state_path = os.path.join(cwd, ".terraform", TERRAFORM_INIT_STATE_FILE)
+    if not os.path.exists(os.path.join(cwd, ".terraform", "terraform.tfstate")) or not os.path.exists(
+        init_state_path
+    ):
+        return True
+    with open(init_state_path, "r") as f:
+        init_state = json.load(f)
+    return init_state.get("fingerprint") != get_terraform_init_fingerprint(cwd)
+
+
+def ensure_terraform_initialized(spinner, cwd):
+    if not is_terraform_init_required(cwd):
+        return
+    # The shared plugin cache isn't safe for concurrent inits, e.g. when deploying to several regions at once
+    with _terraform_init_lock:
+        run_terraform_command("terraform init -reconfigure -input=false", spinner, cwd)
+    # Fingerprint after init, it may have just created or updated the lock file
+    with open(os.path.join(cwd, ".terraform", TERRAFORM_INIT_STATE_FILE), "w") as f:
+        json.dump({"fingerprint": get_terraform_init_fingerprint(cwd)}, f)
+
+
+def get_infrastructure_fingerprint(cwd):
+    digest = hashlib.sha256()
+    for file_name in INFRASTRUCTURE_FILES:
+        with open(os.path.join(cwd, file_name), "rb") as f:
+            digest.update(file_name.encode("utf8") + b"\0" + hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def get_backend_config(cwd):
+    with open(os.path.join(cwd, "cluster.tf"), "r") as f:
+        terraform_block = get_terraform_block(f.read())
+    return dict(re.findall(r'^\s*(bucket|key|region)\s*=\s*"([^"]*)"', terraform_block, re.MULTILINE))
+
+
+def get_remote_state_serial(cwd):
+    """Returns (lineage, serial) of the terraform state stored in S3, or None if there is no state yet"""
+    backend_config = get_backend_config(cwd)
+    s3 = get_client("s3", backend_config.get("region", "us-east-1"))
+    try:
+        response = s3.get_object(Bucket=backend_config["bucket"], Key=backend_config["key"])
+    except s3.exceptions.NoSuchKey:
+        return None
+    state = json.load(response["Body"])
+    return [state.get("lineage"), state.get("serial")]
+
+
+def save_infrastructure_state(cwd, fingerprint):
+    with open(os.path.join(cwd, INFRASTRUCTURE_STATE_FILE), "w") as f:
+        json.dump({"fingerprint": fingerprint, "remote_state": get_remote_state_serial(cwd)}, f)
+
+
+def is_infrastructure_unchanged(cwd, fingerprint):
+    """True when nothing changed locally or remotely since the last apply or clean plan"""
+    infrastructure_state_path = os.path.join(cwd, INFRASTRUCTURE_STATE_FILE)
+    if not os.path.exists(infrastructure_state_path):
+        return False
+    with open(infrastructure_state_path, "r") as f:
+        infrastructure_state = json.load(f)
+    if infrastructure_state.get("fingerprint") != fingerprint:
+        return False
+    remote_state = get_remote_state_serial(cwd)
+    return remote_state is not None and infrastructure_state.get("remote_state") == remote_state
+
+
+def is_infrastructure_update_required(verify=False, cwd=None):
+    cwd = cwd or os.path.join(os.getcwd(), TERRAFORM_DIR)
+    plan_path = os.path.join(cwd, TERRAFORM_PLAN_FILE)
+    with progress_spinner("    verifying infrastructure") as spinner:
+        fingerprint = get_infrastructure_fingerprint(cwd)
+        if not verify and is_infrastructure_unchanged(cwd, fingerprint):
+            spinner.text = "    infrastructure is up to date"
+            spinner.ok("✔")
+            return False
+
+        ensure_terraform_initialized(spinner, cwd)
+        # The plan is saved so update_infrastructure can apply it without refreshing everything again
+        parser = TerraformJsonParser(spinner)
+        run_terraform_command(
+            f"terraform plan -input=false -var-file=cluster.tfvars -json -out={TERRAFORM_PLAN_FILE}",
             spinner,
-            os.path.join(os.getcwd(), ".ailess"),
+            cwd,
+            parser=parser,
         )
+        changes = parser.changes
+        spinner.ok("✔")
+        update_required = changes["add"] > 0 or changes["change"] > 0 or changes["remove"] > 0
+        if not update_required:
+            save_infrastructure_state(cwd, fingerprint)
+            if os.path.exists(plan_path):
+                os.remove(plan_path)
+        return update_required
+
+
+def update_infrastructure(cwd=None):
+    cwd = cwd or os.path.join(os.getcwd(), TERRAFORM_DIR)
+    plan_path = os.path.join(cwd, TERRAFORM_PLAN_FILE)
+    with progress_spinner("    updating infrastructure") as spinner:
+        fingerprint = get_infrastructure_fingerprint(cwd)
+        ensure_terraform_initialized(spinner, cwd)
+        if os.path.exists(plan_path):
+            try:
+                run_terraform_command(
+                    f"terraform apply -json -auto-approve -input=false {TERRAFORM_PLAN_FILE}",
+                    spinner,
+                    cwd,
+                    raise_on_error=True,
+                    parser=TerraformJsonParser(spinner),
+                )
+            except CommandFailedError as e:
+                if b"Saved plan is stale" not in e.output:
+                    spinner.fail("❌")
+                    print_command_output(e.output)
+                    exit(1)
+                # The state changed since the plan was made, plan again as part of the apply
+                run_terraform_command(
+                    "terraform apply -json -auto-approve -input=false -var-file=cluster.tfvars",
+                    spinner,
+                    cwd,
+                    parser=TerraformJsonParser(spinner),
+                )
+            finally:
+                os.remove(plan_path)
+        else:
+            run_terraform_command(
+                "terraform apply -json -auto-approve -input=false -var-file=cluster.tfvars",
+                spinner,
+                cwd,
+                parser=TerraformJsonParser(spinner),
+            )
+        save_infrastructure_state(cwd, fingerprint)
         spinner.ok("✔")
 
 
-def destroy_infrastructure():
-    with yaspin(text="    updating infrastructure") as spinner:
-        run_command_in_working_directory(
-            "terraform destroy -auto-approve -var-file=cluster.tfvars",
+def destroy_infrastructure(cwd=None):
+    cwd = cwd or os.path.join(os.getcwd(), TERRAFORM_DIR)
+    with progress_spinner("    updating infrastructure") as spinner:
+        ensure_terraform_initialized(spinner, cwd)
+        run_terraform_command(
+            "terraform destroy -json -auto-approve -var-file=cluster.tfvars",
             spinner,
-            os.path.join(os.getcwd(), ".ailess"),
+            cwd,
+            parser=TerraformJsonParser(spinner),
         )
+        infrastructure_state_path = os.path.join(cwd, INFRASTRUCTURE_STATE_FILE)
+        if os.path.exists(infrastructure_state_path):
+            os.remove(infrastructure_state_path)
         spinner.ok("✔")
 
 
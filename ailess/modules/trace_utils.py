@@ -0,0 +1,206 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+
+# None while tracing is disabled, every entry point checks it first so disabled tracing costs one lookup
+_tracer = None
+
+
+class Span:
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.started_at = None
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        self.tracer.push(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        duration = time.perf_counter() - self.started_at
+        self.tracer.pop(self)
+        if exc_type is None:
+            self.args.setdefault("status", "ok")
+        elif issubclass(exc_type, SystemExit):
+            self.args["status"] = "ok" if exc_val.code in (None, 0) else f"exit {exc_val.code}"
+        else:
+            self.args["status"] = exc_type.__name__
+        self.tracer.record(self, duration)
+        return False
+
+    def set(self, **args):
+        self.args.update(args)
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_null_span = NullSpan()
+
+
+class Tracer:
+    """Collects finished spans of every thread, in Chrome trace-event terms"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.events = []
+        self.thread_names = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def push(self, span):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(span)
+
+    def pop(self, span):
+        stack = self._local.stack
+        if stack and stack[-1] is span:
+            stack.pop()
+
+    def current(self):
+        stack = getattr(self._local, "stack", None)
+        return stack[-1] if stack else None
+
+    def record(self, span, duration):
+        thread = threading.current_thread()
+        with self._lock:
+            self.thread_names[thread.ident] = thread.name
+            self.events.append(
+                {
+                    "name": span.name,
+                    "cat": span.category,
+                    "ph": "X",
+                    "ts": round((span.started_at - self.started_at) * 1e6),
+                    "dur": round(duration * 1e6),
+                    "pid": os.getpid(),
+                    "tid": thread.ident,
+                    "args": span.args,
+                }
+            )
+
+    def to_chrome_trace(self):
+        metadata = [
+            {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+            for tid, name in self.thread_names.items()
+        ]
+        return {"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}
+
+
+def enable_tracing(trace_path=None, print_timings=False):
+    """Starts collecting spans, the trace is written and the timings printed when the process exits"""
+    global _tracer
+    _tracer = Tracer()
+    atexit.register(finish_tracing, trace_path, print_timings)
+
+
+def is_tracing_enabled():
+    return _tracer is not None
+
+
+def span(name, category="ailess", **args):
+    if _tracer is None:
+        return _null_span
+    return Span(_tracer, name, category, args)
+
+
+def traced(name, category="ailess"):
+    """Decorator running the function in a span"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with Span(_tracer, name, category, {}):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def annotate_span(**args):
+    """Adds args, like bytes moved, to the innermost span of the current thread"""
+    if _tracer is None:
+        return
+    current = _tracer.current()
+    if current is not None:
+        current.set(**args)
+
+
+def instrument_boto3_session(session):
+    """Traces every API call of clients created from the session afterwards"""
+
+    def before_call(model, context, **kwargs):
+        context["ailess_span"] = span(f"{model.service_model.service_name}.{model.name}", "aws").__enter__()
+
+    def after_call(http_response, context, **kwargs):
+        aws_span = context.pop("ailess_span", None)
+        if aws_span is None:
+            return
+        aws_span.set(http_status=http_response.status_code, bytes=len(http_response.content or b""))
+        if http_response.status_code >= 400:
+            aws_span.set(status=f"http {http_response.status_code}")
+        aws_span.__exit__(None, None, None)
+
+    def after_call_error(context, exception, **kwargs):
+        aws_span = context.pop("ailess_span", None)
+        if aws_span is not None:
+            aws_span.__exit__(type(exception), exception, None)
+
+    session.events.register("before-call", before_call)
+    session.events.register("after-call", after_call)
+    session.events.register("after-call-error", after_call_error)
+
+
+def get_span_totals(events):
+    totals = {}
+    for event in events:
+        key = (event["cat"], event["name"])
+        count, total, longest = totals.get(key, (0, 0, 0))
+        totals[key] = (count + 1, total + event["dur"], max(longest, event["dur"]))
+    return sorted(totals.items(), key=lambda item: item[1][1], reverse=True)
+
+
+def print_span_timings(events):
+    from ailess.modules.cli_utils import print_line
+
+    totals = get_span_totals(events)
+    if not totals:
+        return
+    name_width = max(len(f"{category}: {name}") for (category, name), _ in totals)
+    print_line("⏱    timings:")
+    print_line(f"       {'span'.ljust(name_width)}  {'calls':>5}  {'total':>8}  {'max':>8}")
+    for (category, name), (count, total, longest) in totals:
+        label = f"{category}: {name}"
+        print_line(f"       {label.ljust(name_width)}  {count:5}  {total / 1e6:7.2f}s  {longest / 1e6:7.2f}s")
+
+
+def finish_tracing(trace_path, print_timings):
+    tracer = _tracer
+    if tracer is None:
+        return
+    with tracer._lock:
+        events = list(tracer.events)
+    if print_timings:
+        print_span_timings(events)
+    if trace_path is not None:
+        with open(trace_path, "w") as f:
+            json.dump(tracer.to_chrome_trace(), f)
+        print(f"✔    trace saved to {trace_path}, open it in chrome://tracing or https://ui.perfetto.dev")
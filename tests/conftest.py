@@ -0,0 +1,73 @@
+import os
+import shutil
+import socket
+import subprocess
+
+import pytest
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+
+
+@pytest.fixture
+def user_cache_dir(tmp_path, monkeypatch):
+    """Keeps the catalog and other user caches of the machine running the tests out of the way"""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    return tmp_path / "cache"
+
+
+def assert_matches_golden(name, content):
+    """Compares content with tests/golden/<name>, AILESS_UPDATE_GOLDEN=1 rewrites the file instead"""
+    path = os.path.join(GOLDEN_DIR, name)
+    if os.environ.get("AILESS_UPDATE_GOLDEN"):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+    with open(path, "r") as f:
+        assert content == f.read(), f"{name} differs, rerun with AILESS_UPDATE_GOLDEN=1 if that's intended"
+
+
+def is_docker_available():
+    if shutil.which("docker") is None:
+        return False
+    completed_process = subprocess.run(
+        ["docker", "info"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return completed_process.returncode == 0
+
+
+# Docker benchmarks pull base images and build multi-hundred-MB images, they only run when asked for
+requires_docker_benchmarks = pytest.mark.skipif(
+    not os.environ.get("AILESS_DOCKER_BENCHMARKS") or not is_docker_available(),
+    reason="set AILESS_DOCKER_BENCHMARKS=1 and run a docker daemon",
+)
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def buildx_builder():
+    """A docker-container builder with an empty cache, on the host network to reach local registries"""
+    name = f"ailess-benchmark-{os.getpid()}"
+    subprocess.run(
+        [
+            "docker",
+            "buildx",
+            "create",
+            "--name",
+            name,
+            "--driver",
+            "docker-container",
+            "--driver-opt",
+            "network=host",
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        yield name
+    finally:
+        subprocess.run(["docker", "buildx", "rm", name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
@@ -0,0 +1,135 @@
+import datetime
+
+import pytest
+
+pytest.importorskip("boto3")
+pytest.importorskip("yaspin")
+
+from ailess.modules import deployment_utils  # noqa: E402
+
+CLUSTER_NAME = "golden-app-cluster"
+SERVICE_NAME = "golden-app_cluster_service"
+DEPLOYMENT_ID = "ecs-svc/1234567890"
+INSTANCE_ARN = "arn:aws:ecs:us-east-1:123456789012:container-instance/golden-app-cluster/abc"
+STARTED_AT = datetime.datetime(2026, 10, 18, 12, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+def at(seconds):
+    return STARTED_AT + datetime.timedelta(seconds=seconds)
+
+
+class FakeRollout:
+    """ECS and ELB as seen by each poll: (seconds since the deployment, running count, target state,
+    rollout state, events as (seconds, message))
+    """
+
+    def __init__(self, polls):
+        self.polls = polls
+        self.index = -1
+
+    def next_poll(self):
+        self.index += 1
+        return self.polls[self.index]
+
+    def describe_services(self, cluster, services):
+        seconds, running_count, _, rollout_state, events = self.polls[self.index]
+        deployment = {
+            "id": DEPLOYMENT_ID,
+            "createdAt": STARTED_AT,
+            "updatedAt": at(seconds),
+            "runningCount": running_count,
+            "pendingCount": 1 - running_count,
+            "desiredCount": 1,
+            "rolloutState": rollout_state,
+        }
+        service = {
+            "deployments": [deployment],
+            "loadBalancers": [{"targetGroupArn": "arn:target-group"}],
+            "events": [
+                {"id": str(event_seconds), "createdAt": at(event_seconds), "message": message}
+                for event_seconds, message in reversed(events)
+            ],
+        }
+        return {"services": [service]}
+
+    def list_tasks(self, cluster, startedBy):
+        return {"taskArns": ["arn:task"]}
+
+    def describe_tasks(self, cluster, tasks):
+        task = {"taskArn": "arn:task", "containerInstanceArn": INSTANCE_ARN, "createdAt": at(1)}
+        if self.polls[self.index][1] > 0:
+            task.update(pullStartedAt=at(5), pullStoppedAt=at(20), startedAt=at(22))
+            task["containers"] = [{"networkBindings": [{"hostPort": 32768}]}]
+        return {"tasks": [task]}
+
+    def describe_container_instances(self, cluster, containerInstances):
+        return {"containerInstances": [{"containerInstanceArn": INSTANCE_ARN, "ec2InstanceId": "i-new"}]}
+
+    def describe_target_health(self, TargetGroupArn):
+        target_state = self.polls[self.index][2]
+        targets = [{"Target": {"Id": "i-old", "Port": 32770}, "TargetHealth": {"State": "healthy"}}]
+        if target_state is not None:
+            targets.append(
+                {"Target": {"Id": "i-new", "Port": 32768}, "TargetHealth": {"State": target_state}}
+            )
+        return {"TargetHealthDescriptions": targets}
+
+
+class Spinner:
+    text = "    waiting for deployment"
+
+    def write(self, text):
+        pass
+
+
+COMPLETED_MESSAGE = f"(service {SERVICE_NAME}) (deployment {DEPLOYMENT_ID}) deployment completed."
+ROLLOUT = [
+    (3, 0, None, "IN_PROGRESS", []),
+    (5, 0, None, "IN_PROGRESS", []),
+    (8, 0, None, "IN_PROGRESS", []),
+    (24, 1, "initial", "IN_PROGRESS", []),
+    (26, 1, "initial", "IN_PROGRESS", []),
+    (28, 1, "initial", "IN_PROGRESS", []),
+    (30, 1, "healthy", "IN_PROGRESS", []),
+    (75, 1, "healthy", "COMPLETED", [(71, COMPLETED_MESSAGE)]),
+]
+
+
+@pytest.fixture
+def rollout(monkeypatch):
+    fake_rollout = FakeRollout(ROLLOUT)
+    monkeypatch.setattr(deployment_utils, "get_client", lambda service, region=None: fake_rollout)
+    # Polls happen at the times the fake ECS reports
+    monkeypatch.setattr(deployment_utils.time, "time", lambda: at(ROLLOUT[fake_rollout.index][0]).timestamp())
+    return fake_rollout
+
+
+def test_polls_stay_fast_during_health_checks(rollout):
+    watcher = deployment_utils.DeploymentWatcher(CLUSTER_NAME, SERVICE_NAME, "us-east-1", Spinner())
+    intervals = []
+    for _ in ROLLOUT:
+        rollout.next_poll()
+        watcher.poll()
+        intervals.append(watcher.poll_interval)
+
+    minimum = deployment_utils.MIN_POLL_INTERVAL
+    # Backs off while the task is pending, but not while its target is being health checked
+    assert intervals[1] > minimum and intervals[2] > intervals[1]
+    assert intervals[3:6] == [minimum] * 3
+
+
+def test_phases_use_ecs_timestamps(rollout):
+    watcher = deployment_utils.DeploymentWatcher(CLUSTER_NAME, SERVICE_NAME, "us-east-1", Spinner())
+    for _ in ROLLOUT:
+        rollout.next_poll()
+        deployment = watcher.poll()
+
+    durations = watcher.get_phase_durations(deployment)
+
+    assert durations["task placement"] == 1
+    assert durations["image pull"] == 15
+    assert durations["container start"] == 2
+    assert durations["alb health checks"] == 30 - 22
+    # The completion event, not the poll that noticed it 4s later
+    assert durations["draining old tasks"] == 71 - 30
+    assert durations["total"] == 71
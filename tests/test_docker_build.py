@@ -0,0 +1,206 @@
+import json
+import shlex
+import subprocess
+
+import pytest
+
+pytest.importorskip("boto3")
+pytest.importorskip("yaspin")
+
+from ailess.modules import aws_utils, cli_utils, docker_utils  # noqa: E402
+
+ECR_IMAGE = "123456789012.dkr.ecr.us-east-1.amazonaws.com/golden-app"
+CONFIG = {
+    "project_name": "golden-app",
+    "aws_region": "us-east-1",
+    "cpu_architecture": docker_utils.DOCKER_ARCHITECTURE_AMD64,
+}
+
+
+@pytest.fixture
+def fake_ecr(monkeypatch):
+    """ECR repo, login and image name without AWS"""
+    monkeypatch.setattr(aws_utils, "ensure_ecr_repo_exists", lambda config: None)
+    monkeypatch.setattr(aws_utils, "ensure_ecr_login", lambda region, spinner: None)
+    monkeypatch.setattr(aws_utils, "get_ecr_image_name", lambda config: ECR_IMAGE)
+
+
+def get_build_argv(config, push_while_building, builder_args="", cache_args=""):
+    output_args = docker_utils.get_build_output_args(config, None, push_while_building)
+    return shlex.split(
+        docker_utils.get_build_command(
+            config, "/app/Dockerfile", output_args, builder_args, cache_args, push_while_building
+        )
+    )
+
+
+def test_gzip_build_loads_a_tagged_local_image():
+    argv = get_build_argv(CONFIG, push_while_building=False)
+
+    assert argv[:3] == ["docker", "buildx", "build"]
+    assert argv[argv.index("-t") + 1] == "golden-app:latest"
+    assert "--load" in argv
+    assert not any(arg.startswith("type=image") for arg in argv)
+
+
+def test_zstd_build_pushes_to_ecr_without_a_tag(fake_ecr):
+    argv = get_build_argv(dict(CONFIG, layer_compression="zstd"), push_while_building=True)
+
+    # buildx lets -t override the output's name=, which would push to docker.io instead of ECR
+    assert "-t" not in argv
+    assert "--load" not in argv
+    output = argv[argv.index("--output") + 1].split(",")
+    assert output[0] == "type=image"
+    assert f"name={ECR_IMAGE}:latest" in output
+    assert {"push=true", "compression=zstd", "force-compression=true", "oci-mediatypes=true"} <= set(output)
+    assert argv[argv.index("--metadata-file") + 1] == docker_utils.BUILD_METADATA_PATH
+
+
+@pytest.mark.parametrize(
+    "compression, for_deploy, expected",
+    [("gzip", True, False), ("zstd", True, True), ("zstd", False, False), (None, True, False)],
+)
+def test_only_zstd_deploys_push_while_building(compression, for_deploy, expected):
+    config = dict(CONFIG, layer_compression=compression) if compression else CONFIG
+
+    assert docker_utils.is_pushed_while_building(config, for_deploy) is expected
+
+
+def test_pushed_manifest_is_read_from_the_index(monkeypatch):
+    index = {
+        "manifests": [
+            {"digest": "sha256:arm", "platform": {"os": "linux", "architecture": "arm64"}},
+            {"digest": "sha256:amd", "platform": {"os": "linux", "architecture": "amd64"}},
+            {"digest": "sha256:attestation", "platform": {"os": "unknown", "architecture": "unknown"}},
+        ]
+    }
+    manifest = {
+        "layers": [
+            {"mediaType": "application/vnd.oci.image.layer.v1.tar+zstd", "size": 3000},
+            {"mediaType": "application/vnd.oci.image.layer.v1.tar+gzip", "size": 500},
+        ]
+    }
+    inspected_refs = []
+
+    def fake_run(command, **kwargs):
+        inspected_refs.append(command[-1])
+        content = manifest if command[-1].endswith("@sha256:amd") else index
+        return subprocess.CompletedProcess(command, 0, stdout=json.dumps(content).encode("utf8"))
+
+    monkeypatch.setattr(docker_utils.subprocess, "run", fake_run)
+
+    pushed_manifest = docker_utils.inspect_pushed_manifest(f"{ECR_IMAGE}@sha256:index", "linux/amd64")
+
+    assert inspected_refs == [f"{ECR_IMAGE}@sha256:index", f"{ECR_IMAGE}@sha256:amd"]
+    assert docker_utils.get_layer_compression_summary(pushed_manifest) == (3500, 1, 2)
+
+
+ECR_REGISTRY = ECR_IMAGE.rpartition("/")[0]
+ECR_CACHE_REF = f"{ECR_REGISTRY}/golden-app:buildcache"
+
+
+class SilentSpinner:
+    def fail(self, text):
+        pass
+
+
+@pytest.mark.parametrize("mode", ["min", "max"])
+def test_registry_cache_flags_use_an_ecr_image_manifest(fake_ecr, monkeypatch, mode):
+    monkeypatch.setattr(aws_utils, "get_ecr_registry_url", lambda region: ECR_REGISTRY)
+
+    argv = shlex.split(docker_utils.get_build_cache_args(dict(CONFIG, build_cache_mode=mode), None))
+
+    assert argv == [
+        "--cache-from",
+        f"type=registry,ref={ECR_CACHE_REF}",
+        "--cache-to",
+        f"type=registry,ref={ECR_CACHE_REF},mode={mode},image-manifest=true,oci-mediatypes=true",
+    ]
+
+
+def test_registry_cache_elsewhere_skips_the_ecr_login(monkeypatch):
+    monkeypatch.setattr(aws_utils, "get_ecr_registry_url", lambda region: ECR_REGISTRY)
+    monkeypatch.setattr(aws_utils, "ensure_ecr_login", lambda region, spinner: pytest.fail("logged into ECR"))
+    config = dict(CONFIG, build_cache_mode="max", build_cache_ref="ghcr.io/acme/golden-app:cache")
+
+    argv = shlex.split(docker_utils.get_build_cache_args(config, None))
+
+    assert argv[1] == "type=registry,ref=ghcr.io/acme/golden-app:cache"
+
+
+def test_build_cache_is_off_by_default_and_validated():
+    assert docker_utils.get_build_cache_args(CONFIG, None) == ""
+    with pytest.raises(SystemExit):
+        docker_utils.get_build_cache_args(dict(CONFIG, build_cache_mode="all"), SilentSpinner())
+
+
+@pytest.fixture
+def fake_docker(tmp_path, monkeypatch, fake_ecr):
+    """Records the docker commands of a build, `docker buildx inspect ailess` fails until the builder exists"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cli_utils, "_line_progress", True)  # Plain progress lines instead of a spinner
+    (tmp_path / "Dockerfile").write_text("FROM python:3.9\nCOPY . /app\n")
+    (tmp_path / "app.py").write_text("print('hello')\n")
+    monkeypatch.setattr(aws_utils, "get_ecr_registry_url", lambda region: ECR_REGISTRY)
+    docker = {"builder_exists": False, "commands": []}
+
+    def run(command, **kwargs):
+        docker["commands"].append(command)
+        if command[:3] == ["docker", "buildx", "inspect"]:
+            return subprocess.CompletedProcess(command, 0 if docker["builder_exists"] else 1)
+        return subprocess.CompletedProcess(command, 0, stdout=b"1024\n")
+
+    def run_command_in_working_directory(command, spinner, **kwargs):
+        docker["commands"].append(shlex.split(command))
+        if command.startswith("docker buildx create"):
+            docker["builder_exists"] = True
+        elif "--metadata-file" in command:
+            with open(docker_utils.BUILD_METADATA_PATH, "w") as f:
+                json.dump({"containerimage.digest": "sha256:pushed"}, f)
+
+    monkeypatch.setattr(docker_utils.subprocess, "run", run)
+    monkeypatch.setattr(docker_utils, "run_command_in_working_directory", run_command_in_working_directory)
+    return docker
+
+
+def get_build_argvs(docker):
+    return [command for command in docker["commands"] if command[:3] == ["docker", "buildx", "build"]]
+
+
+def test_local_builds_use_the_default_builder(fake_docker):
+    docker_utils.build_docker_image(dict(CONFIG, build_cache_mode="max"), for_deploy=False)
+
+    [argv] = get_build_argvs(fake_docker)
+    assert "--builder" not in argv and "--cache-to" not in argv
+    assert not any(
+        command[:2] == ["docker", "buildx"] and command[2] != "build" for command in fake_docker["commands"]
+    )
+
+
+@pytest.mark.parametrize(
+    "config_overrides",
+    [{"build_cache_mode": "max"}, {"layer_compression": "zstd"}],
+    ids=["registry_cache", "zstd"],
+)
+def test_deploy_builds_create_the_container_builder_once(fake_docker, config_overrides):
+    config = dict(CONFIG, **config_overrides)
+    docker_utils.build_docker_image(config, for_deploy=True)
+    with open("app.py", "a") as f:
+        f.write("print('changed')\n")  # Rebuilds, this time with the builder in place
+    docker_utils.build_docker_image(config, for_deploy=True)
+
+    creates = [
+        command for command in fake_docker["commands"] if command[:3] == ["docker", "buildx", "create"]
+    ]
+    assert creates == [["docker", "buildx", "create", "--name", "ailess", "--driver", "docker-container"]]
+    for argv in get_build_argvs(fake_docker):
+        assert argv[argv.index("--builder") + 1] == docker_utils.BUILDX_BUILDER_NAME
+        assert ("--cache-to" in argv) == ("build_cache_mode" in config_overrides)
+
+
+def test_deploy_builds_without_cache_or_zstd_use_the_default_builder(fake_docker):
+    docker_utils.build_docker_image(CONFIG, for_deploy=True)
+
+    [argv] = get_build_argvs(fake_docker)
+    assert "--builder" not in argv
+    assert "--load" in argv
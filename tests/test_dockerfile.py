@@ -0,0 +1,70 @@
+import pytest
+
+pytest.importorskip("yaspin")
+
+from ailess.modules import docker_utils  # noqa: E402
+from conftest import assert_matches_golden  # noqa: E402
+
+CPU_CONFIG = {
+    "cpu_architecture": docker_utils.DOCKER_ARCHITECTURE_AMD64,
+    "has_gpu": False,
+    "entrypoint_path": "app.py",
+}
+GPU_CONFIG = dict(CPU_CONFIG, has_gpu=True, gpu_manufacturer="NVIDIA")
+ASGI_APP = {"variable": "app", "interface": "asgi"}
+
+CASES = {
+    "simple": (CPU_CONFIG, "numpy\n", None),
+    "simple_app": (CPU_CONFIG, "numpy\n", ASGI_APP),
+    "simple_gpu": (GPU_CONFIG, "torch\n", None),
+    "multistage": (
+        dict(CPU_CONFIG, dockerfile_mode=docker_utils.DOCKERFILE_MODE_MULTISTAGE),
+        "numpy\n",
+        None,
+    ),
+    "multistage_app": (
+        dict(CPU_CONFIG, dockerfile_mode=docker_utils.DOCKERFILE_MODE_MULTISTAGE),
+        "numpy\n",
+        ASGI_APP,
+    ),
+    "multistage_gpu": (
+        dict(GPU_CONFIG, dockerfile_mode=docker_utils.DOCKERFILE_MODE_MULTISTAGE),
+        "torch\n",
+        None,
+    ),
+}
+
+
+def generate_dockerfile(tmp_path, monkeypatch, config, requirements, app):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "requirements.txt").write_text(requirements)
+    # Detecting the app is covered by the server tests, sizing it would need the instance catalog
+    monkeypatch.setattr(docker_utils, "get_entrypoint_app", lambda config: app)
+    docker_utils.generate_dockerfile(config)
+    return (tmp_path / "Dockerfile").read_text()
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_dockerfile_matches_golden(case, tmp_path, monkeypatch):
+    assert_matches_golden(
+        f"dockerfile/{case}.Dockerfile", generate_dockerfile(tmp_path, monkeypatch, *CASES[case])
+    )
+
+
+def test_multistage_dockerfile_keeps_build_tools_out_of_the_image(tmp_path, monkeypatch):
+    dockerfile = generate_dockerfile(tmp_path, monkeypatch, *CASES["multistage_app"])
+    final_stage = dockerfile[dockerfile.rindex("\nFROM base\n") :]
+
+    assert dockerfile.startswith("# syntax=docker/dockerfile:1\n")
+    assert "build-essential" in dockerfile and "build-essential" not in final_stage
+    assert "--mount=type=cache,target=/root/.cache/pip" in dockerfile
+    # Server packages are built into wheels with the requirements and installed from them only
+    assert "-r /tmp/requirements.txt gunicorn uvicorn" in dockerfile
+    assert "--no-index --find-links=/wheels" in final_stage
+    assert final_stage.index("COPY requirements.txt") < final_stage.index("COPY . /app")
+
+
+def test_existing_dockerfile_is_kept(tmp_path, monkeypatch):
+    (tmp_path / "Dockerfile").write_text("FROM scratch\n")
+
+    assert generate_dockerfile(tmp_path, monkeypatch, *CASES["multistage"]) == "FROM scratch\n"
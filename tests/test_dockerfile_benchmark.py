@@ -0,0 +1,87 @@
+import subprocess
+import time
+
+import pytest
+
+pytest.importorskip("yaspin")
+
+from ailess.modules import docker_utils  # noqa: E402
+from conftest import requires_docker_benchmarks  # noqa: E402
+
+pytestmark = [pytest.mark.benchmark, requires_docker_benchmarks]
+
+CONFIG = {
+    "cpu_architecture": docker_utils.DOCKER_ARCHITECTURE_AMD64,
+    "has_gpu": False,
+    "entrypoint_path": "app.py",
+}
+REQUIREMENTS = "numpy\nrequests\n"
+# A dependency that builds from source, where the builder stage and the pip cache matter most
+ADDED_REQUIREMENT = "pyyaml --no-binary pyyaml\n"
+
+
+def build(project_dir, builder, image_name):
+    """Builds and loads the project's image, returns the seconds it took"""
+    started_at = time.perf_counter()
+    subprocess.run(
+        ["docker", "buildx", "build", "--builder", builder, "--platform", CONFIG["cpu_architecture"]]
+        + ["--load", "-t", image_name, str(project_dir)],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - started_at
+
+
+def measure_builds(project_dir, monkeypatch, builder, mode):
+    """Cold build, rebuild after a code change and after a requirements change, and the image size"""
+    mode_dir = project_dir / mode
+    mode_dir.mkdir()
+    (mode_dir / "requirements.txt").write_text(REQUIREMENTS)
+    (mode_dir / "app.py").write_text("print('v1')\n")
+    monkeypatch.chdir(mode_dir)
+    monkeypatch.setattr(docker_utils, "get_entrypoint_app", lambda config: None)
+    docker_utils.generate_dockerfile(dict(CONFIG, dockerfile_mode=mode))
+
+    image_name = f"ailess-dockerfile-benchmark:{mode}"
+    cold = build(mode_dir, builder, image_name)
+    (mode_dir / "app.py").write_text("print('v2')\n")
+    code_change = build(mode_dir, builder, image_name)
+    with open(mode_dir / "requirements.txt", "a") as f:
+        f.write(ADDED_REQUIREMENT)
+    requirements_change = build(mode_dir, builder, image_name)
+    size = int(docker_utils.inspect_local_image(image_name, "{{.Size}}"))
+    subprocess.run(["docker", "image", "rm", "-f", image_name], stdout=subprocess.DEVNULL)
+    return cold, code_change, requirements_change, size
+
+
+def test_multistage_dockerfile_rebuilds(tmp_path, monkeypatch, buildx_builder):
+    # Both modes share the builder, so base image layers are pulled once and neither gets them for free
+    subprocess.run(
+        [
+            "docker",
+            "buildx",
+            "build",
+            "--builder",
+            buildx_builder,
+            "--platform",
+            CONFIG["cpu_architecture"],
+            "-",
+        ],
+        input=b"FROM python:3.9\n",
+    )
+    results = {
+        mode: measure_builds(tmp_path, monkeypatch, buildx_builder, mode)
+        for mode in [docker_utils.DOCKERFILE_MODE_SIMPLE, docker_utils.DOCKERFILE_MODE_MULTISTAGE]
+    }
+
+    print()
+    for mode, (cold, code_change, requirements_change, size) in results.items():
+        print(
+            f"{mode}: cold {cold:.1f}s, code change {code_change:.1f}s, "
+            f"requirements change {requirements_change:.1f}s, {docker_utils.format_size(size)}"
+        )
+    # Build times depend on the network and the machine, the image size doesn't
+    assert (
+        results[docker_utils.DOCKERFILE_MODE_MULTISTAGE][3] <= results[docker_utils.DOCKERFILE_MODE_SIMPLE][3]
+    )
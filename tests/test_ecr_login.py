@@ -0,0 +1,111 @@
+import base64
+import datetime
+import json
+
+import pytest
+
+pytest.importorskip("boto3")
+pytest.importorskip("yaspin")
+
+from ailess.modules import aws_utils  # noqa: E402
+from ailess.modules.cli_utils import CommandFailedError  # noqa: E402
+
+REGION = "us-east-1"
+REGISTRY_URL = "123456789012.dkr.ecr.us-east-1.amazonaws.com"
+
+
+class FakeEcr:
+    def get_authorization_token(self):
+        expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=12)
+        token = base64.b64encode(b"AWS:password").decode("utf8")
+        return {"authorizationData": [{"authorizationToken": token, "expiresAt": expires_at}]}
+
+
+class Spinner:
+    def fail(self, text):
+        pass
+
+
+@pytest.fixture
+def docker_logins(tmp_path, monkeypatch, user_cache_dir):
+    """Records `docker login` calls, which store the registry in $DOCKER_CONFIG/config.json like docker does"""
+    monkeypatch.setenv("DOCKER_CONFIG", str(tmp_path / "docker"))
+    monkeypatch.setattr(aws_utils, "get_client", lambda service, region=None: FakeEcr())
+    monkeypatch.setattr(aws_utils, "get_ecr_registry_url", lambda region: REGISTRY_URL)
+    logins = []
+
+    def login_to_docker_registry(username, password, registry_url, spinner):
+        logins.append(registry_url)
+        config_path = aws_utils.get_docker_config_path()
+        (tmp_path / "docker").mkdir(exist_ok=True)
+        with open(config_path, "w") as f:
+            json.dump({"auths": {registry_url: {"auth": "..."}}}, f)
+
+    monkeypatch.setattr(aws_utils, "login_to_docker_registry", login_to_docker_registry)
+    return logins
+
+
+def test_cached_token_skips_the_login(docker_logins):
+    aws_utils.ensure_ecr_login(REGION, None)
+    aws_utils.ensure_ecr_login(REGION, None)
+
+    assert docker_logins == [REGISTRY_URL]
+
+
+def test_docker_logout_is_noticed(docker_logins):
+    aws_utils.ensure_ecr_login(REGION, None)
+    with open(aws_utils.get_docker_config_path(), "w") as f:
+        json.dump({"auths": {}}, f)
+
+    aws_utils.ensure_ecr_login(REGION, None)
+
+    assert docker_logins == [REGISTRY_URL, REGISTRY_URL]
+
+
+def test_token_cache_is_per_docker_config(docker_logins, tmp_path, monkeypatch):
+    aws_utils.ensure_ecr_login(REGION, None)
+    monkeypatch.setenv("DOCKER_CONFIG", str(tmp_path / "other-docker"))
+    (tmp_path / "other-docker").mkdir()
+    with open(aws_utils.get_docker_config_path(), "w") as f:
+        # Another registry's credential doesn't help
+        json.dump({"auths": {"ghcr.io": {}}}, f)
+
+    aws_utils.ensure_ecr_login(REGION, None)
+
+    assert docker_logins == [REGISTRY_URL, REGISTRY_URL]
+
+
+def fail_commands(monkeypatch, outputs):
+    """run_command_in_working_directory fails with each output in turn, then succeeds"""
+    commands = []
+
+    def run_command_in_working_directory(command, spinner, raise_on_error=False, parser=None):
+        commands.append(command)
+        if outputs:
+            output = outputs.pop(0)
+            if not raise_on_error:
+                exit(1)
+            raise CommandFailedError(command, 1, output)
+
+    monkeypatch.setattr(aws_utils, "run_command_in_working_directory", run_command_in_working_directory)
+    return commands
+
+
+def test_rejected_credential_logs_in_again_and_retries(docker_logins, monkeypatch):
+    aws_utils.ensure_ecr_login(REGION, None)
+    commands = fail_commands(monkeypatch, [b"push access denied: no basic auth credentials\n"])
+
+    aws_utils.run_ecr_command("docker push image", [REGION], Spinner())
+
+    assert commands == ["docker push image", "docker push image"]
+    assert docker_logins == [REGISTRY_URL, REGISTRY_URL]
+
+
+def test_other_failures_are_not_retried(docker_logins, monkeypatch):
+    commands = fail_commands(monkeypatch, [b"manifest unknown\n"])
+
+    with pytest.raises(SystemExit):
+        aws_utils.run_ecr_command("docker push image", [REGION], Spinner())
+
+    assert commands == ["docker push image"]
+    assert docker_logins == [REGISTRY_URL]
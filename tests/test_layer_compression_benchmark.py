@@ -0,0 +1,93 @@
+import subprocess
+import time
+
+import pytest
+
+pytest.importorskip("yaspin")
+
+from ailess.modules import docker_utils  # noqa: E402
+from conftest import get_free_port, requires_docker_benchmarks  # noqa: E402
+
+pytestmark = [pytest.mark.benchmark, requires_docker_benchmarks]
+
+PLATFORM = docker_utils.DOCKER_ARCHITECTURE_AMD64
+# A model-sized image: a python base, compressible weights and a few incompressible MB
+DOCKERFILE = """FROM python:3.11-slim
+RUN python -c "open('/weights.bin', 'wb').write(bytes(range(256)) * 512 * 1024)"
+RUN head -c 32000000 /dev/urandom > /random.bin
+"""
+COMPRESSION_OUTPUTS = {
+    "gzip": "compression=gzip,force-compression=true",
+    "zstd": "compression=zstd,force-compression=true,oci-mediatypes=true",
+}
+
+
+def run(command):
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+@pytest.fixture
+def local_registry():
+    """registry:2 on a free port, reachable from a host-network builder as localhost"""
+    port = get_free_port()
+    container_id = (
+        subprocess.run(
+            ["docker", "run", "-d", "--rm", "-p", f"127.0.0.1:{port}:5000", "registry:2"],
+            check=True,
+            stdout=subprocess.PIPE,
+        )
+        .stdout.decode("utf8")
+        .strip()
+    )
+    try:
+        yield f"localhost:{port}"
+    finally:
+        subprocess.run(["docker", "rm", "-f", container_id], stdout=subprocess.DEVNULL)
+
+
+def measure_pull(image_ref):
+    """Returns the seconds a cold `docker pull` takes and the unpacked size"""
+    subprocess.run(
+        ["docker", "image", "rm", "-f", image_ref], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    started_at = time.perf_counter()
+    run(["docker", "pull", "--platform", PLATFORM, image_ref])
+    duration = time.perf_counter() - started_at
+    size = int(docker_utils.inspect_local_image(image_ref, "{{.Size}}"))
+    subprocess.run(["docker", "image", "rm", "-f", image_ref], stdout=subprocess.DEVNULL)
+    return duration, size
+
+
+def test_zstd_layers_pull_faster_than_gzip(tmp_path, local_registry, buildx_builder):
+    (tmp_path / "Dockerfile").write_text(DOCKERFILE)
+    results = {}
+    for compression, output_options in COMPRESSION_OUTPUTS.items():
+        image_ref = f"{local_registry}/benchmark:{compression}"
+        run(
+            [
+                "docker",
+                "buildx",
+                "build",
+                "--builder",
+                buildx_builder,
+                "--platform",
+                PLATFORM,
+                "--output",
+                f"type=image,name={image_ref},push=true,registry.insecure=true,{output_options}",
+                str(tmp_path),
+            ]
+        )
+        manifest = docker_utils.inspect_pushed_manifest(image_ref, PLATFORM)
+        compressed_size, zstd_layers, layers = docker_utils.get_layer_compression_summary(manifest)
+        assert zstd_layers == (layers if compression == "zstd" else 0)
+        pull_time, unpacked_size = measure_pull(image_ref)
+        results[compression] = (compressed_size, unpacked_size, pull_time)
+
+    print()
+    for compression, (compressed_size, unpacked_size, pull_time) in results.items():
+        print(
+            f"{compression}: {docker_utils.format_size(compressed_size)} pushed, "
+            f"{docker_utils.format_size(unpacked_size)} unpacked, pulled in {pull_time:.1f}s"
+        )
+    # Pull times on a loaded machine vary too much for a strict bound, the sizes don't
+    assert results["zstd"][0] <= results["gzip"][0]
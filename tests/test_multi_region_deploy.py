@@ -0,0 +1,244 @@
+import base64
+import datetime
+import json
+import os
+import stat
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("typer")
+pytest.importorskip("boto3")
+pytest.importorskip("yaspin")
+
+from ailess import cli  # noqa: E402
+from ailess.modules import aws_utils, cli_utils, deployment_utils, docker_utils, terraform_utils  # noqa: E402
+from ailess.modules.pipeline_utils import (  # noqa: E402
+    Stage,
+    run_stages,
+    STAGE_OK,
+    STAGE_FAILED,
+    STAGE_SKIPPED,
+)
+
+REGIONS = ["us-east-1", "eu-west-1", "ap-south-1"]
+FAILING_REGION = "eu-west-1"
+ACCOUNT_ID = "123456789012"
+CONFIG = {
+    "project_name": "golden-app",
+    "aws_region": REGIONS[0],
+    "aws_regions": REGIONS,
+    "cpu_architecture": docker_utils.DOCKER_ARCHITECTURE_AMD64,
+}
+CLUSTER_TF = """terraform {
+  backend "s3" {
+    bucket = "123456789012-ailess-tf-state"
+    key    = "golden-app.tfstate"
+    region = "us-east-1"
+  }
+}
+"""
+# Every call is logged as "<cwd> <tool> <args>", docker push fails for the registry of $SHIM_FAIL_REGION
+DOCKER_SHIM = """#!/bin/sh
+echo "$PWD docker $*" >> "$SHIM_LOG"
+case "$1 $2" in
+  "push "*"$SHIM_FAIL_REGION"*) echo "denied: not authorized to push" >&2; exit 1 ;;
+  "image inspect") exit 1 ;;
+  "login "*) cat > /dev/null ;;
+esac
+"""
+TERRAFORM_SHIM = """#!/bin/sh
+echo "$PWD terraform $*" >> "$SHIM_LOG"
+case "$1" in
+  init) mkdir -p .terraform && touch .terraform/terraform.tfstate ;;
+  plan) touch ailess.tfplan && echo '{"type":"change_summary","changes":{"add":1,"change":0,"remove":0}}' ;;
+esac
+"""
+
+
+class FakeExceptions:
+    class NoSuchKey(Exception):
+        pass
+
+    class RepositoryAlreadyExistsException(Exception):
+        pass
+
+    class ImageNotFoundException(Exception):
+        pass
+
+    class RepositoryNotFoundException(Exception):
+        pass
+
+
+class FakeClient:
+    """Answers the AWS calls of a deploy and records the ECS ones"""
+
+    exceptions = FakeExceptions
+
+    def __init__(self, service, region, calls):
+        self.service = service
+        self.region = region
+        self.calls = calls
+
+    def get_caller_identity(self):
+        return {"Account": ACCOUNT_ID}
+
+    def create_bucket(self, Bucket):
+        pass
+
+    def get_object(self, Bucket, Key):
+        raise FakeExceptions.NoSuchKey()
+
+    def create_repository(self, repositoryName):
+        pass
+
+    def get_authorization_token(self):
+        expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=12)
+        token = base64.b64encode(b"AWS:password").decode("utf8")
+        return {"authorizationData": [{"authorizationToken": token, "expiresAt": expires_at}]}
+
+    def describe_images(self, repositoryName, imageIds):
+        return {"imageDetails": [{"imageSizeInBytes": 1024, "imageDigest": "sha256:pushed"}]}
+
+    def update_service(self, cluster, service, forceNewDeployment):
+        self.calls.append(("update_service", self.region))
+
+    def describe_load_balancers(self, Names):
+        return {"LoadBalancers": [{"DNSName": f"{Names[0]}.{self.region}.elb.amazonaws.com"}]}
+
+
+@pytest.fixture
+def deploy_project(tmp_path, monkeypatch, user_cache_dir):
+    """A three-region project whose docker, terraform and AWS calls are all local"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for name, content in [("docker", DOCKER_SHIM), ("terraform", TERRAFORM_SHIM)]:
+        (bin_dir / name).write_text(content)
+        (bin_dir / name).chmod(stat.S_IRWXU)
+    shim_log = tmp_path / "shim.log"
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("SHIM_LOG", str(shim_log))
+    monkeypatch.setenv("SHIM_FAIL_REGION", f".{FAILING_REGION}.")
+
+    project_dir = tmp_path / "project"
+    project_dir.mkdir()
+    monkeypatch.chdir(project_dir)
+    os.makedirs(".ailess")
+    with open(".ailess/config.json", "w") as f:
+        json.dump(CONFIG, f)
+    for region in REGIONS:
+        terraform_dir = terraform_utils.get_terraform_dir(CONFIG, region)
+        os.makedirs(terraform_dir, exist_ok=True)
+        for file_name, content in [
+            ("cluster.tf", CLUSTER_TF),
+            ("cluster.tfvars", ""),
+            ("iam_policy.json", "{}"),
+        ]:
+            with open(os.path.join(terraform_dir, file_name), "w") as f:
+                f.write(content)
+
+    calls = []
+    clients = {}
+
+    def get_client(service, region=None):
+        return clients.setdefault((service, region), FakeClient(service, region, calls))
+
+    for module in [aws_utils, terraform_utils, deployment_utils]:
+        monkeypatch.setattr(module, "get_client", get_client)
+    aws_utils.get_caller_identity.cache_clear()
+    # The build itself is covered by test_docker_build, here it only has to leave an image to push
+    monkeypatch.setattr(docker_utils, "build_docker_image", lambda config, for_deploy=False: None)
+    monkeypatch.setattr(
+        deployment_utils,
+        "wait_for_deployment",
+        lambda config: calls.append(("rollout", config["aws_region"])),
+    )
+    yield {"calls": calls, "shim_log": shim_log}
+    aws_utils.get_caller_identity.cache_clear()
+
+
+def read_shim_log(shim_log):
+    with open(shim_log, "r") as f:
+        return f.read().splitlines()
+
+
+def test_failing_region_leaves_the_other_regions_deploying(deploy_project, capsys):
+    with pytest.raises(SystemExit):
+        cli.deploy(verify_infra=False)
+
+    output = capsys.readouterr().out
+    healthy_regions = [region for region in REGIONS if region != FAILING_REGION]
+    assert sorted(deploy_project["calls"]) == sorted(
+        [("update_service", region) for region in healthy_regions]
+        + [("rollout", region) for region in healthy_regions]
+    )
+    # The failing region's infrastructure doesn't depend on its push, so it is applied all the same
+    shim_log = read_shim_log(deploy_project["shim_log"])
+    applied_dirs = {line.split(" terraform ")[0] for line in shim_log if " terraform apply " in line}
+    for region in REGIONS:
+        assert os.path.abspath(terraform_utils.get_terraform_dir(CONFIG, region)) in applied_dirs
+
+    table = output[output.index("🌍    regions:") :].splitlines()
+    assert table[1].split() == ["region", "push", "image", "infrastructure", "deploy", "rollout"]
+    rows = {line.split()[0]: line.split()[1:] for line in table[2 : 2 + len(REGIONS)]}
+    assert rows[FAILING_REGION] == [STAGE_FAILED, STAGE_OK, STAGE_SKIPPED, STAGE_SKIPPED]
+    for region in healthy_regions:
+        assert rows[region] == [STAGE_OK] * 4
+        assert f"golden-app-lb.{region}.elb.amazonaws.com" in output
+    assert f"deploy failed in {FAILING_REGION}" in output
+
+
+@pytest.fixture
+def fresh_cancellation(monkeypatch):
+    # Cancelling is final for the process, a cancelled test run must not cancel the next one
+    monkeypatch.setattr(cli_utils, "_cancelled", threading.Event())
+
+
+def test_fail_fast_cancels_running_and_unstarted_stages(fresh_cancellation):
+    started = []
+
+    def fail():
+        raise ValueError("build failed")
+
+    def run_command():
+        started.append("slow command")
+        cli_utils.run_command_in_working_directory("sleep 30", None)
+
+    stages = [
+        Stage("build", fail),
+        Stage("slow command", run_command),
+        Stage("after build", lambda: started.append("after build"), depends_on=["build"]),
+        Stage("after command", lambda: started.append("after command"), depends_on=["slow command"]),
+    ]
+    started_at = time.monotonic()
+    with pytest.raises(SystemExit):
+        run_stages(stages)
+
+    assert time.monotonic() - started_at < 10, "the running command wasn't stopped"
+    assert "after build" not in started
+    assert "after command" not in started
+
+
+def test_without_fail_fast_only_dependents_are_skipped(fresh_cancellation):
+    finished = []
+
+    def fail():
+        raise ValueError("push failed")
+
+    stages = [
+        Stage("push [a]", fail),
+        Stage("deploy [a]", lambda: finished.append("a"), depends_on=["push [a]"]),
+        Stage("push [b]", lambda: time.sleep(0.2)),
+        Stage("deploy [b]", lambda: finished.append("b"), depends_on=["push [b]"]),
+    ]
+
+    statuses = run_stages(stages, fail_fast=False)
+
+    assert finished == ["b"]
+    assert statuses == {
+        "push [a]": STAGE_FAILED,
+        "deploy [a]": STAGE_SKIPPED,
+        "push [b]": STAGE_OK,
+        "deploy [b]": STAGE_OK,
+    }
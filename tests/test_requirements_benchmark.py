@@ -0,0 +1,68 @@
+import os
+import time
+
+from ailess.modules.python_utils import RequirementsParser
+
+TREE_LINES = 5000
+INCLUDED_FILES = 20
+TAG_COUNT = 500
+# Parsing the tree and matching every package against the tags, generous enough for a loaded CI machine
+BENCHMARK_BUDGET_S = float(os.environ.get("AILESS_REQUIREMENTS_BUDGET_S", "10"))
+
+
+def generate_requirements_tree(root):
+    """Writes a requirements tree of about TREE_LINES lines and returns its package names.
+
+    requirements.txt starts a chain of nested -r includes whose last file includes the root again and a
+    constraints file. Every package has a comment, a range and a != entry under its non-normalized name.
+    """
+    # Three lines per package in its file and one in the constraints file
+    packages_per_file = TREE_LINES // 4 // (INCLUDED_FILES + 1)
+    names = []
+    for file_index in range(INCLUDED_FILES + 1):
+        lines = []
+        if file_index < INCLUDED_FILES:
+            lines.append(f"-r {'reqs/' if file_index == 0 else ''}level{file_index + 1}.txt")
+        else:
+            lines += ["-r ../requirements.txt", "-c constraints.txt"]  # The root again closes a cycle
+        for package_index in range(len(names), len(names) + packages_per_file):
+            name = f"Package_{package_index}"
+            major = package_index % 7
+            names.append(name)
+            lines.append(f"# {name} is pinned")
+            lines.append(f"{name}>={major}.0,<{major + 2}.0  # below the next major")
+            lines.append(f"{name.lower().replace('_', '-')}!={major}.1.1")
+        file_name = "requirements.txt" if file_index == 0 else f"reqs/level{file_index}.txt"
+        path = os.path.join(root, file_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+    with open(os.path.join(root, "reqs", "constraints.txt"), "w") as f:
+        f.write("\n".join(f"{name}<{index % 7 + 1}.5" for index, name in enumerate(names)) + "\n")
+    return names
+
+
+def test_requirements_tree_benchmark(tmp_path):
+    names = generate_requirements_tree(str(tmp_path))
+    tags = [[major, minor, patch] for major in range(10) for minor in range(10) for patch in range(5)]
+    tags = tags[:TAG_COUNT]
+
+    started_at = time.perf_counter()
+    requirements = RequirementsParser(str(tmp_path / "requirements.txt"))
+    matches = {name: requirements.filter_versions(name, tags) for name in names}
+    duration = time.perf_counter() - started_at
+
+    print(f"\n{len(names)} packages x {len(tags)} tags in {duration:.2f}s")
+    assert duration < BENCHMARK_BUDGET_S
+    assert all(requirements.is_contain(name) for name in names)
+    # Package_3: >=3.0,<5.0 and !=3.1.1, constrained to <4.5
+    assert [3, 1, 1] not in matches["Package_3"]
+    assert matches["Package_3"][0] == [3, 0, 0]
+    assert matches["Package_3"][-1] == [4, 4, 4]
+
+
+def test_local_version_pins_match_public_tags():
+    requirements = RequirementsParser(["torch==2.0.1+cu118", 'tensorflow==2.13; sys_platform == "linux"'])
+
+    assert requirements.filter_versions("torch", [[2, 0, 0], [2, 0, 1]]) == [[2, 0, 1]]
+    assert requirements.filter_versions("tensorflow", ["2.13.0", "2.12.0"]) == ["2.13.0"]
@@ -0,0 +1,175 @@
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("yaspin")
+
+from ailess.modules import python_utils  # noqa: E402
+
+THIRD_PARTY_MODULES = ["numpy", "requests", "yaml"]
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # pipreqs' stdlib list only adds python 2 modules to this one
+    monkeypatch.setattr(python_utils, "get_stdlib_modules", lambda: set(sys.stdlib_module_names))
+    return tmp_path
+
+
+def write_fixture_tree(root, file_count):
+    """A package of file_count modules importing each other, the stdlib and THIRD_PARTY_MODULES in turn"""
+    os.makedirs(root / "app" / "models")
+    (root / "app" / "__init__.py").write_text("")
+    for index in range(file_count - 1):
+        module = THIRD_PARTY_MODULES[index % len(THIRD_PARTY_MODULES)]
+        (root / "app" / "models" / f"model_{index}.py").write_text(
+            f"import os\nimport {module}.submodule\nfrom app.models import model_0\nfrom . import model_1\n"
+        )
+    # Files outside the build context, in virtualenvs or broken never count
+    (root / ".dockerignore").write_text("scripts\n")
+    os.makedirs(root / "scripts")
+    (root / "scripts" / "notebook.py").write_text("import matplotlib\n")
+    os.makedirs(root / "venv" / "lib")
+    (root / "venv" / "lib" / "site.py").write_text("import setuptools\n")
+
+
+class CountingProcessPool(ProcessPoolExecutor):
+    instances = 0
+
+    def __init__(self, *args, **kwargs):
+        CountingProcessPool.instances += 1
+        super().__init__(*args, **kwargs)
+
+
+@pytest.fixture
+def counting_process_pool(monkeypatch):
+    CountingProcessPool.instances = 0
+    monkeypatch.setattr(python_utils, "ProcessPoolExecutor", CountingProcessPool)
+    return CountingProcessPool
+
+
+@pytest.mark.parametrize("file_count", [8, python_utils.PARALLEL_SCAN_MIN_FILES + 1])
+def test_scan_finds_third_party_imports(project, counting_process_pool, file_count):
+    write_fixture_tree(project, file_count)
+
+    assert python_utils.scan_imports(".") == set(THIRD_PARTY_MODULES)
+    assert counting_process_pool.instances == (1 if file_count >= python_utils.PARALLEL_SCAN_MIN_FILES else 0)
+
+
+def test_import_cache_only_reparses_changed_files(project, monkeypatch):
+    write_fixture_tree(project, 8)
+    python_utils.scan_imports(".")
+    with open(python_utils.IMPORT_CACHE_PATH, "r") as f:
+        cached_paths = set(json.load(f))
+    assert "app/models/model_0.py" in cached_paths and "scripts/notebook.py" not in cached_paths
+
+    parsed_paths = []
+    parse_file_imports = python_utils.parse_file_imports
+    monkeypatch.setattr(
+        python_utils, "parse_file_imports", lambda path: parsed_paths.append(path) or parse_file_imports(path)
+    )
+    assert python_utils.scan_imports(".") == set(THIRD_PARTY_MODULES)
+    assert parsed_paths == []
+
+    (project / "app" / "models" / "model_0.py").write_text("import torch\n")
+    os.remove(project / "app" / "models" / "model_2.py")
+    assert python_utils.scan_imports(".") == set(THIRD_PARTY_MODULES) | {"torch"}
+    assert parsed_paths == [os.path.join(".", "app", "models", "model_0.py")]
+    with open(python_utils.IMPORT_CACHE_PATH, "r") as f:
+        assert "app/models/model_2.py" not in json.load(f)
+
+
+def test_unreadable_import_cache_is_rebuilt(project):
+    write_fixture_tree(project, 8)
+    (project / ".ailess").mkdir()
+    (project / python_utils.IMPORT_CACHE_PATH).write_text("{not json")
+
+    assert python_utils.scan_imports(".") == set(THIRD_PARTY_MODULES)
+
+
+class PyPIStandIn:
+    """Answers /pypi/<name>/json over HTTP/1.1 keep-alive connections, recording which connection asked"""
+
+    def __init__(self, versions, drop_connections=False):
+        self.versions = versions
+        self.drop_connections = drop_connections
+        self.requests = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stand_in.requests.append(self.client_address)
+                name = self.path.split("/")[-2]
+                if name in stand_in.versions:
+                    status, body = 200, json.dumps({"info": {"version": stand_in.versions[name]}})
+                else:
+                    status, body = 404, json.dumps({"message": "Not Found"})
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body.encode("utf8"))
+                # Like a server dropping idle kept-alive connections, without telling the client
+                self.close_connection = stand_in.drop_connections
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/pypi/"
+
+
+@pytest.fixture
+def pypi(monkeypatch):
+    servers = []
+
+    def start(versions, drop_connections=False):
+        stand_in = PyPIStandIn(versions, drop_connections)
+        threading.Thread(target=stand_in.server.serve_forever, args=(0.05,), daemon=True).start()
+        servers.append(stand_in.server)
+        monkeypatch.setenv("AILESS_PYPI_URL", stand_in.url)
+        return stand_in
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+PACKAGE_VERSIONS = {f"package-{index}": f"1.{index}.0" for index in range(40)}
+
+
+def test_pypi_versions_reuse_a_connection_per_worker(pypi):
+    stand_in = pypi(PACKAGE_VERSIONS)
+
+    libs = python_utils.resolve_pypi_versions(list(PACKAGE_VERSIONS))
+
+    assert libs == [{"name": name, "version": version} for name, version in PACKAGE_VERSIONS.items()]
+    assert len(stand_in.requests) == len(PACKAGE_VERSIONS)
+    assert len(set(stand_in.requests)) <= python_utils.PYPI_WORKERS
+
+
+def test_dropped_pypi_connections_are_reopened(pypi):
+    stand_in = pypi(PACKAGE_VERSIONS, drop_connections=True)
+
+    libs = python_utils.resolve_pypi_versions(list(PACKAGE_VERSIONS))
+
+    assert [lib["version"] for lib in libs] == list(PACKAGE_VERSIONS.values())
+    assert len(set(stand_in.requests)) == len(PACKAGE_VERSIONS)
+
+
+def test_unknown_pypi_packages_are_skipped(pypi, capsys):
+    pypi({"numpy": "1.26.4"})
+
+    assert python_utils.resolve_pypi_versions(["numpy", "not-on-pypi"]) == [
+        {"name": "numpy", "version": "1.26.4"}
+    ]
+    assert "package not-on-pypi was not found on PyPI" in capsys.readouterr().out
@@ -0,0 +1,105 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("gunicorn")
+
+from ailess.modules.bench_utils import run_bench  # noqa: E402
+from ailess.modules.server_utils import (  # noqa: E402
+    SERVER_CONFIG_PATH,
+    detect_app,
+    generate_server_config,
+    get_server_command,
+    get_server_settings,
+)
+
+BENCH_DURATION = 5
+# Workers share the task's vCPUs, fewer than 2 leave nothing to gain over the single-process server
+TASK_VCPUS = min(os.cpu_count() or 1, 4)
+MIN_SPEEDUP = 1.5
+
+APP_SOURCE = """
+import os
+
+from flask import Flask
+
+app = Flask(__name__)
+
+
+@app.route("/")
+def predict():
+    total = 0
+    for i in range(200000):  # About as CPU-bound as a small model's forward pass
+        total += i * i
+    return str(total)
+
+
+if __name__ == "__main__":
+    app.run(host="127.0.0.1", port=int(os.environ["PORT"]))
+"""
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        assert process.poll() is None, "the server exited before accepting connections"
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"nothing listens on port {port}")
+
+
+def measure_throughput(command, port):
+    """Starts the server command, loads it at twice the task's vCPUs in flight and returns requests/s"""
+    process = subprocess.Popen(
+        command,
+        env=dict(os.environ, PORT=str(port)),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(port, process)
+        bench = run_bench(f"http://127.0.0.1:{port}", concurrency=TASK_VCPUS * 2, duration=BENCH_DURATION)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+    assert bench["results"]["errors"] == {}
+    return bench["results"]["throughput_rps"]
+
+
+@pytest.mark.skipif(TASK_VCPUS < 2, reason="needs at least 2 CPUs to run workers side by side")
+def test_generated_server_outperforms_single_process(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open("app.py", "w") as f:
+        f.write(APP_SOURCE)
+    port = get_free_port()
+    config = {"ec2_instance_type": "test", "host_port": port, "entrypoint_path": "app.py"}
+    packing = {"task_cpu": TASK_VCPUS * 1024, "task_memory": TASK_VCPUS * 2048, "task_gpus": 0}
+
+    app = detect_app("app.py")
+    assert app == {"variable": "app", "interface": "wsgi"}
+    generate_server_config(config, app, packing)
+    assert os.path.exists(SERVER_CONFIG_PATH)
+    assert get_server_settings(packing)["workers"] > 1
+
+    # The CMD without an app, and the generated one, run from this interpreter
+    single_process_command = [sys.executable] + get_server_command(config, None)[1:]
+    server_command = [sys.executable, "-m"] + get_server_command(config, app)
+    single_process_throughput = measure_throughput(single_process_command, port)
+    server_throughput = measure_throughput(server_command, port)
+
+    print(f"\nsingle process {single_process_throughput} req/s, gunicorn {server_throughput} req/s")
+    assert server_throughput >= single_process_throughput * MIN_SPEEDUP
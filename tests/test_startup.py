@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("typer")
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Cumulative import time of ailess.cli, generous enough for a loaded CI machine
+IMPORT_BUDGET_US = int(os.environ.get("AILESS_IMPORT_BUDGET_MS", "200")) * 1000
+# Only the command that needs them may import these
+HEAVY_MODULES = ["boto3", "botocore", "inquirer", "yaspin", "pipreqs"]
+SUBCOMMANDS = ["init", "deploy", "serve", "context", "bench", "refresh-catalog", "destroy"]
+
+
+def get_import_times(args):
+    """Runs `python -X importtime -m ailess <args>` and returns {module: cumulative microseconds}"""
+    completed_process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "ailess"] + args,
+        cwd=ROOT_DIR,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=dict(os.environ, PYTHONDONTWRITEBYTECODE="1"),
+    )
+    assert completed_process.returncode == 0, completed_process.stderr.decode("utf8")[-2000:]
+    import_times = {}
+    for line in completed_process.stderr.decode("utf8").splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:") :].split("|")
+        import_times[module.strip()] = int(cumulative)
+    return import_times
+
+
+STARTUP_ARGS = [["--version"], ["--help"]] + [[command, "--help"] for command in SUBCOMMANDS]
+
+
+@pytest.mark.parametrize("args", STARTUP_ARGS)
+def test_startup_stays_within_budget(args):
+    import_times = get_import_times(args)
+
+    heavy_imports = [module for module in import_times if module.partition(".")[0] in HEAVY_MODULES]
+    assert heavy_imports == [], f"ailess {' '.join(args)} imports {', '.join(heavy_imports)}"
+    assert import_times["ailess.cli"] <= IMPORT_BUDGET_US, (
+        f"importing ailess.cli took {import_times['ailess.cli'] / 1000:.0f} ms, "
+        f"the budget is {IMPORT_BUDGET_US / 1000:.0f} ms"
+    )
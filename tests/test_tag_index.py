@@ -0,0 +1,162 @@
+import json
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from ailess.modules.docker_searchers import tag_index
+
+REPOSITORY = "pytorch/pytorch"
+
+
+class DockerHubStandIn:
+    """Serves a repository's tags the way Docker Hub pages them, with an ETag on every page"""
+
+    def __init__(self, tags, page_size=2):
+        self.tags = tags
+        self.page_size = page_size
+        self.etag = '"v1"'
+        self.requests = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stand_in.requests.append((self.path, self.headers.get("If-None-Match")))
+                if self.headers.get("If-None-Match") == stand_in.etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                body = json.dumps(stand_in.get_page(self.path)).encode("utf8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", stand_in.etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def get_page(self, path):
+        url = urllib.parse.urlparse(path)
+        assert url.path == f"/v2/repositories/{REPOSITORY}/tags/"
+        page_number = int(urllib.parse.parse_qs(url.query).get("page", ["1"])[0])
+        start = (page_number - 1) * self.page_size
+        next_url = None
+        if start + self.page_size < len(self.tags):
+            next_url = f"{self.url}{url.path}?{url.query.split('&page=')[0]}&page={page_number + 1}"
+        return {
+            "results": [{"name": tag} for tag in self.tags[start : start + self.page_size]],
+            "next": next_url,
+        }
+
+
+@pytest.fixture
+def docker_hub(monkeypatch, user_cache_dir):
+    stand_in = DockerHubStandIn(
+        ["1.13.0-runtime", "2.0.1-runtime", "latest", "2.1.0-runtime", "1.9.0-runtime"]
+    )
+    thread = threading.Thread(target=stand_in.server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    # DOCKER_HUB_URL is read from AILESS_DOCKER_HUB_URL when the module is imported
+    monkeypatch.setattr(tag_index, "DOCKER_HUB_URL", stand_in.url)
+    monkeypatch.setattr(tag_index, "_tag_indexes", {})
+    monkeypatch.delenv("AILESS_OFFLINE", raising=False)
+    yield stand_in
+    stand_in.server.shutdown()
+    stand_in.server.server_close()
+
+
+def get_fresh_tag_index():
+    """Reads the index like a new ailess process would, from the disk cache or Docker Hub"""
+    tag_index._tag_indexes.clear()
+    return tag_index.get_tag_index(REPOSITORY, "runtime")
+
+
+def expire_cache(monkeypatch):
+    monkeypatch.setattr(tag_index, "TAG_INDEX_TTL", -1)
+
+
+def test_every_page_is_fetched_and_sorted(docker_hub):
+    index = get_fresh_tag_index()
+
+    assert [tag for _, tag in index] == ["2.1.0-runtime", "2.0.1-runtime", "1.13.0-runtime", "1.9.0-runtime"]
+    pages = [urllib.parse.parse_qs(path.partition("?")[2]).get("page") for path, _ in docker_hub.requests]
+    assert pages == [None, ["2"], ["3"]]
+
+
+def test_pagination_stops_at_max_pages(docker_hub, monkeypatch):
+    monkeypatch.setattr(tag_index, "MAX_PAGES", 2)
+
+    index = get_fresh_tag_index()
+
+    assert len(docker_hub.requests) == 2
+    # 1.9.0-runtime is on the third page
+    assert [tag for _, tag in index] == ["2.1.0-runtime", "2.0.1-runtime", "1.13.0-runtime"]
+
+
+def test_fresh_cache_is_used_without_requests(docker_hub):
+    index = get_fresh_tag_index()
+    docker_hub.requests.clear()
+
+    assert get_fresh_tag_index() == index
+    assert docker_hub.requests == []
+
+
+def test_expired_cache_is_revalidated_with_the_first_page_etag(docker_hub, monkeypatch):
+    index = get_fresh_tag_index()
+    docker_hub.requests.clear()
+    expire_cache(monkeypatch)
+
+    assert get_fresh_tag_index() == index
+    # The 304 on the first page spares the other pages
+    assert [etag for _, etag in docker_hub.requests] == ['"v1"']
+
+
+def test_expired_cache_is_refetched_when_the_tags_changed(docker_hub, monkeypatch):
+    get_fresh_tag_index()
+    docker_hub.requests.clear()
+    expire_cache(monkeypatch)
+    docker_hub.tags = docker_hub.tags + ["2.2.0-runtime"]
+    docker_hub.etag = '"v2"'
+
+    index = get_fresh_tag_index()
+
+    assert index[0][1] == "2.2.0-runtime"
+    assert len(docker_hub.requests) == 3
+    docker_hub.requests.clear()
+    monkeypatch.setattr(tag_index, "TAG_INDEX_TTL", 24 * 60 * 60)
+    assert get_fresh_tag_index() == index
+    assert docker_hub.requests == []
+
+
+def test_offline_uses_an_expired_cache(docker_hub, monkeypatch):
+    index = get_fresh_tag_index()
+    docker_hub.requests.clear()
+    expire_cache(monkeypatch)
+    monkeypatch.setenv("AILESS_OFFLINE", "1")
+
+    assert get_fresh_tag_index() == index
+    assert docker_hub.requests == []
+
+
+def test_offline_without_cache_falls_back_to_latest(docker_hub, monkeypatch, capsys):
+    monkeypatch.setenv("AILESS_OFFLINE", "1")
+
+    assert get_fresh_tag_index() == []
+    assert docker_hub.requests == []
+    assert "no cached tags" in capsys.readouterr().out
+
+
+def test_unreachable_docker_hub_falls_back_to_the_cache(docker_hub, monkeypatch, capsys):
+    index = get_fresh_tag_index()
+    expire_cache(monkeypatch)
+    docker_hub.server.shutdown()
+    docker_hub.server.server_close()
+
+    assert get_fresh_tag_index() == index
+    assert "could not fetch tags" in capsys.readouterr().out
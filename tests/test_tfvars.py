@@ -0,0 +1,92 @@
+import pytest
+
+pytest.importorskip("boto3")
+
+from ailess.modules import aws_utils, terraform_utils  # noqa: E402
+from ailess.modules.catalog_utils import get_cached_instance_type  # noqa: E402
+from ailess.modules.docker_utils import DOCKER_ARCHITECTURE_AMD64  # noqa: E402
+from ailess.modules.packing_utils import get_task_packing, get_scaling_settings  # noqa: E402
+
+from conftest import assert_matches_golden  # noqa: E402
+
+BASE_CONFIG = {
+    "project_name": "golden-app",
+    "aws_region": "us-east-1",
+    "host_port": 5000,
+    "instances_count": 2,
+    "ec2_instance_type": "g4dn.12xlarge",
+    "cpu_architecture": DOCKER_ARCHITECTURE_AMD64,
+    "rollout_profile": "safe",
+    "health_check_path": "/health",
+}
+
+CASES = {
+    "scaling_none": {},
+    "scaling_requests": {"scaling_metric": "requests", "min_tasks": 4, "max_tasks": 16},
+    "scaling_cpu": {"scaling_metric": "cpu", "scaling_target": 60, "min_tasks": 8, "max_tasks": 12},
+    "scaling_custom": {
+        "scaling_metric": "custom",
+        "scaling_target": 5,
+        "scaling_custom_metric": {"namespace": "App", "name": "QueueDepthPerTask", "statistic": "Maximum"},
+        "max_tasks": 20,
+    },
+    "warm_pool_auto": {"scaling_metric": "requests", "max_tasks": 16, "warm_pool_size": True},
+    "warm_pool_fixed": {"warm_pool_size": 1},
+}
+
+
+@pytest.fixture(autouse=True)
+def catalog_only(user_cache_dir, monkeypatch):
+    """Instance types come from the bundled catalog, any AWS call fails the test"""
+    get_cached_instance_type.cache_clear()
+    aws_utils.get_instance_type_info.cache_clear()
+
+    def get_client(*args, **kwargs):
+        raise AssertionError("tfvars rendering must not call AWS")
+
+    monkeypatch.setattr(aws_utils, "get_client", get_client)
+    yield
+    get_cached_instance_type.cache_clear()
+    aws_utils.get_instance_type_info.cache_clear()
+
+
+@pytest.mark.parametrize("case", sorted(CASES))
+def test_tfvars_matches_golden(case, tmp_path):
+    terraform_utils.generate_tfvars_file(dict(BASE_CONFIG, **CASES[case]), str(tmp_path))
+
+    with open(tmp_path / "cluster.tfvars", "r") as f:
+        assert_matches_golden(f"tfvars/{case}.tfvars", f.read())
+
+
+def test_default_packing_runs_one_task_per_gpu():
+    instance_data = aws_utils.get_instance_type_info("g4dn.12xlarge", "us-east-1")
+
+    packing = get_task_packing(BASE_CONFIG, instance_data)
+
+    assert packing["tasks_per_instance"] == 4
+    assert packing["task_gpus"] == 1
+    assert packing["desired_count"] == 8
+
+
+@pytest.mark.parametrize(
+    "task_shape, tasks_per_instance",
+    [({"task_gpus": 0}, 1), ({"task_gpus": 0, "task_cpu": 4096}, 12), ({"task_gpus": 2}, 2)],
+)
+def test_explicit_task_gpus_is_packed_as_given(task_shape, tasks_per_instance):
+    instance_data = aws_utils.get_instance_type_info("g4dn.12xlarge", "us-east-1")
+
+    packing = get_task_packing(dict(BASE_CONFIG, **task_shape), instance_data)
+
+    assert packing["tasks_per_instance"] == tasks_per_instance
+    assert packing["task_gpus"] == task_shape["task_gpus"]
+
+
+def test_warm_pool_covers_scale_out():
+    instance_data = aws_utils.get_instance_type_info("g4dn.12xlarge", "us-east-1")
+    config = dict(BASE_CONFIG, **CASES["warm_pool_auto"])
+
+    scaling = get_scaling_settings(config, get_task_packing(config, instance_data))
+
+    assert scaling["asg_min_size"] == 2
+    assert scaling["warm_pool_size"] == 2
+    assert scaling["asg_max_size"] == 8